@@ -0,0 +1,207 @@
+"""
+Per priority class latency of a model endpoint under mixed load.
+
+Interactive users send short streaming chat requests while batch users send large embedding
+(or chat) requests back to back, each class with its own `X-Priority-Class` header.
+The latency percentiles of each class are reported, run it once with the admission priority
+classes of the FastAPI framework enabled and once without to compare (a class weighted above the
+default one needs an `--api_key` whose tenant lists it in `allowed_priority_classes`):
+
+    python benchmark_priority.py --base_url http://localhost:8080 --model_id Qwen2.5-7B-Instruct \
+        --interactive_users 8 --batch_users 32 --session_time 120
+
+With `--simulate`, the admission controller of the pipeline is benchmarked in process against
+a simulated engine, first as a single FIFO queue then with weighted fair queuing.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+
+class ClassMetrics:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.head_latencies = collections.defaultdict(list)
+        self.status = collections.defaultdict(collections.Counter)
+
+    def report(self, title):
+        print(f"=================== {title} ====================")
+        for priority_class in sorted(self.status):
+            print(f"[{priority_class}] Status: {dict(self.status[priority_class])}")
+            for name, latencies in (
+                ("Response Head Latency", self.head_latencies[priority_class]),
+                ("Response Latency", self.latencies[priority_class]),
+            ):
+                if latencies:
+                    print(
+                        f"[{priority_class}] {name}: "
+                        f"avg {np.mean(latencies):.3f}, "
+                        f"p50 {np.percentile(latencies, 50):.3f}, "
+                        f"p95 {np.percentile(latencies, 95):.3f}, "
+                        f"p99 {np.percentile(latencies, 99):.3f}"
+                    )
+        print()
+
+
+def make_request(args, priority_class):
+    headers = {"Content-Type": "application/json", args.priority_header: priority_class}
+    if args.api_key:
+        headers["Authorization"] = f"Bearer {args.api_key}"
+    if priority_class == args.batch_class and args.batch_route == "embeddings":
+        url = f"{args.base_url}/v1/embeddings"
+        data = {"model": args.model_id, "input": ["benchmark " * args.batch_input_words] * args.batch_size}
+    elif priority_class == args.batch_class:
+        url = f"{args.base_url}/v1/chat/completions"
+        data = {
+            "model": args.model_id,
+            "messages": [{"role": "user", "content": "benchmark " * args.batch_input_words}],
+            "max_tokens": args.batch_max_tokens,
+        }
+    else:
+        url = f"{args.base_url}/v1/chat/completions"
+        data = {
+            "model": args.model_id,
+            "messages": [{"role": "user", "content": "Tell me a short joke."}],
+            "max_tokens": args.interactive_max_tokens,
+            "stream": True,
+        }
+    return url, headers, json.dumps(data)
+
+
+async def user_loop(args, session, priority_class, metrics, deadline):
+    while time.time() < deadline:
+        url, headers, data = make_request(args, priority_class)
+        start = time.time()
+        try:
+            async with session.post(url, headers=headers, data=data) as response:
+                metrics.status[priority_class][response.status] += 1
+                first = True
+                async for _ in response.content.iter_any():
+                    if first:
+                        first = False
+                        metrics.head_latencies[priority_class].append(time.time() - start)
+                if response.status == 200:
+                    metrics.latencies[priority_class].append(time.time() - start)
+                else:
+                    await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+        except Exception as e:
+            metrics.status[priority_class][type(e).__name__] += 1
+        if priority_class == args.interactive_class:
+            # think time of the interactive users
+            await asyncio.sleep(random.uniform(0, 2 * args.think_time))
+
+
+async def run_endpoint(args):
+    import aiohttp
+
+    metrics = ClassMetrics()
+    deadline = time.time() + args.session_time
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar()) as session:
+        users = [
+            user_loop(args, session, args.interactive_class, metrics, deadline)
+            for _ in range(args.interactive_users)
+        ] + [
+            user_loop(args, session, args.batch_class, metrics, deadline)
+            for _ in range(args.batch_users)
+        ]
+        await asyncio.gather(*users)
+    metrics.report(f"{args.interactive_users} interactive users, {args.batch_users} batch users")
+
+
+async def simulate_session(args, priority_classes, default_priority_class):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipeline"))
+    from utils.admission_controller import AdmissionController, AdmissionRejectedError
+
+    controller = AdmissionController(
+        max_concurrency=args.max_concurrency,
+        max_queue_size=args.max_queue_size,
+        queue_timeout=None,
+        priority_classes=priority_classes,
+        default_priority_class=default_priority_class,
+    )
+    metrics = ClassMetrics()
+    deadline = time.time() + args.session_time
+
+    async def simulated_user(priority_class, service_time):
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                ticket = await controller.acquire(priority_class=priority_class)
+            except AdmissionRejectedError as e:
+                metrics.status[priority_class][e.status_code] += 1
+                await asyncio.sleep(e.retry_after)
+                continue
+            metrics.head_latencies[priority_class].append(time.time() - start)
+            # the engine time grows with the number of sequences batched
+            await asyncio.sleep(service_time * (1 + controller.in_flight / args.max_concurrency))
+            ticket.release()
+            metrics.latencies[priority_class].append(time.time() - start)
+            metrics.status[priority_class][200] += 1
+            if priority_class == args.interactive_class:
+                await asyncio.sleep(random.uniform(0, 2 * args.think_time))
+
+    await asyncio.gather(*(
+        [simulated_user(args.interactive_class, args.interactive_service_time) for _ in range(args.interactive_users)] +
+        [simulated_user(args.batch_class, args.batch_service_time) for _ in range(args.batch_users)]
+    ))
+    return metrics
+
+
+async def run_simulation(args):
+    # every request in one FIFO queue, as without priority classes
+    fifo = await simulate_session(args, None, "default")
+    fifo.report("FIFO")
+    wfq = await simulate_session(
+        args,
+        {
+            args.interactive_class: {"weight": args.interactive_weight},
+            args.batch_class: {"weight": args.batch_weight},
+        },
+        args.batch_class,
+    )
+    wfq.report(
+        f"Weighted fair queuing, {args.interactive_class}:{args.interactive_weight} "
+        f"{args.batch_class}:{args.batch_weight}"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base_url", type=str, default=os.environ.get("BASE_URL", "http://localhost:8080"))
+    parser.add_argument("--model_id", type=str, default=os.environ.get("MODEL_ID", "Qwen2.5-7B-Instruct"))
+    parser.add_argument("--api_key", type=str, default=None)
+    parser.add_argument("--priority_header", type=str, default="X-Priority-Class")
+    parser.add_argument("--session_time", type=float, default=120)
+    parser.add_argument("--interactive_class", type=str, default="interactive")
+    parser.add_argument("--interactive_users", type=int, default=8)
+    parser.add_argument("--interactive_max_tokens", type=int, default=128)
+    parser.add_argument("--think_time", type=float, default=1)
+    parser.add_argument("--batch_class", type=str, default="batch")
+    parser.add_argument("--batch_users", type=int, default=32)
+    parser.add_argument("--batch_route", type=str, default="embeddings", choices=["embeddings", "chat"])
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--batch_input_words", type=int, default=256)
+    parser.add_argument("--batch_max_tokens", type=int, default=1024)
+    parser.add_argument("--simulate", action="store_true")
+    parser.add_argument("--max_concurrency", type=int, default=8)
+    parser.add_argument("--max_queue_size", type=int, default=256)
+    parser.add_argument("--interactive_service_time", type=float, default=0.2)
+    parser.add_argument("--batch_service_time", type=float, default=1.0)
+    parser.add_argument("--interactive_weight", type=float, default=8)
+    parser.add_argument("--batch_weight", type=float, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.simulate:
+        asyncio.run(run_simulation(args))
+    else:
+        asyncio.run(run_endpoint(args))
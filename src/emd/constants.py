@@ -31,3 +31,8 @@ LOCAL_DEPLOY_PIPELINE_ZIP_DIR = os.path.join(
     os.path.expanduser("~"),
     ".emd-local"
 )
+
+EMD_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"),
+    ".emd-cache"
+)
@@ -9,10 +9,23 @@ class OpenAICompitableEngine(Engine):
     default_cli_args: str = ""
     custom_gpu_num: Union[int,None] = None
     custom_neuron_core_num: Union[int,None] = None
+    # forward the sse bytes of the engine server as is, instead of re-serializing every chunk
+    # through the openai client (opt-in, only for engine servers whose stream needs no transform)
+    raw_stream_proxy: bool = False
+    # return the json bytes of the engine server as is, instead of parsing them with the openai client
+    # (opt-in, only for engine servers whose responses need no transform)
+    raw_response_proxy: bool = False
+    # max concurrent sequences of the engine server (e.g. --max_num_seqs of vllm), sizes the connection
+    # pool of the engine server and the admission control, 128 with a warning when not set
+    max_concurrency: Union[int,None] = None
+    # seconds to wait for the response, or the next stream chunk, of the engine server
+    read_timeout: Union[float,None] = 600
 
 
 class VllmEngine(OpenAICompitableEngine):
-    pass
+    # the openai compatible responses and streams of vllm are forwarded as is
+    raw_stream_proxy: bool = True
+    raw_response_proxy: bool = True
 
 
 # class MultiModelVllmEngine:
@@ -36,14 +49,50 @@ class LlamaCppEngine(OpenAICompitableEngine):
 class OllamaEngine(OpenAICompitableEngine):
     pass
 
-class HuggingFaceWhisperEngine(Engine):
-    pass
-
-class HuggingFaceLLMEngine(Engine):
+class InProcessEngine(Engine):
+    # bounded executor of the in-process backends, one worker per device by default
+    inference_max_workers: Union[int,None] = None
+    inference_max_queue_size: int = 64
+
+class HuggingFaceWhisperEngine(InProcessEngine):
+    # loaded whisper models stay resident, the least recently used one is evicted first
+    max_cached_models: int = 2
+    min_free_gpu_memory_ratio: float = 0.2
+    # audios longer than `long_audio_min_duration` seconds are cut at silences into chunks
+    # transcribed in batches, across one worker process per gpu on multi-gpu instances (opt-in,
+    # the chunks are decoded without word timestamps, temperature fallback or previous text)
+    long_audio_min_duration: Union[float,None] = None
+    long_audio_chunk_duration: float = 30
+    long_audio_batch_size: int = 16
+    long_audio_num_workers: Union[int,None] = None
+    # s3 inputs up to `s3_stream_max_size` bytes are decoded from ranged reads piped into ffmpeg,
+    # larger ones and mp4 like containers (ffmpeg needs to seek to their index) are downloaded
+    # to a temporary file
+    s3_stream_max_size: Union[int,None] = 2 * 1024 ** 3
+    s3_stream_part_size: int = 8 * 1024 ** 2
+
+class HuggingFaceEngine(InProcessEngine):
     pretrained_model_init_kwargs: Union[dict,None] = None
     pretrained_tokenizer_init_kwargs: Union[dict,None] = None
 
-class ComfyuiEngine(Engine):
+class HuggingFaceLLMEngine(HuggingFaceEngine):
+    # iteration level batching of concurrent generations, used by the causal lm backend (opt-in,
+    # it needs a model accepting `position_ids` with a legacy tuple compatible kv cache)
+    continuous_batching: bool = False
+    max_num_seqs: int = 8
+
+class HuggingFaceEmbeddingEngine(HuggingFaceEngine):
+    # micro batching of concurrent requests, set max_batch_size to 0 to disable it
+    max_batch_size: int = 32
+    max_batch_wait_ms: float = 5
+    # input length (in characters) boundaries, a batch never mixes inputs from different buckets
+    batch_length_buckets: Union[list,None] = [128, 512, 2048]
+
+class HuggingFaceRerankEngine(HuggingFaceEngine):
+    # number of [query, document] pairs scored per forward pass, pairs are sorted by length first
+    rerank_batch_size: int = 32
+
+class ComfyuiEngine(InProcessEngine):
     pass
 
 class KtransformersEngine(OpenAICompitableEngine):
@@ -520,7 +569,7 @@ huggingface_baichuan_engine_4d41d2 = HuggingFaceLLMEngine(**{
             "pretrained_tokenizer_init_kwargs":{"trust_remote_code":True}
 })
 
-huggingface_embedding_engine449 = HuggingFaceLLMEngine(**{
+huggingface_embedding_engine449 = HuggingFaceEmbeddingEngine(**{
             "engine_type":EngineType.HUGGINGFACE,
             "engine_cls":"huggingface.embedding.transformers_embedding_backend.TransformerEmbeddingBackend",
             "python_name":"python3",
@@ -531,7 +580,7 @@ huggingface_embedding_engine449 = HuggingFaceLLMEngine(**{
             "pretrained_model_init_kwargs":{"trust_remote_code":True,"torch_dtype":"float16"},
 })
 
-huggingface_rerank_engine449 = HuggingFaceLLMEngine(**{
+huggingface_rerank_engine449 = HuggingFaceRerankEngine(**{
             "engine_type":EngineType.HUGGINGFACE,
             "engine_cls":"huggingface.rerank.transformers_rerank_backend.TransformerRerankBackend",
             "python_name":"python3",
@@ -1,11 +1,30 @@
 from . import Framework
 from .utils.constants import FrameworkType
+from typing import Union
 
 
 class FastAPIFramework(Framework):
     limit_concurrency: int = 1000
     timeout_keep_alive: int = 300
     uvicorn_log_level: str = "info"
+    # opt-in, requests beyond the engine batch capacity wait in a bounded queue of the server
+    admission_control: bool = False
+    # defaults to the engine batch capacity, the `max_concurrency` of the engine
+    admission_max_concurrency: Union[int,None] = None
+    # defaults to 4 times the admission concurrency
+    admission_max_queue_size: Union[int,None] = None
+    # seconds a request may wait for admission, below the 60s sagemaker invocation timeout
+    admission_queue_timeout: Union[float,None] = 30
+    # weighted fair queuing of the admissions across priority classes and tenants (api keys),
+    # e.g. {"interactive": {"weight": 8}, "batch": {"weight": 1, "queue_timeout": 300}}
+    admission_priority_classes: Union[dict,None] = None
+    admission_default_priority_class: str = "default"
+    # e.g. {"<bulk api key>": {"weight": 2, "priority_class": "batch"},
+    #       "<chat api key>": {"allowed_priority_classes": ["interactive"]}}
+    admission_tenants: Union[dict,None] = None
+    # request header choosing the priority class, also read from the sagemaker custom attributes,
+    # classes weighted above the default one are only granted to the tenants allowed them
+    admission_priority_header: str = "X-Priority-Class"
 
 
 
@@ -0,0 +1,319 @@
+import heapq
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import Future, InvalidStateError
+from typing import Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+from emd.utils.logger_utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class _PendingResult:
+    def __init__(
+            self,
+            output_path: str,
+            failure_path: Optional[str],
+            inference_id: Optional[str],
+            timeout: Optional[float],
+            delay: float
+        ):
+        self.future = Future()
+        self.output_path = output_path
+        self.failure_path = failure_path
+        self.inference_id = inference_id
+        self.timeout = timeout
+        self.deadline = time.time() + timeout if timeout else None
+        self.delay = delay
+        self.next_check = time.time() + delay
+
+    def __lt__(self, other: "_PendingResult"):
+        return self.next_check < other.next_check
+
+
+class AsyncResultWatcher:
+    """
+    One shared watcher resolving the futures of async inference results.
+
+    When the async endpoint publishes completion notifications (`NotificationConfig` of the
+    endpoint config), the watcher subscribes a private SQS queue to the success and error SNS
+    topics and a single thread long-polls the queue and dispatches every notification to the
+    waiting future. Results are always also checked on S3 by a single polling thread with a per
+    result exponential backoff from `poll_initial_delay` to `poll_max_delay` seconds, this is the
+    only source of results when no notification topic is configured and a safety net for missed
+    notifications otherwise (the backoff then starts at `poll_max_delay`).
+    """
+
+    def __init__(
+        self,
+        sagemaker_client,
+        success_topic: Optional[str] = None,
+        error_topic: Optional[str] = None,
+        queue_url: Optional[str] = None,
+        poll_initial_delay: float = 0.5,
+        poll_max_delay: float = 30,
+    ):
+        self.sagemaker_client = sagemaker_client
+        self.s3_client = sagemaker_client.s3_client
+        self.topics = [topic for topic in (success_topic, error_topic) if topic]
+        self.queue_url = queue_url
+        self.poll_initial_delay = poll_initial_delay
+        self.poll_max_delay = poll_max_delay
+        self._owns_queue = False
+        self._subscriptions = []
+        self._pending: Dict[str, _PendingResult] = {}
+        self._failure_paths: Dict[str, str] = {}
+        self._inference_ids: Dict[str, str] = {}
+        self._poll_heap: List[_PendingResult] = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._sqs_client = None
+
+        if self.topics or self.queue_url:
+            self._start_notification_listener()
+        threading.Thread(target=self._poll_loop, daemon=True, name="async-result-poller").start()
+
+    @property
+    def notification_enabled(self) -> bool:
+        return self._sqs_client is not None
+
+    # ---------------- notifications ----------------
+    def _start_notification_listener(self):
+        boto_session = self.sagemaker_client._get_boto_session()
+        region_name = self.sagemaker_client.client.meta.region_name
+        sqs_client = boto_session.client("sqs", region_name=region_name)
+        if self.queue_url is None:
+            self.queue_url = self._create_subscribed_queue(sqs_client, boto_session.client("sns", region_name=region_name))
+        self._sqs_client = sqs_client
+        threading.Thread(target=self._notification_loop, daemon=True, name="async-result-listener").start()
+        logger.info(f"listening async inference notifications on: {self.queue_url}")
+
+    def _create_subscribed_queue(self, sqs_client, sns_client) -> str:
+        queue_url = sqs_client.create_queue(
+            QueueName=f"emd-async-results-{uuid.uuid4().hex[:16]}",
+            Attributes={"MessageRetentionPeriod": "3600"}
+        )["QueueUrl"]
+        self._owns_queue = True
+        queue_arn = sqs_client.get_queue_attributes(
+            QueueUrl=queue_url, AttributeNames=["QueueArn"]
+        )["Attributes"]["QueueArn"]
+        policy = {
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Principal": {"Service": "sns.amazonaws.com"},
+                "Action": "sqs:SendMessage",
+                "Resource": queue_arn,
+                "Condition": {"ArnEquals": {"aws:SourceArn": self.topics}}
+            }]
+        }
+        sqs_client.set_queue_attributes(QueueUrl=queue_url, Attributes={"Policy": json.dumps(policy)})
+        for topic in self.topics:
+            subscription = sns_client.subscribe(
+                TopicArn=topic,
+                Protocol="sqs",
+                Endpoint=queue_arn,
+                Attributes={"RawMessageDelivery": "true"},
+                ReturnSubscriptionArn=True
+            )
+            self._subscriptions.append((sns_client, subscription["SubscriptionArn"]))
+        return queue_url
+
+    @staticmethod
+    def _parse_notification(body: str) -> dict:
+        message = json.loads(body)
+        if message.get("Type") == "Notification" and "Message" in message:
+            # not a raw message delivery, unwrap the sns envelope
+            message = json.loads(message["Message"])
+        return message
+
+    def _dispatch_notification(self, message: dict):
+        response_parameters = message.get("responseParameters") or {}
+        output_location = response_parameters.get("outputLocation")
+        failure_location = response_parameters.get("failureLocation")
+        with self._cond:
+            # error notifications may carry no location, only the inference id
+            output_path = output_location if output_location in self._pending \
+                else self._failure_paths.get(failure_location) \
+                or self._inference_ids.get(message.get("inferenceId"))
+            pending = self._pending.get(output_path)
+        if pending is None:
+            # a request of another client of the same endpoint
+            return
+        if message.get("invocationStatus") == "Completed":
+            self._resolve(pending, output_found=True)
+        elif failure_location:
+            self._resolve(pending, output_found=False)
+        else:
+            from .sagemaker_client import AsyncInferenceModelError
+            self._finish(pending, exception=AsyncInferenceModelError(
+                message=message.get("failureReason") or message.get("invocationStatus")
+            ))
+
+    def _notification_loop(self):
+        while not self._closed:
+            try:
+                response = self._sqs_client.receive_message(
+                    QueueUrl=self.queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=20
+                )
+            except Exception as e:
+                logger.warning(f"Failed to receive async inference notifications: {e}")
+                time.sleep(self.poll_initial_delay)
+                continue
+            messages = response.get("Messages") or []
+            for message in messages:
+                try:
+                    self._dispatch_notification(self._parse_notification(message["Body"]))
+                except Exception as e:
+                    logger.warning(f"Failed to handle async inference notification: {e}")
+            if not messages:
+                continue
+            try:
+                self._sqs_client.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]}
+                        for i, message in enumerate(messages)
+                    ]
+                )
+            except Exception as e:
+                # the messages are received again, their results are already resolved
+                logger.warning(f"Failed to delete async inference notifications: {e}")
+
+    # ---------------- s3 polling ----------------
+    def _object_exists(self, s3_path: str) -> bool:
+        from .sagemaker_client import parse_s3_url
+        bucket, key = parse_s3_url(s3_path)
+        try:
+            self.s3_client.head_object(Bucket=bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def _check(self, pending: _PendingResult):
+        if self._object_exists(pending.output_path):
+            self._resolve(pending, output_found=True)
+        elif pending.failure_path and self._object_exists(pending.failure_path):
+            self._resolve(pending, output_found=False)
+
+    def _poll_loop(self):
+        from .sagemaker_client import PollingTimeoutError
+        while not self._closed:
+            with self._cond:
+                while not self._closed and (
+                    not self._poll_heap or self._poll_heap[0].next_check > time.time()
+                ):
+                    timeout = self._poll_heap[0].next_check - time.time() if self._poll_heap else None
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                pending = heapq.heappop(self._poll_heap)
+            if pending.future.done():
+                continue
+            try:
+                self._check(pending)
+            except Exception as e:
+                self._finish(pending, exception=e)
+                continue
+            if pending.future.done():
+                continue
+            if pending.deadline is not None and time.time() >= pending.deadline:
+                self._finish(pending, exception=PollingTimeoutError(
+                    message="Inference could still be running",
+                    output_path=pending.output_path,
+                    seconds=pending.timeout,
+                ))
+                continue
+            pending.delay = min(pending.delay * 2, self.poll_max_delay)
+            pending.next_check = time.time() + pending.delay
+            if pending.deadline is not None:
+                pending.next_check = min(pending.next_check, pending.deadline)
+            with self._cond:
+                heapq.heappush(self._poll_heap, pending)
+
+    # ---------------- futures ----------------
+    def _forget(self, pending: _PendingResult):
+        with self._cond:
+            if self._pending.get(pending.output_path) is pending:
+                self._pending.pop(pending.output_path)
+            self._failure_paths.pop(pending.failure_path, None)
+            self._inference_ids.pop(pending.inference_id, None)
+
+    def _finish(self, pending: _PendingResult, result=None, exception: Exception = None):
+        self._forget(pending)
+        if pending.future.done():
+            return
+        try:
+            if exception is not None:
+                pending.future.set_exception(exception)
+            else:
+                pending.future.set_result(result)
+        except InvalidStateError:
+            # cancelled by the caller meanwhile
+            pass
+
+    def _resolve(self, pending: _PendingResult, output_found: bool):
+        from .sagemaker_client import AsyncInferenceModelError, parse_s3_url
+        try:
+            if output_found:
+                bucket, key = parse_s3_url(pending.output_path)
+                s3_object = self.s3_client.get_object(Bucket=bucket, Key=key)
+                self._finish(pending, result=self.sagemaker_client._handle_response(response=s3_object))
+            else:
+                bucket, key = parse_s3_url(pending.failure_path)
+                failure_object = self.s3_client.get_object(Bucket=bucket, Key=key)
+                failure_response = self.sagemaker_client._handle_response(response=failure_object)
+                self._finish(pending, exception=AsyncInferenceModelError(message=failure_response))
+        except Exception as e:
+            self._finish(pending, exception=e)
+
+    def watch(
+            self,
+            output_path: str,
+            failure_path: Optional[str] = None,
+            inference_id: Optional[str] = None,
+            timeout: Optional[float] = None
+        ) -> Future:
+        """
+        Return a future of the async inference result at `output_path`, failing after `timeout` seconds.
+        Cancelling the future stops watching the result.
+        """
+        delay = self.poll_max_delay if self.notification_enabled else self.poll_initial_delay
+        if timeout:
+            delay = min(delay, timeout)
+        pending = _PendingResult(output_path, failure_path, inference_id, timeout, delay)
+        with self._cond:
+            self._pending[output_path] = pending
+            if failure_path:
+                self._failure_paths[failure_path] = output_path
+            if inference_id:
+                self._inference_ids[inference_id] = output_path
+            heapq.heappush(self._poll_heap, pending)
+            self._cond.notify()
+        # the poller drops the cancelled results it pops
+        pending.future.add_done_callback(lambda future: self._forget(pending) if future.cancelled() else None)
+        return pending.future
+
+    def close(self):
+        """Stop the watcher, remove the subscriptions and the queue created by it."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for sns_client, subscription_arn in self._subscriptions:
+            try:
+                sns_client.unsubscribe(SubscriptionArn=subscription_arn)
+            except Exception as e:
+                logger.warning(f"Failed to unsubscribe {subscription_arn}: {e}")
+        self._subscriptions = []
+        if self._owns_queue:
+            try:
+                self._sqs_client.delete_queue(QueueUrl=self.queue_url)
+            except Exception as e:
+                logger.warning(f"Failed to delete queue {self.queue_url}: {e}")
+            self._owns_queue = False
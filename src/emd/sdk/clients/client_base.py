@@ -1,6 +1,30 @@
-from pydantic import BaseModel,Field
-from typing import Optional
+from pydantic import BaseModel,Field,PrivateAttr
+from typing import Optional,Any,AsyncIterator
 import os
+import json
+import base64
+import asyncio
+
+from .serializers import JSONSerializer
+from .response_cache import is_deterministic_request,request_cache_key
+from emd.utils.logger_utils import get_logger
+
+logger = get_logger(__name__)
+
+# little-endian dtypes of the base64/binary embedding encodings
+EMBEDDING_DTYPES = {
+    "float32": "<f4",
+    "float16": "<f2"
+}
+
+
+class EndpointHTTPError(RuntimeError):
+    """Non 200 response of an endpoint."""
+
+    def __init__(self, status_code:int, message:str):
+        super().__init__(f"Error {status_code}, {message}")
+        self.status_code = status_code
+
 
 class ClientBase(BaseModel):
     model_id: Optional[str] = None
@@ -12,14 +36,187 @@ class ClientBase(BaseModel):
     model_stack_name: Optional[str] = None
     """The name of the model stack deployed by emd."""
 
+    max_concurrency: int = 64
+    """Max number of in-flight `ainvoke`/`astream` requests of this client."""
+
+    serializer: Any = Field(default_factory=JSONSerializer)
+    """Serializer of the request bodies, see `JSONSerializer`."""
+
+    response_cache: Any = None
+    """Opt-in `ResponseCache` of the responses of deterministic requests
+    (embeddings, rerank and completions with `temperature=0`)."""
+
+    _semaphore: Any = PrivateAttr(default=None)
+    _semaphore_loop: Any = PrivateAttr(default=None)
+    _async_http_client: Any = PrivateAttr(default=None)
+    _async_http_client_loop: Any = PrivateAttr(default=None)
+
     class Config:
         """Configuration for this pydantic object."""
         extra = "allow"
 
 
+    def _stack_resolution_kwargs(self) -> dict:
+        """Profile and region the model stack of the client is resolved with."""
+        return {}
+
+    def _invalidate_endpoint_resolution(self):
+        """The endpoint resolved from the model stack is gone, e.g. the model was destroyed or redeployed."""
+        if self.model_stack_name:
+            from emd.utils.stack_resolution_cache import invalidate_model_stack_info
+            invalidate_model_stack_info(self.model_stack_name, **self._stack_resolution_kwargs())
+
+    def _cache_endpoint(self) -> str:
+        """Identity of the endpoint in the response cache keys."""
+        raise NotImplementedError
+
+    def _cache_model_type(self) -> Optional[str]:
+        """Type of the deployed model, only known for clients created with a `model_id`."""
+        if not self.model_id:
+            return None
+        from emd.models import Model
+        try:
+            return Model.get_model(self.model_id).model_type
+        except KeyError:
+            return None
+
+    def _response_cache_key(self, pyload:dict):
+        if self.response_cache is None:
+            return None
+        request = {**(getattr(self, "model_kwargs", None) or {}), **pyload}
+        if not is_deterministic_request(request, self._cache_model_type()):
+            return None
+        return request_cache_key(self._cache_endpoint(), request)
+
     def invoke(self,pyload:dict):
+        cache_key = self._response_cache_key(pyload)
+        if cache_key is not None:
+            response = self.response_cache.get(cache_key)
+            if response is not None:
+                return response
+        response = self._invoke(pyload)
+        if cache_key is not None:
+            self.response_cache.set(cache_key, response)
+        return response
+
+    def _invoke(self,pyload:dict):
         raise NotImplementedError
 
 
     def invoke_async(self, pyload:dict):
         raise NotADirectoryError
+
+    def _log_request(self, pyload:dict):
+        enable_print_messages = os.getenv("ENABLE_PRINT_MESSAGES", 'False').lower() in ('true', '1', 't')
+        if enable_print_messages:
+            logger.info(f"request body: {pyload}")
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # a semaphore is bound to the event loop it is first used in
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    def _create_async_http_client(self):
+        raise NotImplementedError
+
+    @property
+    def async_http_client(self):
+        # pooled connections are bound to the event loop they were opened in, the sync
+        # methods use the sync clients rather than a new event loop per call
+        loop = asyncio.get_running_loop()
+        if self._async_http_client is None or self._async_http_client_loop is not loop:
+            if self._async_http_client is not None:
+                self._close_async_http_client(self._async_http_client, self._async_http_client_loop)
+            self._async_http_client = self._create_async_http_client()
+            self._async_http_client_loop = loop
+        return self._async_http_client
+
+    @staticmethod
+    def _close_async_http_client(client, loop):
+        """Close a client replaced by the one of another event loop, in the loop it belongs to."""
+        if loop.is_closed():
+            # e.g. the loop of a previous `asyncio.run`, its sockets are released with the client
+            logger.debug("The event loop of the replaced async http client is closed")
+            return
+        # runs in the other thread of the loop, or when the loop runs again
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+
+    async def aclose(self):
+        if self._async_http_client is not None:
+            await self._async_http_client.aclose()
+            self._async_http_client = None
+
+    async def ainvoke(self, pyload:dict):
+        """Asyncio version of `invoke`, a streaming pyload returns the async iterator of `astream`."""
+        if pyload.get("stream", False):
+            return self.astream(pyload)
+        cache_key = self._response_cache_key(pyload)
+        if cache_key is not None:
+            response = self.response_cache.get(cache_key)
+            if response is not None:
+                return response
+        async with self._get_semaphore():
+            response = await self._ainvoke(pyload)
+        if cache_key is not None:
+            self.response_cache.set(cache_key, response)
+        return response
+
+    async def astream(self, pyload:dict) -> AsyncIterator[dict]:
+        """Stream the response chunks, the request holds its in-flight slot until the stream is consumed."""
+        async with self._get_semaphore():
+            async for chunk in self._astream({**pyload, "stream": True}):
+                yield chunk
+
+    async def _ainvoke(self, pyload:dict):
+        raise NotImplementedError
+
+    def _astream(self, pyload:dict) -> AsyncIterator[dict]:
+        raise NotImplementedError
+
+    @staticmethod
+    def _parse_content_type(content_type:str):
+        media_type,*params = [p.strip() for p in (content_type or "").split(";")]
+        return media_type, dict(p.split("=",1) for p in params if "=" in p)
+
+    def _decode_binary_embeddings(self, body:bytes, content_type:str):
+        """Decode a raw embedding matrix (`encoding_format: binary`) without going through python lists.
+
+        The embeddings are read-only numpy views of the response buffer.
+        """
+        import numpy as np
+        _, params = self._parse_content_type(content_type)
+        dtype = EMBEDDING_DTYPES[params.get("dtype", "float32")]
+        shape = tuple(int(i) for i in params["shape"].split(","))
+        matrix = np.frombuffer(body, dtype=dtype).reshape(shape)
+        return {
+            "object": "list",
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": embedding
+                }
+                for i, embedding in enumerate(matrix)
+            ],
+            "model": self.model_id
+        }
+
+    def _decode_base64_embeddings(self, response_dict:dict, pyload:dict):
+        """Decode `encoding_format: base64` embeddings into numpy arrays."""
+        if pyload.get("encoding_format") != "base64" or not isinstance(response_dict, dict):
+            return response_dict
+        import numpy as np
+        dtype = EMBEDDING_DTYPES[pyload.get("embedding_dtype", "float32")]
+        for item in response_dict.get("data") or []:
+            if isinstance(item.get("embedding"), str):
+                item["embedding"] = np.frombuffer(base64.b64decode(item["embedding"]), dtype=dtype)
+        return response_dict
+
+    def _decode_response(self, body:bytes, content_type:str, pyload:dict):
+        media_type, _ = self._parse_content_type(content_type)
+        if media_type == "application/octet-stream":
+            return self._decode_binary_embeddings(body, content_type)
+        return self._decode_base64_embeddings(json.loads(body.decode("utf-8")), pyload)
@@ -3,7 +3,7 @@ import os
 from typing import Optional,Dict,Any,Union
 import io
 from urllib.parse import urlparse
-from pydantic import model_validator
+from pydantic import model_validator,PrivateAttr
 import uuid
 import codecs
 import time
@@ -12,74 +12,43 @@ import botocore
 import threading
 from botocore.exceptions import WaiterError
 from botocore.exceptions import ClientError
+import httpx
 
-from .client_base import ClientBase
-from emd.utils.aws_service_utils import check_stack_exists,get_model_stack_info
+from .client_base import ClientBase,EndpointHTTPError
+from emd.utils.stack_resolution_cache import resolve_model_stack_info
 from emd.models import Model
 from emd.constants import MODEL_DEFAULT_TAG
 from emd.utils.logger_utils import get_logger
 from emd.utils.framework_utils import get_model_specific_path
-import requests
+from emd.utils.line_iterator import LineIterator,AsyncLineIterator,iter_frames,aiter_frames
+from .http_utils import create_http_client,send_with_retry,asend_with_retry
 
 
 logger = get_logger(__name__)
 
 
-class LineIterator:
-    """
-    A helper class for parsing the byte stream input.
-
-    The output of the model will be in the following format:
-
-    b'{"outputs": [" a"]}\n'
-    b'{"outputs": [" challenging"]}\n'
-    b'{"outputs": [" problem"]}\n'
-    ...
-
-
-    This class accounts for this by concatenating bytes written via the 'write' function
-    and then exposing a method which will return lines (ending with a '\n' character)
-    within the buffer via the 'scan_lines' function.
-    It maintains the position of the last read position to ensure
-    that previous bytes are not exposed again.
-
-    For more details see:
-    https://aws.amazon.com/blogs/machine-learning/elevating-the-generative-ai-experience-introducing-streaming-support-in-amazon-sagemaker-hosting/
-    """
-
-    def __init__(self, stream: Any) -> None:
-        self.byte_iterator = iter(stream)
-        self.buffer = io.BytesIO()
-        self.read_pos = 0
-
-    def __iter__(self) -> "LineIterator":
-        return self
-
-    def __next__(self) -> Any:
-        while True:
-            self.buffer.seek(self.read_pos)
-            line = self.buffer.readline()
-            if line and line[-1] == ord("\n"):
-                self.read_pos += len(line)
-                return line[:-1]
-            try:
-                chunk = next(self.byte_iterator)
-                # print('chunk: ',chunk)
-            except StopIteration:
-                if self.read_pos < self.buffer.getbuffer().nbytes:
-                    # print('continue condition',self.read_pos,self.buffer.getbuffer().nbytes)
-                    continue
-                raise
-            # if "PayloadPart" not in chunk:
-            #     # Unknown Event Type
-            #     continue
-            self.buffer.seek(0, io.SEEK_END)
-            self.buffer.write(chunk)#["PayloadPart"]["Bytes"])
+class ECSClient(ClientBase):
+    base_url:str = ""
 
+    pool_size: int = 100
+    """Max number of pooled connections to the load balancer."""
 
+    keepalive_expiry: float = 60
+    """Seconds an idle connection is kept alive in the pool."""
 
-class ECSClient(ClientBase):
-    base_url:str = ""
+    connect_timeout: float = 10
+
+    read_timeout: Union[float,None] = 600
+
+    http2: bool = True
+    """Use HTTP/2 when the `h2` package is installed."""
+
+    max_retries: int = 3
+    """Retries with exponential backoff on connection errors and 502/503/504."""
+
+    retry_backoff: float = 0.5
+
+    _http_client: Any = PrivateAttr(default=None)
 
     @model_validator(mode='before')
     def validate_environment(cls, values: Dict) -> Dict:
@@ -98,10 +67,8 @@ class ECSClient(ClientBase):
             )
 
         # get endpoint name from stack
-        if not check_stack_exists(model_stack_name):
-            raise ValueError(f"Model stack {model_stack_name} does not exist")
-
-        stack_info = get_model_stack_info(model_stack_name)
+        stack_info = resolve_model_stack_info(model_stack_name)
+        values["model_stack_name"] = model_stack_name
         Outputs = stack_info.get('Outputs')
         if not Outputs:
             raise RuntimeError(f"Model stack {model_stack_name} does not have any outputs, the model may be not deployed in success")
@@ -113,34 +80,127 @@ class ECSClient(ClientBase):
         assert values.get("base_url") is not None, "base_url  not found in stack outputs"
         return values
 
-    def invoke(self,pyload:dict):
+    def _http_client_kwargs(self):
+        return dict(
+            pool_size=self.pool_size,
+            keepalive_expiry=self.keepalive_expiry,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            http2=self.http2
+        )
+
+    @property
+    def http_client(self):
+        if self._http_client is None:
+            self._http_client = create_http_client(**self._http_client_kwargs())
+        return self._http_client
+
+    def _create_async_http_client(self):
+        return create_http_client(asynchronous=True, **self._http_client_kwargs())
+
+    def close(self):
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+
+    async def aclose(self):
+        self.close()
+        await super().aclose()
+
+    def _build_request(self, http_client, pyload:dict):
+        self._log_request(pyload)
+        body, content_encoding = self.serializer.encode(pyload)
+        headers = {"Content-Type": self.serializer.content_type}
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        return http_client.build_request(
+            "POST", f"{self.base_url}/invocations", content=body, headers=headers
+        )
+
+    async def _asend(self, pyload:dict, stream:bool):
+        request = self._build_request(self.async_http_client, pyload)
+        try:
+            return await asend_with_retry(
+                self.async_http_client,
+                request,
+                stream=stream,
+                max_retries=self.max_retries,
+                retry_backoff=self.retry_backoff
+            )
+        except httpx.ConnectError:
+            # e.g. the load balancer of the resolved stack was deleted
+            self._invalidate_endpoint_resolution()
+            raise
+
+    async def _ainvoke(self, pyload:dict):
+        response = await self._asend(pyload, stream=False)
+        if response.status_code != 200:
+            raise EndpointHTTPError(response.status_code, response.text)
+        return self._decode_response(
+            response.content,
+            response.headers.get("Content-Type", "application/json"),
+            pyload
+        )
+
+    async def _astream(self, pyload:dict):
+        response = await self._asend(pyload, stream=True)
+        try:
+            if response.status_code != 200:
+                await response.aread()
+                raise EndpointHTTPError(response.status_code, response.text)
+            async for frame in aiter_frames(AsyncLineIterator(response.aiter_bytes())):
+                try:
+                    chunk_dict = json.loads(frame)
+                except Exception as e:
+                    logger.warning(f"Skipping undecodable stream frame: {e}")
+                    continue
+                if chunk_dict:
+                    yield chunk_dict
+        finally:
+            await response.aclose()
+
+    def _cache_endpoint(self) -> str:
+        return f"ecs:{self.base_url}"
+
+    def _invoke(self,pyload:dict):
         stream = pyload.get('stream', False)
-        url = f"{self.base_url}/invocations"
-        if stream:
-            response = requests.post(
-                url,
-                json=pyload,
-                stream=True
+        request = self._build_request(self.http_client, pyload)
+        try:
+            response = send_with_retry(
+                self.http_client,
+                request,
+                stream=stream,
+                max_retries=self.max_retries,
+                retry_backoff=self.retry_backoff
             )
+        except httpx.ConnectError:
+            self._invalidate_endpoint_resolution()
+            raise
+        if stream:
             if response.status_code != 200:
-                raise RuntimeError(f"Error {response.status_code}, {response.text}")
+                response.read()
+                response.close()
+                raise EndpointHTTPError(response.status_code, response.text)
             def _ret_iterator_helper():
-                interator = LineIterator(response)
-                for line in interator:
-                    try:
-                        decoded_line = line.decode('utf-8').strip()
-                        if decoded_line.startswith('data: '):
-                            json_data = decoded_line[len('data: '):]
-                            chunk_dict = json.loads(json_data)
-                            if not chunk_dict:
-                                continue
+                try:
+                    for frame in iter_frames(LineIterator(response.iter_bytes())):
+                        try:
+                            chunk_dict = json.loads(frame)
+                        except Exception as e:
+                            logger.warning(f"Skipping undecodable stream frame: {e}")
+                            continue
+                        if chunk_dict:
                             yield chunk_dict
-                    except Exception as e:
-                        print(e)
+                finally:
+                    # give the connection back to the pool
+                    response.close()
 
             return _ret_iterator_helper()
         else:
-            return requests.post(
-                url,
-                json=pyload
-            ).json()
+            if response.status_code != 200:
+                raise EndpointHTTPError(response.status_code, response.text)
+            return self._decode_response(
+                response.content,
+                response.headers.get("Content-Type", "application/json"),
+                pyload
+            )
@@ -0,0 +1,102 @@
+import asyncio
+import importlib.util
+import random
+import time
+from typing import Union
+
+import httpx
+
+from emd.utils.logger_utils import get_logger
+
+logger = get_logger(__name__)
+
+# gateway errors of the load balancer are safe to retry, the request did not reach the model
+RETRY_STATUS_CODES = (502, 503, 504)
+RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+def create_http_client(
+        pool_size: int = 100,
+        keepalive_expiry: float = 60,
+        connect_timeout: float = 10,
+        read_timeout: Union[float, None] = 600,
+        http2: bool = True,
+        asynchronous: bool = False,
+        **kwargs
+    ) -> Union[httpx.Client, httpx.AsyncClient]:
+    """Create a pooled keep-alive http client, HTTP/2 is used when the `h2` package is installed."""
+    client_cls = httpx.AsyncClient if asynchronous else httpx.Client
+    return client_cls(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry
+        ),
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        http2=http2 and http2_available(),
+        **kwargs
+    )
+
+
+def get_retry_delay(attempt: int, retry_backoff: float, response: httpx.Response = None) -> float:
+    """Exponential backoff with jitter, `Retry-After` of the response takes precedence."""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return retry_backoff * (2 ** attempt) * (0.5 + random.random())
+
+
+def send_with_retry(
+        client: httpx.Client,
+        request: httpx.Request,
+        stream: bool = False,
+        max_retries: int = 3,
+        retry_backoff: float = 0.5
+    ) -> httpx.Response:
+    for attempt in range(max_retries + 1):
+        try:
+            response = client.send(request, stream=stream)
+        except RETRY_EXCEPTIONS as e:
+            if attempt >= max_retries:
+                raise
+            delay = get_retry_delay(attempt, retry_backoff)
+            logger.warning(f"{request.method} {request.url} failed: {e!r}, retry in {delay:.2f}s")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                return response
+            delay = get_retry_delay(attempt, retry_backoff, response)
+            response.close()
+            logger.warning(f"{request.method} {request.url} returned {response.status_code}, retry in {delay:.2f}s")
+        time.sleep(delay)
+
+
+async def asend_with_retry(
+        client: httpx.AsyncClient,
+        request: httpx.Request,
+        stream: bool = False,
+        max_retries: int = 3,
+        retry_backoff: float = 0.5
+    ) -> httpx.Response:
+    for attempt in range(max_retries + 1):
+        try:
+            response = await client.send(request, stream=stream)
+        except RETRY_EXCEPTIONS as e:
+            if attempt >= max_retries:
+                raise
+            delay = get_retry_delay(attempt, retry_backoff)
+            logger.warning(f"{request.method} {request.url} failed: {e!r}, retry in {delay:.2f}s")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                return response
+            delay = get_retry_delay(attempt, retry_backoff, response)
+            await response.aclose()
+            logger.warning(f"{request.method} {request.url} returned {response.status_code}, retry in {delay:.2f}s")
+        await asyncio.sleep(delay)
@@ -2,6 +2,7 @@ from typing import (
     Union,
     cast,
     Any,
+    AsyncIterator,
     Callable,
     Dict,
     Iterator,
@@ -18,6 +19,7 @@ import sys
 import json
 from operator import itemgetter
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 from langchain_core.callbacks import (
@@ -266,6 +268,9 @@ class SageMakerVllmModelBase(BaseModel):
     s3_client: Any = None
     """Boto3 client for s3"""
 
+    response_cache: Any = None
+    """Opt-in `ResponseCache` of the sagemaker client, see `ClientBase.response_cache`."""
+
     class Config:
         """Configuration for this pydantic object."""
         extra = "allow"
@@ -286,6 +291,7 @@ class SageMakerVllmModelBase(BaseModel):
                 model_id=values.get("model_id"),
                 model_tag=values.get("model_tag"),
                 model_stack_name=values.get("model_stack_name"),
+                response_cache=values.get("response_cache"),
             )
         return values
 
@@ -337,6 +343,24 @@ class SageMakerVllmChatModelBase(SageMakerVllmModelBase,BaseChatModel):
         input_body = self.prepare_input_body(_model_kwargs,messages)
         input_body['stream'] = False
         response_dict = self.sagemaker_client.invoke(input_body)
+        return self._create_chat_result(response_dict)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """Native asyncio version of `_generate`, no executor thread per call."""
+        _model_kwargs = self.model_kwargs or {}
+        _model_kwargs = {**_model_kwargs, **kwargs}
+        input_body = self.prepare_input_body(_model_kwargs,messages)
+        input_body['stream'] = False
+        response_dict = await self.sagemaker_client.ainvoke(input_body)
+        return self._create_chat_result(response_dict)
+
+    def _create_chat_result(self, response_dict: dict) -> ChatResult:
         generations = []
         generation_info = None
         token_usage = response_dict.get("usage")
@@ -377,30 +401,54 @@ class SageMakerVllmChatModelBase(SageMakerVllmModelBase,BaseChatModel):
         iterator = self.sagemaker_client.invoke(input_body)
 
         for chunk_dict in iterator:
-            if not chunk_dict:
+            cg_chunk = self._convert_chunk_to_generation_chunk(chunk_dict)
+            if cg_chunk is None:
                 continue
-            if len(chunk_dict["choices"]) == 0:
-                continue
-            choice = chunk_dict["choices"][0]
-            if choice["delta"] is None:
-                continue
-
-            default_chunk_class = AIMessageChunk
-            chunk = _convert_delta_to_message_chunk(
-                choice["delta"], default_chunk_class
-            )
-            finish_reason = choice.get("finish_reason")
-            generation_info = (
-                dict(finish_reason=finish_reason) if finish_reason is not None else None
-            )
-            default_chunk_class = chunk.__class__
-            cg_chunk = ChatGenerationChunk(
-                message=chunk, generation_info=generation_info
-            )
             if run_manager:
                 run_manager.on_llm_new_token(cg_chunk.text, chunk=cg_chunk)
             yield cg_chunk
 
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        """Stream the output of the model on the event loop, chunks are yielded as the bytes arrive.
+        """
+        _model_kwargs = self.model_kwargs or {}
+        _model_kwargs = {**_model_kwargs, **kwargs}
+        input_body = self.prepare_input_body(_model_kwargs,messages)
+        async for chunk_dict in self.sagemaker_client.astream(input_body):
+            cg_chunk = self._convert_chunk_to_generation_chunk(chunk_dict)
+            if cg_chunk is None:
+                continue
+            if run_manager:
+                await run_manager.on_llm_new_token(cg_chunk.text, chunk=cg_chunk)
+            yield cg_chunk
+
+    def _convert_chunk_to_generation_chunk(self, chunk_dict: dict) -> Optional[ChatGenerationChunk]:
+        if not chunk_dict:
+            return None
+        if len(chunk_dict["choices"]) == 0:
+            return None
+        choice = chunk_dict["choices"][0]
+        if choice["delta"] is None:
+            return None
+
+        default_chunk_class = AIMessageChunk
+        chunk = _convert_delta_to_message_chunk(
+            choice["delta"], default_chunk_class
+        )
+        finish_reason = choice.get("finish_reason")
+        generation_info = (
+            dict(finish_reason=finish_reason) if finish_reason is not None else None
+        )
+        return ChatGenerationChunk(
+            message=chunk, generation_info=generation_info
+        )
+
 
     @property
     def _llm_type(self) -> str:
@@ -571,6 +619,15 @@ class SageMakerVllmChatModel(SageMakerVllmChatModelBase):
 class SageMakerVllmEmbeddings(SageMakerVllmModelBase,Embeddings):
     normalize: bool = False
 
+    batch_size: int = 32
+    """Max number of texts packed into one embedding request."""
+
+    max_batch_tokens: Optional[int] = None
+    """Max estimated tokens (characters / 4) of one embedding request, no limit by default."""
+
+    max_concurrency: int = 8
+    """Max number of in-flight embedding requests of `embed_documents`."""
+
     def _embedding_func(self, text: str) -> List[float]:
         """Call out to SageMaker embedding endpoint."""
 
@@ -593,26 +650,87 @@ class SageMakerVllmEmbeddings(SageMakerVllmModelBase,Embeddings):
         norm_emb = emb / np.linalg.norm(emb)
         return norm_emb.tolist()
 
+    def _normalize_vectors(self, embeddings: List[List[float]]) -> List[List[float]]:
+        """Normalize all the embeddings to unit vectors at once."""
+        import numpy as np
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return (matrix / np.maximum(norms, 1e-12)).tolist()
+
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        return len(text) // 4 + 1
+
+    def _make_batches(self, texts: List[str]) -> List[List[str]]:
+        """Pack consecutive texts into batches bounded by `batch_size` and `max_batch_tokens`."""
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = self._estimate_tokens(text)
+            if batch and (
+                len(batch) >= self.batch_size
+                or (self.max_batch_tokens and batch_tokens + tokens > self.max_batch_tokens)
+            ):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def _batch_embeddings(response_dict: dict) -> List[List[float]]:
+        data = sorted(response_dict['data'], key=lambda item: item['index'])
+        return [item['embedding'] for item in data]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        try:
+            response_dict = self.sagemaker_client.invoke({"input": texts})
+        except Exception as e:
+            logger.error(f"Error raised by inference endpoint: {e}")
+            raise e
+        return self._batch_embeddings(response_dict)
+
+    async def _aembed_batch(self, texts: List[str], semaphore: asyncio.Semaphore) -> List[List[float]]:
+        async with semaphore:
+            try:
+                response_dict = await self.sagemaker_client.ainvoke({"input": texts})
+            except Exception as e:
+                logger.error(f"Error raised by inference endpoint: {e}")
+                raise e
+        return self._batch_embeddings(response_dict)
+
+    def _collect_embeddings(self, results: List[List[List[float]]]) -> List[List[float]]:
+        # batches hold consecutive texts, concatenating them keeps the input order
+        embeddings = [embedding for result in results for embedding in result]
+        if self.normalize:
+            return self._normalize_vectors(embeddings)
+        return [
+            embedding if isinstance(embedding, list) else embedding.tolist()
+            for embedding in embeddings
+        ]
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Compute doc embeddings using a SageMaker model.
 
+        The texts are packed into multi-input requests sent from `max_concurrency` threads,
+        over the pooled connections of the sync client.
+
         Args:
             texts: The list of texts to embed
 
         Returns:
             List of embeddings, one for each text.
         """
-        tasks = [
-            {
-                'func':self.embed_query,
-                "args":[text]
-            }
-            for text in texts
-        ]
-        return asyncio.run(
-            self.run_tasks_in_executor(tasks)
-        )
+        if not texts:
+            return []
+        batches = self._make_batches(texts)
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            results = list(executor.map(self._embed_batch, batches))
+        return self._collect_embeddings(results)
 
     def embed_query(self, text: str) -> List[float]:
         """Compute query embeddings using a Bedrock model.
@@ -640,26 +758,131 @@ class SageMakerVllmEmbeddings(SageMakerVllmModelBase,Embeddings):
             Embeddings for the text.
         """
 
-        return await run_in_executor(None, self.embed_query, text)
+        return (await self.aembed_documents([text]))[0]
 
     async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
         """Asynchronous compute doc embeddings using a Bedrock model.
 
+        The texts are packed into multi-input requests, see `batch_size` and `max_batch_tokens`.
+
         Args:
             texts: The list of texts to embed
 
         Returns:
             List of embeddings, one for each text.
         """
-
-        result = await asyncio.gather(*[self.aembed_query(text) for text in texts])
-
-        return list(result)
+        if not texts:
+            return []
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*[
+            self._aembed_batch(batch, semaphore)
+            for batch in self._make_batches(texts)
+        ])
+        return self._collect_embeddings(results)
 
 
 class SageMakerVllmRerank(SageMakerVllmModelBase,BaseDocumentCompressor):
     top_n: Optional[int] = sys.maxsize
 
+    max_documents_per_request: int = 256
+    """Larger document lists are split into several rerank requests."""
+
+    max_concurrency: int = 4
+    """Max number of in-flight rerank requests of one `rerank` call."""
+
+    @staticmethod
+    def _rerank_body(query: str, documents: List[str], top_n: int) -> Dict[str, Any]:
+        input_body = {
+            "query": query,
+            "documents": documents,
+        }
+        if top_n < len(documents):
+            input_body["top_n"] = top_n
+        return input_body
+
+    def _rerank_chunk(self, query: str, documents: List[str], top_n: int) -> List[Dict[str, Any]]:
+        try:
+            response_dict = self.sagemaker_client.invoke(self._rerank_body(query, documents, top_n))
+        except Exception as e:
+            logger.error(f"Error raised by inference endpoint: {e}")
+            raise e
+        return response_dict["results"]
+
+    async def _arerank_chunk(
+        self,
+        query: str,
+        documents: List[str],
+        top_n: int,
+        semaphore: asyncio.Semaphore
+    ) -> List[Dict[str, Any]]:
+        input_body = self._rerank_body(query, documents, top_n)
+        async with semaphore:
+            try:
+                response_dict = await self.sagemaker_client.ainvoke(input_body)
+            except Exception as e:
+                logger.error(f"Error raised by inference endpoint: {e}")
+                raise e
+        return response_dict["results"]
+
+    @staticmethod
+    def _top_n_results(indices: List[int], scores: List[float], top_n: int) -> List[Dict[str, Any]]:
+        """Sort only the `top_n` best scores."""
+        import numpy as np
+        scores = np.asarray(scores, dtype=np.float64)
+        top_n = min(top_n, len(scores))
+        if top_n < len(scores):
+            selected = np.argpartition(-scores, top_n - 1)[:top_n]
+        else:
+            selected = np.arange(len(scores))
+        selected = selected[np.argsort(-scores[selected], kind="stable")]
+        return [
+            {
+                "index": indices[i],
+                "relevance_score": float(scores[i])
+            }
+            for i in selected
+        ]
+
+    async def arerank(
+        self,
+        documents: Sequence[Union[str, Document]],
+        query: str,
+        top_n: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Asynchronous version of `rerank`."""
+        if len(documents) == 0:
+            return []
+        top_n = top_n or self.top_n or len(documents)
+        chunks = self._document_chunks(documents)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        chunk_results = await asyncio.gather(*[
+            self._arerank_chunk(query, chunk, top_n, semaphore)
+            for chunk in chunks
+        ])
+        return self._merge_chunk_results(chunk_results, top_n)
+
+    def _document_chunks(self, documents: Sequence[Union[str, Document]]) -> List[List[str]]:
+        serialized_documents = [
+            doc.page_content
+            if isinstance(doc,Document)
+            else doc
+            for doc in documents
+        ]
+        return [
+            serialized_documents[offset:offset + self.max_documents_per_request]
+            for offset in range(0, len(serialized_documents), self.max_documents_per_request)
+        ]
+
+    def _merge_chunk_results(self, chunk_results: List[List[Dict[str, Any]]], top_n: int) -> List[Dict[str, Any]]:
+        indices = []
+        scores = []
+        for chunk_index, results in enumerate(chunk_results):
+            offset = chunk_index * self.max_documents_per_request
+            for result in results:
+                indices.append(offset + result["index"])
+                scores.append(result["relevance_score"])
+        return self._top_n_results(indices, scores, top_n)
+
     def rerank(
         self,
         documents: Sequence[Union[str, Document]],
@@ -668,45 +891,35 @@ class SageMakerVllmRerank(SageMakerVllmModelBase,BaseDocumentCompressor):
     ) -> List[Dict[str, Any]]:
         """Returns an ordered list of documents based on their relevance to the query.
 
+        The documents are sent in one rerank request (query plus documents), or in a few
+        requests of `max_documents_per_request` documents for large lists, sent from
+        `max_concurrency` threads.
+
         Args:
             query: The query to use for reranking.
             documents: A sequence of documents to rerank.
             top_n: The number of top-ranked results to return. Defaults to self.top_n.
 
         Returns:
-            List[Dict[str, Any]]: A list of ranked documents with relevance scores.
+            List[Dict[str, Any]]: A list of ranked documents with relevance scores, most relevant first.
         """
         if len(documents) == 0:
             return []
-
-        serialized_documents = [
-            doc.page_content
-            if isinstance(doc,Document)
-            else doc
-            for doc in documents
-        ]
-        tasks = [
-            {
-                "func":self.sagemaker_client.invoke,
-                "args":[{
-                    "encoding_format": "float",
-                    "text_1": query,
-                    "text_2": doc
-                }]
-            }
-            for doc in documents
-        ]
-        rets = asyncio.run(self.run_tasks_in_executor(tasks))
-
-        rets = [
-            {
-                "index": i,
-                "relevance_score": ret["data"][0]["score"]
-            }
-            for i,ret in enumerate(rets)
-        ]
-
-        return rets
+        top_n = top_n or self.top_n or len(documents)
+        chunks = self._document_chunks(documents)
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(chunks))) as executor:
+            chunk_results = list(executor.map(lambda chunk: self._rerank_chunk(query, chunk, top_n), chunks))
+        return self._merge_chunk_results(chunk_results, top_n)
+
+    @staticmethod
+    def _compress(documents: Sequence[Document], results: List[Dict[str, Any]]) -> Sequence[Document]:
+        compressed = []
+        for res in results:
+            doc = documents[res["index"]]
+            doc_copy = Document(doc.page_content, metadata=deepcopy(doc.metadata))
+            doc_copy.metadata["relevance_score"] = res["relevance_score"]
+            compressed.append(doc_copy)
+        return compressed
 
     def compress_documents(
         self,
@@ -723,12 +936,15 @@ class SageMakerVllmRerank(SageMakerVllmModelBase,BaseDocumentCompressor):
             callbacks: Callbacks to run during the compression process.
 
         Returns:
-            A sequence of compressed documents.
+            A sequence of compressed documents in relevance order.
         """
-        compressed = []
-        for res in self.rerank(documents, query):
-            doc = documents[res["index"]]
-            doc_copy = Document(doc.page_content, metadata=deepcopy(doc.metadata))
-            doc_copy.metadata["relevance_score"] = res["relevance_score"]
-            compressed.append(doc_copy)
-        return compressed
+        return self._compress(documents, self.rerank(documents, query))
+
+    async def acompress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        """Asynchronous version of `compress_documents`."""
+        return self._compress(documents, await self.arerank(documents, query))
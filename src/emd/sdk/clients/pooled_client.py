@@ -0,0 +1,271 @@
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+from botocore.exceptions import ClientError
+from pydantic import PrivateAttr, model_validator
+
+from .client_base import ClientBase, EndpointHTTPError
+from emd.constants import MODEL_DEFAULT_TAG
+from emd.models import Model
+from emd.models.utils.constants import ServiceType
+from emd.utils.logger_utils import get_logger
+from emd.utils.stack_resolution_cache import resolve_model_stack_info
+
+logger = get_logger(__name__)
+
+THROTTLING_ERROR_CODES = (
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ModelNotReadyException",
+    "ServiceUnavailable",
+    "InternalFailure",
+)
+
+
+def is_endpoint_failure(error: Exception) -> bool:
+    """Throttling, 5xx and connection errors, the endpoint is overloaded or unhealthy."""
+    if isinstance(error, EndpointHTTPError):
+        return error.status_code == 429 or error.status_code >= 500
+    if isinstance(error, ClientError):
+        response = error.response
+        if response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+            return True
+        # `ModelError` carries the status code returned by the model container
+        status_code = response.get("OriginalStatusCode") or \
+            response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def create_client_from_stack(model_stack_name: str, **kwargs) -> ClientBase:
+    """`SageMakerClient` or `ECSClient` of a deployed model stack, according to its service type."""
+    stack_info = resolve_model_stack_info(
+        model_stack_name,
+        profile_name=kwargs.get("credentials_profile_name"),
+        region_name=kwargs.get("region_name")
+    )
+    parameters = {p["ParameterKey"]: p["ParameterValue"] for p in stack_info["Parameters"]}
+    service_type = parameters.get("ServiceType")
+    if service_type in [ServiceType.SAGEMAKER, ServiceType.SAGEMAKER_ASYNC]:
+        from .sagemaker_client import SageMakerClient
+        return SageMakerClient(model_stack_name=model_stack_name, **kwargs)
+    elif service_type == ServiceType.ECS:
+        from .ecs_client import ECSClient
+        return ECSClient(model_stack_name=model_stack_name, **kwargs)
+    raise ValueError(f"Service type {service_type} of model stack {model_stack_name} is not supported")
+
+
+_END_OF_STREAM = object()
+
+
+class _EndpointState:
+    def __init__(self, client: ClientBase):
+        self.client = client
+        self.outstanding = 0
+        self.ewma: Optional[float] = None
+        self.ejected_until = 0.0
+
+
+class PooledClient(ClientBase):
+    """
+    Spread the requests over several deployments of a model, e.g. the stacks of several tags,
+    or endpoints in several regions.
+
+    The endpoint with the least outstanding requests is chosen (`strategy="least_outstanding"`),
+    or the one with the lowest latency EWMA weighted by its outstanding requests
+    (`strategy="ewma"`, the latency of a stream is its time to first chunk). An endpoint
+    returning throttling, 5xx or connection errors is ejected for `eject_cooldown` seconds and
+    the request fails over to another endpoint, up to `max_failovers` times. A stream fails over
+    only before its first chunk.
+    """
+
+    clients: List[Any] = []
+    """The `SageMakerClient`/`ECSClient` of each endpoint, built from the fields below when empty."""
+
+    model_tags: Optional[List[str]] = None
+    """Tags of `model_id`, one endpoint per model stack."""
+
+    model_stack_names: Optional[List[str]] = None
+
+    endpoint_names: Optional[List[str]] = None
+    """SageMaker endpoint names in `region_name`."""
+
+    base_urls: Optional[List[str]] = None
+    """Base urls of ECS deployments."""
+
+    region_name: Optional[str] = None
+
+    client_kwargs: Optional[Dict] = None
+    """Keyword arguments of the clients built by the pool."""
+
+    strategy: str = "least_outstanding"
+
+    ewma_decay: float = 0.3
+    """Weight of the last latency in the latency EWMA."""
+
+    eject_cooldown: float = 30
+    """Seconds an endpoint is ejected after a throttling, 5xx or connection error."""
+
+    max_failovers: int = 2
+
+    _states: List[_EndpointState] = PrivateAttr(default_factory=list)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @model_validator(mode='before')
+    def validate_environment(cls, values: Dict) -> Dict:
+        if values.get("clients"):
+            return values
+        client_kwargs = dict(values.get("client_kwargs") or {})
+        if values.get("region_name"):
+            client_kwargs["region_name"] = values["region_name"]
+        model_stack_names = list(values.get("model_stack_names") or [])
+        for model_tag in values.get("model_tags") or []:
+            model_id = values.get("model_id")
+            if model_id is None:
+                raise ValueError("model_id must be provided with model_tags")
+            model_stack_names.append(Model.get_model_stack_name_prefix(model_id, model_tag=model_tag or MODEL_DEFAULT_TAG))
+        clients = [create_client_from_stack(name, **client_kwargs) for name in model_stack_names]
+        if values.get("endpoint_names"):
+            from .sagemaker_client import SageMakerClient
+            clients += [
+                SageMakerClient(endpoint_name=endpoint_name, **client_kwargs)
+                for endpoint_name in values["endpoint_names"]
+            ]
+        if values.get("base_urls"):
+            from .ecs_client import ECSClient
+            ecs_kwargs = {k: v for k, v in client_kwargs.items() if k != "region_name"}
+            clients += [ECSClient(base_url=base_url, **ecs_kwargs) for base_url in values["base_urls"]]
+        if not clients:
+            raise ValueError("clients, model_tags, model_stack_names, endpoint_names or base_urls must be provided")
+        values["clients"] = clients
+        return values
+
+    def model_post_init(self, __context: Any):
+        if self.strategy not in ("least_outstanding", "ewma"):
+            raise ValueError(f"Unsupported strategy: {self.strategy}")
+        self._states = [_EndpointState(client) for client in self.clients]
+
+    def _cache_endpoint(self) -> str:
+        return "pool:" + ",".join(sorted(state.client._cache_endpoint() for state in self._states))
+
+    def _score(self, state: _EndpointState) -> float:
+        if self.strategy == "ewma":
+            # endpoints without latency yet are tried first
+            return (state.ewma or 0) * (state.outstanding + 1)
+        return state.outstanding
+
+    def _acquire(self, excluded: List[_EndpointState]) -> _EndpointState:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [state for state in self._states if state not in excluded]
+            if not candidates:
+                raise RuntimeError("No endpoint left to fail over to")
+            available = [state for state in candidates if state.ejected_until <= now]
+            if available:
+                # random tie break, idle endpoints share the load evenly
+                state = min(available, key=lambda s: (self._score(s), random.random()))
+            else:
+                # every endpoint is ejected, try the one recovering first
+                state = min(candidates, key=lambda s: s.ejected_until)
+            state.outstanding += 1
+            return state
+
+    def _release(self, state: _EndpointState, latency: Optional[float] = None, error: Exception = None):
+        with self._lock:
+            state.outstanding -= 1
+            if latency is not None:
+                state.ewma = latency if state.ewma is None \
+                    else self.ewma_decay * latency + (1 - self.ewma_decay) * state.ewma
+            if error is not None and is_endpoint_failure(error):
+                state.ejected_until = time.monotonic() + self.eject_cooldown
+                logger.warning(
+                    f"Eject endpoint {state.client._cache_endpoint()} for {self.eject_cooldown}s: {error}"
+                )
+
+    def _can_fail_over(self, error: Exception, excluded: List[_EndpointState]) -> bool:
+        return is_endpoint_failure(error) and len(excluded) <= self.max_failovers \
+            and len(excluded) < len(self._states)
+
+    def _track_stream(self, state: _EndpointState, latency: float, first_chunk, iterator):
+        error = None
+        try:
+            yield first_chunk
+            yield from iterator
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # also when the consumer stops early
+            self._release(state, latency, error=error)
+
+    def _invoke(self, pyload: dict):
+        stream = pyload.get("stream", False)
+        excluded = []
+        while True:
+            state = self._acquire(excluded)
+            start = time.monotonic()
+            try:
+                response = state.client.invoke(pyload)
+                if stream:
+                    # most endpoints fail when the first chunk is read, before it the stream can fail over
+                    response = iter(response)
+                    first_chunk = next(response, _END_OF_STREAM)
+            except Exception as e:
+                self._release(state, error=e)
+                excluded.append(state)
+                if not self._can_fail_over(e, excluded):
+                    raise
+                continue
+            latency = time.monotonic() - start
+            if not stream:
+                self._release(state, latency)
+                return response
+            if first_chunk is _END_OF_STREAM:
+                self._release(state)
+                return iter(())
+            return self._track_stream(state, latency, first_chunk, response)
+
+    async def _ainvoke(self, pyload: dict):
+        excluded = []
+        while True:
+            state = self._acquire(excluded)
+            start = time.monotonic()
+            try:
+                response = await state.client.ainvoke(pyload)
+            except Exception as e:
+                self._release(state, error=e)
+                excluded.append(state)
+                if not self._can_fail_over(e, excluded):
+                    raise
+                continue
+            self._release(state, time.monotonic() - start)
+            return response
+
+    async def _astream(self, pyload: dict) -> AsyncIterator[dict]:
+        excluded = []
+        while True:
+            state = self._acquire(excluded)
+            start = time.monotonic()
+            latency = None
+            error = None
+            try:
+                async for chunk in state.client.astream(pyload):
+                    if latency is None:
+                        latency = time.monotonic() - start
+                    yield chunk
+                return
+            except Exception as e:
+                error = e
+                excluded.append(state)
+                if latency is not None or not self._can_fail_over(e, excluded):
+                    raise
+            finally:
+                self._release(state, latency, error=error)
+
+    async def aclose(self):
+        for state in self._states:
+            await state.client.aclose()
+        await super().aclose()
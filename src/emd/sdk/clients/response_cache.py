@@ -0,0 +1,244 @@
+import copy
+import hashlib
+import json
+import os
+import base64
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from emd.constants import EMD_CACHE_DIR
+from emd.models.utils.constants import ModelType
+from emd.utils.logger_utils import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_RESPONSE_CACHE_PATH = os.path.join(EMD_CACHE_DIR, "responses.sqlite")
+
+_MISS = object()
+# marker of the numpy arrays (e.g. decoded embeddings) in the serialized responses
+_NDARRAY_KEY = "__emd_ndarray__"
+# `input` and `query`/`documents` payloads are only cached for these model types
+CACHEABLE_INPUT_MODEL_TYPES = (ModelType.EMBEDDING, ModelType.RERANK)
+
+
+def _encode_value(value: Any):
+    if hasattr(value, "dtype") and hasattr(value, "tobytes"):
+        if value.shape == ():
+            # numpy scalars
+            return value.item()
+        return {
+            _NDARRAY_KEY: base64.b64encode(value.tobytes()).decode("ascii"),
+            "dtype": value.dtype.str,
+            "shape": list(value.shape),
+        }
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_object(obj: dict):
+    if _NDARRAY_KEY not in obj:
+        return obj
+    import numpy as np
+    return np.frombuffer(base64.b64decode(obj[_NDARRAY_KEY]), dtype=obj["dtype"]).reshape(obj["shape"]).copy()
+
+
+def dumps_response(value: Any) -> bytes:
+    """Serialize a response (JSON values and numpy arrays) for the disk tier."""
+    return json.dumps(value, default=_encode_value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads_response(data: bytes) -> Any:
+    return json.loads(data, object_hook=_decode_object)
+
+
+def is_deterministic_request(pyload: dict, model_type: Optional[str] = None) -> bool:
+    """Requests of embedding and rerank models, and completions sampled greedily (`temperature=0`)."""
+    if pyload.get("stream", False):
+        return False
+    if "messages" in pyload or "prompt" in pyload:
+        return pyload.get("temperature") == 0 and pyload.get("n", 1) == 1
+    if model_type not in CACHEABLE_INPUT_MODEL_TYPES:
+        return False
+    return "input" in pyload or ("query" in pyload and "documents" in pyload)
+
+
+def _encode_key_value(value: Any):
+    if hasattr(value, "dtype") and hasattr(value, "tobytes"):
+        if value.shape == ():
+            return value.item()
+        # the whole buffer is hashed, the repr of large arrays is truncated
+        return {
+            _NDARRAY_KEY: hashlib.sha256(value.tobytes()).hexdigest(),
+            "dtype": value.dtype.str,
+            "shape": list(value.shape),
+        }
+    raise TypeError(f"Object of type {type(value).__name__} can not be part of a cache key")
+
+
+def request_cache_key(endpoint: str, pyload: dict) -> Optional[str]:
+    """Canonical hash of a request, independent of the order of the keys of the payload.
+
+    Returns `None` when the payload has values other than JSON values and numpy arrays,
+    such requests are not cached.
+    """
+    try:
+        canonical = json.dumps(
+            {"endpoint": endpoint, "pyload": pyload},
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            default=_encode_key_value
+        )
+    except (TypeError, ValueError) as e:
+        logger.debug(f"Request not cached: {e}")
+        return None
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two tier cache of deterministic responses, shared by any number of clients.
+
+    An in-memory LRU of `max_entries` responses is backed by a sqlite database at `path`
+    (`None` for memory only) bounded to `max_disk_size` bytes, the least recently used entries
+    are evicted first. Entries expire `ttl` seconds after they are written (`None` never).
+    The database can be shared by several processes, e.g. successive ingestion runs, responses
+    are stored as JSON (numpy arrays as base64 with their dtype and shape).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        ttl: Optional[float] = 7 * 24 * 3600,
+        path: Optional[str] = DEFAULT_RESPONSE_CACHE_PATH,
+        max_disk_size: int = 1024 ** 3,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self._memory: "OrderedDict[str, Tuple[Optional[float], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_size = 0
+        if path is not None:
+            self._open_db(path)
+
+    def _open_db(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires_at REAL, accessed_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._db.execute("DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+        self._disk_size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _memory_set(self, key: str, expires_at: Optional[float], value: Any):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _disk_delete(self, key: str, size: int):
+        self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._disk_size -= size
+
+    def _disk_get(self, key: str, now: float):
+        row = self._db.execute("SELECT value, size, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return _MISS, None
+        data, size, expires_at = row
+        if expires_at is not None and expires_at < now:
+            self._disk_delete(key, size)
+            return _MISS, None
+        try:
+            value = loads_response(data)
+        except ValueError:
+            # not a JSON response (e.g. pickled by an older version), it is never unpickled
+            self._disk_delete(key, size)
+            return _MISS, None
+        self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return value, expires_at
+
+    def _disk_set(self, key: str, value: Any, expires_at: Optional[float], now: float):
+        data = dumps_response(value)
+        if len(data) > self.max_disk_size:
+            return
+        row = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, data, len(data), expires_at, now)
+        )
+        # a replaced row frees its size
+        self._disk_size += len(data) - (row[0] if row is not None else 0)
+        if self._disk_size > self.max_disk_size:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        # the size is only approximate when other processes share the database, recompute it
+        self._disk_size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        excess = self._disk_size - self.max_disk_size
+        if excess <= 0:
+            return
+        freed = 0
+        keys = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._db.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self._disk_size -= freed
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at >= now:
+                    self._memory.move_to_end(key)
+                    return copy.deepcopy(value)
+                del self._memory[key]
+            if self._db is None:
+                return default
+            try:
+                value, expires_at = self._disk_get(key, now)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to read the response cache: {e}")
+                return default
+            if value is _MISS:
+                return default
+            self._memory_set(key, expires_at, value)
+            return copy.deepcopy(value)
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl is not None else None
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._memory_set(key, expires_at, value)
+            if self._db is None:
+                return
+            try:
+                self._disk_set(key, value, expires_at, now)
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                logger.warning(f"Failed to write the response cache: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._disk_size = 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
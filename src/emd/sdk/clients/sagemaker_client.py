@@ -1,23 +1,31 @@
 import json
 import os
-from typing import Optional,Dict,Any,Union
+from typing import Optional,Dict,Any,Union,List
 import io
-from urllib.parse import urlparse
-from pydantic import model_validator
+from urllib.parse import urlparse,quote
+from pydantic import model_validator,PrivateAttr
 import uuid
 import codecs
 import time
 from functools import reduce
 import botocore
 import threading
-from botocore.exceptions import WaiterError
+import atexit
+from contextlib import contextmanager
+from concurrent.futures import Future,InvalidStateError,ThreadPoolExecutor
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.eventstream import EventStreamBuffer
 
-from .client_base import ClientBase
-from emd.utils.aws_service_utils import check_stack_exists,get_model_stack_info
+from .client_base import ClientBase,EndpointHTTPError
+from .http_utils import create_http_client,asend_with_retry
+from emd.utils.stack_resolution_cache import resolve_model_stack_info
 from emd.models import Model
 from emd.constants import MODEL_DEFAULT_TAG
 from emd.utils.logger_utils import get_logger
+from emd.utils.line_iterator import LineIterator,AsyncLineIterator,iter_frames,aiter_frames
 # from sagemaker.async_inference
 
 logger = get_logger(__name__)
@@ -70,65 +78,6 @@ class ObjectNotExistedError(AsyncInferenceError):
 
 
 
-class LineIterator:
-    """
-    A helper class for parsing the byte stream input.
-
-    The output of the model will be in the following format:
-
-    b'{"outputs": [" a"]}\n'
-    b'{"outputs": [" challenging"]}\n'
-    b'{"outputs": [" problem"]}\n'
-    ...
-
-    While usually each PayloadPart event from the event stream will
-    contain a byte array with a full json, this is not guaranteed
-    and some of the json objects may be split acrossPayloadPart events.
-
-    For example:
-
-    {'PayloadPart': {'Bytes': b'{"outputs": '}}
-    {'PayloadPart': {'Bytes': b'[" problem"]}\n'}}
-
-
-    This class accounts for this by concatenating bytes written via the 'write' function
-    and then exposing a method which will return lines (ending with a '\n' character)
-    within the buffer via the 'scan_lines' function.
-    It maintains the position of the last read position to ensure
-    that previous bytes are not exposed again.
-
-    For more details see:
-    https://aws.amazon.com/blogs/machine-learning/elevating-the-generative-ai-experience-introducing-streaming-support-in-amazon-sagemaker-hosting/
-    """
-
-    def __init__(self, stream: Any) -> None:
-        self.byte_iterator = iter(stream)
-        self.buffer = io.BytesIO()
-        self.read_pos = 0
-
-    def __iter__(self) -> "LineIterator":
-        return self
-
-    def __next__(self) -> Any:
-        while True:
-            self.buffer.seek(self.read_pos)
-            line = self.buffer.readline()
-            if line and line[-1] == ord("\n"):
-                self.read_pos += len(line)
-                return line[:-1]
-            try:
-                chunk = next(self.byte_iterator)
-            except StopIteration:
-                if self.read_pos < self.buffer.getbuffer().nbytes:
-                    continue
-                raise
-            if "PayloadPart" not in chunk:
-                # Unknown Event Type
-                continue
-            self.buffer.seek(0, io.SEEK_END)
-            self.buffer.write(chunk["PayloadPart"]["Bytes"])
-
-
 class WaiterConfig(object):
     """Configuration object passed in when using async inference and wait for the result."""
 
@@ -487,6 +436,31 @@ class SageMakerClient(ClientBase):
     s3_client: Any = None
     """Boto3 client for s3"""
 
+    read_timeout: Union[float,None] = 600
+    """Read timeout of `ainvoke`/`astream` requests."""
+
+    max_retries: int = 3
+    """Retries of `ainvoke`/`astream` requests on connection errors and 502/503/504."""
+
+    result_notification: bool = False
+    """Wait for async inference results through the SNS notifications of the endpoint
+    (a private SQS queue is created and subscribed to the topics), instead of S3 polling only."""
+
+    result_queue_url: Union[str,None] = None
+    """An existing SQS queue subscribed to the notification topics of the endpoint."""
+
+    poll_initial_delay: float = 0.5
+    """First S3 polling interval of an async inference result, doubled up to `poll_max_delay`."""
+
+    poll_max_delay: float = 30
+
+    _result_watcher: Any = PrivateAttr(default=None)
+    _result_watcher_lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _bulk_clients: Any = PrivateAttr(default=None)
+    _bulk_clients_lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _default_boto_session: Any = PrivateAttr(default=None)
+    _default_boto_session_lock: Any = PrivateAttr(default_factory=threading.Lock)
+
     @model_validator(mode='before')
     def validate_environment(cls, values: Dict) -> Dict:
         """Dont do anything if client provided externally"""
@@ -543,10 +517,12 @@ class SageMakerClient(ClientBase):
             )
 
         # get endpoint name from stack
-        if not check_stack_exists(model_stack_name):
-            raise ValueError(f"Model stack {model_stack_name} does not exist")
-
-        stack_info = get_model_stack_info(model_stack_name)
+        stack_info = resolve_model_stack_info(
+            model_stack_name,
+            profile_name=values.get("credentials_profile_name"),
+            region_name=values.get("region_name")
+        )
+        values["model_stack_name"] = model_stack_name
 
         Outputs = stack_info.get('Outputs')
         if not Outputs:
@@ -562,44 +538,169 @@ class SageMakerClient(ClientBase):
             values['name'] = model_stack_name
         return values
 
+    def _stack_resolution_kwargs(self) -> dict:
+        return {"profile_name": self.credentials_profile_name, "region_name": self.region_name}
+
     def _prepare_input_body(self,pyload:dict):
         _model_kwargs = self.model_kwargs or {}
-        body = json.dumps({**_model_kwargs,**pyload},ensure_ascii=False,indent=2)
+        body_dict = {**_model_kwargs,**pyload}
+        self._log_request(body_dict)
         accept = "application/json"
-        contentType = "application/json"
+        contentType = self.serializer.content_type
         _endpoint_kwargs = self.endpoint_kwargs or {}
         request_options = {
-            "Body": body,
+            # sagemaker runtime does not forward a content encoding, never compress
+            "Body": self.serializer.dumps(body_dict),
             "EndpointName":self.endpoint_name,
             "Accept": accept,
             "ContentType": contentType,
             **_endpoint_kwargs
         }
-        enable_print_messages = os.getenv("ENABLE_PRINT_MESSAGES", 'False').lower() in ('true', '1', 't')
-        if enable_print_messages:
-            logger.info(f"request body: {json.loads(request_options['Body'])}")
         return request_options
 
-    def invoke(self,pyload:dict):
+    def _cache_endpoint(self) -> str:
+        return f"sagemaker:{self.client.meta.region_name}:{self.endpoint_name}"
+
+    @staticmethod
+    def _is_endpoint_not_found(message:str) -> bool:
+        return "Endpoint" in message and "not found" in message
+
+    @contextmanager
+    def _check_endpoint_not_found(self):
+        try:
+            yield
+        except ClientError as e:
+            if self._is_endpoint_not_found(str(e)):
+                self._invalidate_endpoint_resolution()
+            raise
+
+    def _invoke(self,pyload:dict):
         request_options = self._prepare_input_body(pyload)
         stream = pyload.get('stream', False)
         if stream:
-            resp = self.client.invoke_endpoint_with_response_stream(
-                **request_options
-            )
+            with self._check_endpoint_not_found():
+                resp = self.client.invoke_endpoint_with_response_stream(
+                    **request_options
+                )
             def _ret_iterator_helper():
-                iterator = LineIterator(resp["Body"])
-                for line in iterator:
-                    chunk_dict = json.loads(line)
+                for frame in iter_frames(LineIterator(resp["Body"])):
+                    chunk_dict = json.loads(frame)
                     if not chunk_dict:
                         continue
                     yield chunk_dict
             return _ret_iterator_helper()
         else:
-            output = self.client.invoke_endpoint(**request_options)['Body']
-            response_dict = json.loads(output.read().decode("utf-8"))
-            return response_dict
+            with self._check_endpoint_not_found():
+                response = self.client.invoke_endpoint(**request_options)
+            return self._decode_response(
+                response['Body'].read(),
+                response.get("ContentType", "application/json"),
+                pyload
+            )
+
+
+    def _create_async_http_client(self):
+        return create_http_client(
+            asynchronous=True,
+            pool_size=self.max_concurrency,
+            read_timeout=self.read_timeout
+        )
+
+    def _get_boto_session(self):
+        """The session of the client, or a session of the default credential chain
+        (or `credentials_profile_name`) when the clients are provided externally."""
+        if self.boto_session is not None:
+            return self.boto_session
+        with self._default_boto_session_lock:
+            if self._default_boto_session is None:
+                import boto3
+                self._default_boto_session = boto3.Session(
+                    profile_name=self.credentials_profile_name,
+                    region_name=self.client.meta.region_name
+                )
+            return self._default_boto_session
+
+    def _get_credentials(self):
+        credentials = self._get_boto_session().get_credentials()
+        if credentials is None:
+            raise ValueError("Could not resolve AWS credentials to sign the endpoint requests")
+        return credentials
+
+    def _build_signed_request(self, request_options:dict, stream:bool=False):
+        """Build the SigV4 signed http request of `invoke_endpoint(_with_response_stream)`."""
+        request_options = dict(request_options)
+        body = request_options.pop("Body")
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        endpoint_name = request_options.pop("EndpointName")
+        operation_model = self.client.meta.service_model.operation_model(
+            "InvokeEndpointWithResponseStream" if stream else "InvokeEndpoint"
+        )
+        headers = {}
+        for key, value in request_options.items():
+            member = operation_model.input_shape.members.get(key)
+            if member is None or member.serialization.get("location") != "header":
+                raise ValueError(f"Unsupported endpoint option: {key}")
+            headers[member.serialization["name"]] = str(value)
+        url = self.client.meta.endpoint_url + operation_model.http["requestUri"].replace(
+            "{EndpointName}", quote(endpoint_name, safe="")
+        )
+        aws_request = AWSRequest(method="POST", url=url, data=body, headers=headers)
+        SigV4Auth(
+            self._get_credentials().get_frozen_credentials(),
+            self.client.meta.service_model.signing_name,
+            self.client.meta.region_name
+        ).add_auth(aws_request)
+        return self.async_http_client.build_request(
+            "POST", url, content=body, headers=dict(aws_request.headers.items())
+        )
 
+    async def _asend(self, pyload:dict, stream:bool):
+        request = self._build_signed_request(self._prepare_input_body(pyload), stream=stream)
+        response = await asend_with_retry(
+            self.async_http_client, request, stream=stream, max_retries=self.max_retries
+        )
+        if response.status_code != 200:
+            await response.aread()
+            await response.aclose()
+            if self._is_endpoint_not_found(response.text):
+                self._invalidate_endpoint_resolution()
+            raise EndpointHTTPError(response.status_code, response.text)
+        return response
+
+    async def _ainvoke(self, pyload:dict):
+        response = await self._asend(pyload, stream=False)
+        return self._decode_response(
+            response.content,
+            response.headers.get("Content-Type", "application/json"),
+            pyload
+        )
+
+    async def _aiter_payload_parts(self, response):
+        """Decode the event stream of `invoke_endpoint_with_response_stream` into payload bytes."""
+        event_buffer = EventStreamBuffer()
+        async for data in response.aiter_bytes():
+            event_buffer.add_data(data)
+            for message in event_buffer:
+                headers = message.headers
+                if headers.get(":message-type") in ("exception", "error"):
+                    raise RuntimeError(
+                        f"{headers.get(':exception-type') or headers.get(':error-code')}: "
+                        f"{message.payload.decode('utf-8', errors='ignore')}"
+                    )
+                if headers.get(":event-type") == "PayloadPart":
+                    yield message.payload
+
+    async def _astream(self, pyload:dict):
+        response = await self._asend(pyload, stream=True)
+        try:
+            async for frame in aiter_frames(AsyncLineIterator(self._aiter_payload_parts(response))):
+                chunk_dict = json.loads(frame)
+                if not chunk_dict:
+                    continue
+                yield chunk_dict
+        finally:
+            await response.aclose()
 
     def account_id(self) -> str:
         """Get the AWS account id of the caller.
@@ -772,6 +873,7 @@ class SageMakerClient(ClientBase):
         self,
         data,
         input_path=None,
+        s3_client=None,
     ):
         """Upload request data to Amazon S3 for users"""
         if input_path:
@@ -788,9 +890,9 @@ class SageMakerClient(ClientBase):
             )
 
         _model_kwargs = self.model_kwargs or {}
-        data = json.dumps({**_model_kwargs,**data},ensure_ascii=False,indent=2)
-        self.s3_client.put_object(
-            Body=data, Bucket=bucket, Key=key, ContentType="application/json"
+        body = self.serializer.dumps({**_model_kwargs,**data})
+        (s3_client or self.s3_client).put_object(
+            Body=body, Bucket=bucket, Key=key, ContentType=self.serializer.content_type
         )
         input_path = input_path or "s3://{}/{}".format(bucket, key)
 
@@ -804,111 +906,49 @@ class SageMakerClient(ClientBase):
         finally:
             response_body.close()
 
-    def _check_output_and_failure_paths(self, output_path, failure_path, waiter_config):
-        """Check the Amazon S3 output path for the output.
-
-        This method waits for either the output file or the failure file to be found on the
-        specified S3 output path. Whichever file is found first, its corresponding event is
-        triggered, and the method executes the appropriate action based on the event.
+    def _get_notification_topics(self):
+        """Success and error SNS topics of the async endpoint config."""
+        sagemaker = self._get_boto_session().client("sagemaker", region_name=self.client.meta.region_name)
+        endpoint = sagemaker.describe_endpoint(EndpointName=self.endpoint_name)
+        endpoint_config = sagemaker.describe_endpoint_config(EndpointConfigName=endpoint["EndpointConfigName"])
+        output_config = (endpoint_config.get("AsyncInferenceConfig") or {}).get("OutputConfig") or {}
+        notification_config = output_config.get("NotificationConfig") or {}
+        if not notification_config:
+            logger.warning(f"Endpoint {self.endpoint_name} has no notification topics, poll results from S3")
+        return notification_config.get("SuccessTopic"), notification_config.get("ErrorTopic")
+
+    @property
+    def result_watcher(self):
+        """The watcher shared by all the async inference results of this client."""
+        with self._result_watcher_lock:
+            if self._result_watcher is None:
+                from .async_result_watcher import AsyncResultWatcher
+                success_topic, error_topic = None, None
+                if self.result_notification and not self.result_queue_url:
+                    success_topic, error_topic = self._get_notification_topics()
+                self._result_watcher = AsyncResultWatcher(
+                    self,
+                    success_topic=success_topic,
+                    error_topic=error_topic,
+                    queue_url=self.result_queue_url,
+                    poll_initial_delay=self.poll_initial_delay,
+                    poll_max_delay=self.poll_max_delay
+                )
+                # remove the subscriptions and the queue created for this client
+                atexit.register(self._result_watcher.close)
+            return self._result_watcher
 
-        Args:
-            output_path (str): The S3 path where the output file is expected to be found.
-            failure_path (str): The S3 path where the failure file is expected to be found.
-            waiter_config (boto3.waiter.WaiterConfig): The configuration for the S3 waiter.
-
-        Returns:
-            Any: The deserialized result from the output file, if the output file is found first.
-            Otherwise, raises an exception.
+    def _wait_for_output(self, output_path, failure_path, waiter_config, inference_id=None):
+        """Wait for the result, `waiter_config` bounds the total waiting time.
 
         Raises:
             AsyncInferenceModelError: If the failure file is found before the output file.
-            PollingTimeoutError: If both files are not found and the S3 waiter
-             has thrown a WaiterError.
-        """
-        output_bucket, output_key = parse_s3_url(output_path)
-        failure_bucket, failure_key = parse_s3_url(failure_path)
-
-        output_file_found = threading.Event()
-        failure_file_found = threading.Event()
-
-        def check_output_file():
-            try:
-                output_file_waiter = self.s3_client.get_waiter("object_exists")
-                output_file_waiter.wait(
-                    Bucket=output_bucket,
-                    Key=output_key,
-                    WaiterConfig=waiter_config._to_request_dict(),
-                )
-                output_file_found.set()
-            except WaiterError:
-                pass
-
-        def check_failure_file():
-            try:
-                failure_file_waiter = self.s3_client.get_waiter("object_exists")
-                failure_file_waiter.wait(
-                    Bucket=failure_bucket,
-                    Key=failure_key,
-                    WaiterConfig=waiter_config._to_request_dict(),
-                )
-                failure_file_found.set()
-            except WaiterError:
-                pass
-
-
-        output_thread = threading.Thread(target=check_output_file)
-        failure_thread = threading.Thread(target=check_failure_file)
-
-        output_thread.start()
-        failure_thread.start()
-
-        while not output_file_found.is_set() and not failure_file_found.is_set():
-            time.sleep(1)
-
-        if output_file_found.is_set():
-            s3_object = self.s3_client.get_object(Bucket=output_bucket, Key=output_key)
-            result = self._handle_response(response=s3_object)
-            return result
-
-        failure_object = self.s3_client.get_object(Bucket=failure_bucket, Key=failure_key)
-        failure_response = self._handle_response(response=failure_object)
-
-        raise (
-            AsyncInferenceModelError(message=failure_response)
-            if failure_file_found.is_set()
-            else PollingTimeoutError(
-                message="Inference could still be running",
-                output_path=output_path,
-                seconds=waiter_config.delay * waiter_config.max_attempts,
-            )
-        )
-
-    def _check_output_path(self, output_path, waiter_config):
-        """Check the Amazon S3 output path for the output.
-
-        Periodically check Amazon S3 output path for async inference result.
-        Timeout automatically after max attempts reached
+            PollingTimeoutError: If no result is found in time.
         """
-        bucket, key = parse_s3_url(output_path)
-        s3_waiter = self.s3_client.get_waiter("object_exists")
-        try:
-            s3_waiter.wait(Bucket=bucket, Key=key, WaiterConfig=waiter_config._to_request_dict())
-        except WaiterError:
-            raise PollingTimeoutError(
-                message="Inference could still be running",
-                output_path=output_path,
-                seconds=waiter_config.delay * waiter_config.max_attempts,
-            )
-        s3_object = self.s3_client.get_object(Bucket=bucket, Key=key)
-        result = self._handle_response(response=s3_object)
-        return result
-
-    def _wait_for_output(self, output_path, failure_path, waiter_config):
-        """Retrieve output based on the presense of failure_path."""
-        if failure_path is not None:
-            return self._check_output_and_failure_paths(output_path, failure_path, waiter_config)
-
-        return self._check_output_path(output_path, waiter_config)
+        timeout = waiter_config.delay * waiter_config.max_attempts
+        return self.result_watcher.watch(
+            output_path, failure_path, inference_id=inference_id, timeout=timeout
+        ).result()
 
     def invoke_async(
             self,
@@ -931,11 +971,12 @@ class SageMakerClient(ClientBase):
             "Accept":"*/*"
         }
         if inference_id:
-            request_options['InferenceId']
+            request_options['InferenceId'] = inference_id
 
-        response = self.client.invoke_endpoint_async(
-            **request_options
-        )
+        with self._check_endpoint_not_found():
+            response = self.client.invoke_endpoint_async(
+                **request_options
+            )
         output_location = response["OutputLocation"]
         failure_location = response.get("FailureLocation")
         if async_invoke:
@@ -947,6 +988,112 @@ class SageMakerClient(ClientBase):
             return response_async
         else:
             result = self._wait_for_output(
-                output_path=output_location, failure_path=failure_location, waiter_config=waiter_config
+                output_path=output_location,
+                failure_path=failure_location,
+                waiter_config=waiter_config,
+                inference_id=response.get("InferenceId")
             )
         return result
+
+    def _get_bulk_clients(self, max_concurrency:int):
+        """S3 and sagemaker runtime clients with a connection pool for `max_concurrency` threads."""
+        if self.boto_session is None:
+            # the clients are provided externally
+            return self.s3_client, self.client
+        with self._bulk_clients_lock:
+            if self._bulk_clients is None or self._bulk_clients[0] < max_concurrency:
+                config = Config(max_pool_connections=max_concurrency)
+                region_name = self.client.meta.region_name
+                self._bulk_clients = (
+                    max_concurrency,
+                    self.boto_session.client("s3", region_name=region_name, config=config),
+                    self.boto_session.client(
+                        "sagemaker-runtime",
+                        region_name=region_name,
+                        endpoint_url=self.client.meta.endpoint_url,
+                        config=config
+                    )
+                )
+            return self._bulk_clients[1:]
+
+    def submit_many(
+            self,
+            payloads:List[dict],
+            max_concurrency:int=32,
+            timeout:float=15*60
+        ) -> List[Future]:
+        """Submit a batch of async inference requests.
+
+        The payloads are uploaded to S3 and sent with `invoke_endpoint_async` by `max_concurrency`
+        threads sharing pooled clients. A future per payload is returned at once, in the order of
+        the payloads. Each future is resolved by the shared `result_watcher` with the result of the
+        request, or fails with the error of its submission or inference, or with a
+        `PollingTimeoutError` when no result is found `timeout` seconds after its submission.
+        Cancelling a future drops its pending submission, or stops watching its result.
+        """
+        if not payloads:
+            return []
+        s3_client, runtime_client = self._get_bulk_clients(max_concurrency)
+        # resolve (and create) the default bucket once, not in every upload thread
+        if self.default_bucket is None:
+            self.get_default_bucket()
+        watcher = self.result_watcher
+
+        def _submit(data:dict) -> Future:
+            input_path = self._upload_data_to_s3(data, s3_client=s3_client)
+            with self._check_endpoint_not_found():
+                response = runtime_client.invoke_endpoint_async(
+                    InputLocation=input_path,
+                    EndpointName=self.endpoint_name,
+                    Accept="*/*"
+                )
+            return watcher.watch(
+                response["OutputLocation"],
+                response.get("FailureLocation"),
+                inference_id=response.get("InferenceId"),
+                timeout=timeout
+            )
+
+        def _set_state(future:Future, source:Future):
+            if future.done():
+                return
+            try:
+                if source.cancelled():
+                    future.cancel()
+                elif source.exception() is not None:
+                    future.set_exception(source.exception())
+                else:
+                    future.set_result(source.result())
+            except InvalidStateError:
+                # cancelled by the caller meanwhile
+                pass
+
+        def _on_submitted(future:Future, submission:Future):
+            if submission.cancelled() or submission.exception() is not None:
+                _set_state(future, submission)
+            elif future.cancelled():
+                # cancelled while being submitted
+                submission.result().cancel()
+            else:
+                submission.result().add_done_callback(lambda result: _set_state(future, result))
+
+        def _on_done(future:Future, submission:Future):
+            if not future.cancelled():
+                return
+            # leave the submission queue, or stop watching the result once submitted
+            if not submission.cancel() and submission.done() and submission.exception() is None:
+                submission.result().cancel()
+
+        executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="async-submit")
+        futures = []
+        for data in payloads:
+            future = Future()
+            submission = executor.submit(_submit, data)
+            submission.add_done_callback(
+                lambda submission, future=future: _on_submitted(future, submission)
+            )
+            future.add_done_callback(lambda future, submission=submission: _on_done(future, submission))
+            futures.append(future)
+        # the pending submissions keep running, the threads exit once they are done
+        executor.shutdown(wait=False)
+        return futures
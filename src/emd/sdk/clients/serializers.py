@@ -0,0 +1,41 @@
+import gzip
+import json
+from typing import Any, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONSerializer:
+    """
+    Compact json serializer of the request bodies, orjson is used when it is installed.
+
+    With `compress_min_size` set, bodies of at least that many bytes are gzip compressed and
+    sent with `Content-Encoding: gzip`, e.g. multimodal requests with base64 images. Only the
+    clients talking to the emd http server directly (`ECSClient`) compress, sagemaker runtime
+    does not forward the content encoding to the model container.
+    """
+
+    content_type = "application/json"
+
+    def __init__(self, compress_min_size: Optional[int] = None, compress_level: int = 6):
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+
+    def dumps(self, data: Any) -> bytes:
+        if orjson is not None:
+            try:
+                return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                # e.g. integers larger than 64 bits, fall back to the standard encoder
+                pass
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def encode(self, data: Any) -> Tuple[bytes, Optional[str]]:
+        """Return the body and its content encoding (`None` when not compressed)."""
+        body = self.dumps(data)
+        if self.compress_min_size is not None and len(body) >= self.compress_min_size:
+            return gzip.compress(body, compresslevel=self.compress_level), "gzip"
+        return body, None
@@ -11,7 +11,7 @@ from pathlib import Path
 from botocore.exceptions import ClientError, NoCredentialsError
 from typing_extensions import Annotated
 
-from emd.utils.line_iterator import LineIterator
+from emd.utils.line_iterator import LineIterator,decode_generated_text_line
 
 
 def get_streaming_response(response: requests.Response) -> Iterable[List[str]]:
@@ -52,7 +52,8 @@ class SageMakerClient:
                 ContentType="application/json",
             )
             event_stream = response["Body"]
-            for line in LineIterator(event_stream):
+            for line in LineIterator(event_stream, partial=True):
+                line = decode_generated_text_line(line)
                 print(line, end="")
                 sys.stdout.flush()
                 content += line
@@ -1,4 +1,5 @@
-from emd.utils.aws_service_utils import get_model_stack_info, get_current_region
+from emd.utils.aws_service_utils import get_current_region
+from emd.utils.stack_resolution_cache import resolve_model_stack_info
 from emd.models import Model
 from emd.constants import MODEL_DEFAULT_TAG
 from emd.models.utils.constants import ServiceType
@@ -26,7 +27,7 @@ class InvokerBase:
             self.model_tag
         )
         self.model_stack_name = model_stack_name
-        stack_info = get_model_stack_info(self.model_stack_name)
+        stack_info = resolve_model_stack_info(self.model_stack_name)
         parameters = stack_info.get('Parameters')
 
         if not parameters:
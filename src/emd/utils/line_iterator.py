@@ -13,76 +13,197 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-# --
-# --  Author:        Pavan Kumar Rao Navule
-# --  Date:          1/12/2023
-# --  Purpose:       Iterates over the byte stream from Llama 2 Chat models inferenced with LMI Container with djl-deepspeed version 0.25.0.
-# --  Version:       0.1.0
-# --  Disclaimer:    This script is provided "as is" in accordance with the repository license
-# --  History
-# --  When        Version     Who         What
-# --  -----------------------------------------------------------------
-# --  1/12/2023  0.1.0       Pavan Kumar Rao Navule    Initial
-# --  -----------------------------------------------------------------
-# --
-
-import io
-import re
-
-NEWLINE = re.compile(r'\\n')
-DOUBLE_NEWLINE = re.compile(r'\\n\\n')
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional, Union
 
-class LineIterator:
+# a single unterminated line larger than this is treated as a broken stream
+DEFAULT_MAX_LINE_SIZE = 16 * 1024 * 1024
+
+SSE_DATA_FIELD = b"data:"
+SSE_DONE = b"[DONE]"
+
+
+def _event_bytes(chunk: Union[bytes, dict]) -> Optional[bytes]:
+    """Bytes of a stream chunk, either raw bytes or a sagemaker `PayloadPart` event."""
+    if isinstance(chunk, dict):
+        if "PayloadPart" not in chunk:
+            # Unknown Event Type
+            return None
+        return chunk["PayloadPart"]["Bytes"]
+    return chunk
+
+
+class LineDecoder:
+    """
+    Incremental line splitter of a byte stream.
+
+    `feed` returns the lines completed by the new bytes (without the line ending), only the
+    trailing unterminated part is kept, so the memory use is bounded by the longest line and
+    not by the length of the stream. Lines may be split anywhere across chunks, e.g. when a
+    json object is split across `PayloadPart` events:
+
+    {'PayloadPart': {'Bytes': b'{"outputs": '}}
+    {'PayloadPart': {'Bytes': b'[" problem"]}\n'}}
+
+    With `partial=True` the unterminated part is returned as well, for streams which
+    are not line oriented (e.g. the incremental `{"generated_text": "...` output of LMI).
     """
-    A helper class for parsing the byte stream from Llama 2 model inferenced with LMI Container.
 
-    The output of the model will be in the following repetetive but incremental format:
-    ```
-    b'{"generated_text": "'
-    b'lo from L"'
-    b'LM \\n\\n'
-    b'How are you?"}'
-    ...
+    def __init__(self, max_line_size: int = DEFAULT_MAX_LINE_SIZE, partial: bool = False):
+        self.max_line_size = max_line_size
+        self.partial = partial
+        self._buffer = bytearray()
 
-    For each iteration, we just read the incremental part and seek for the new position for the next iteration till the end of the line.
+    def feed(self, data: bytes) -> List[bytes]:
+        if not data:
+            return []
+        # only the new bytes are searched for line endings
+        scan_pos = len(self._buffer)
+        self._buffer += data
+        lines = []
+        start = 0
+        end = self._buffer.find(b"\n", scan_pos)
+        while end != -1:
+            line = bytes(self._buffer[start:end + 1]) if self.partial else bytes(self._buffer[start:end])
+            lines.append(line if self.partial or not line.endswith(b"\r") else line[:-1])
+            start = end + 1
+            end = self._buffer.find(b"\n", start)
+        if self.partial and start < len(self._buffer):
+            lines.append(bytes(self._buffer[start:]))
+            start = len(self._buffer)
+        del self._buffer[:start]
+        if len(self._buffer) > self.max_line_size:
+            raise ValueError(f"Line exceeds the max line size: {self.max_line_size} bytes")
+        return lines
 
+    def flush(self) -> List[bytes]:
+        if not self._buffer:
+            return []
+        line = bytes(self._buffer)
+        self._buffer.clear()
+        return [line]
+
+
+class LineIterator:
+    """
+    Iterate over the lines of a byte stream, the stream items are bytes or `PayloadPart` events
+    of `invoke_endpoint_with_response_stream`. See `LineDecoder`.
+
+    For more details see:
+    https://aws.amazon.com/blogs/machine-learning/elevating-the-generative-ai-experience-introducing-streaming-support-in-amazon-sagemaker-hosting/
     """
 
-    def __init__(self, stream):
+    def __init__(self, stream: Iterable, max_line_size: int = DEFAULT_MAX_LINE_SIZE, partial: bool = False):
         self.byte_iterator = iter(stream)
-        self.buffer = io.BytesIO()
-        self.read_pos = 0
+        self.decoder = LineDecoder(max_line_size=max_line_size, partial=partial)
+        self._lines = iter(())
 
-    def __iter__(self):
+    def __iter__(self) -> "LineIterator":
         return self
 
-    def __next__(self):
-        start_sequence = b'{"generated_text": "'
-        stop_sequence = b'"}'
-        new_line = '\n'
-        double_new_line = '\n\n'
+    def __next__(self) -> bytes:
         while True:
-            self.buffer.seek(self.read_pos)
-            line = self.buffer.readline()
-            if line:
-                self.read_pos += len(line)
-                if line.startswith(start_sequence):# in :
-                    line = line.lstrip(start_sequence)
-
-                if line.endswith(stop_sequence):
-                    line =line.rstrip(stop_sequence)
-                line = line.decode('utf-8')
-                line = NEWLINE.sub(new_line, line)
-                line = DOUBLE_NEWLINE.sub(double_new_line, line)
+            line = next(self._lines, None)
+            if line is not None:
                 return line
+            if self.decoder is None:
+                raise StopIteration
             try:
-                chunk = next(self.byte_iterator)
+                data = _event_bytes(next(self.byte_iterator))
             except StopIteration:
-                if self.read_pos < self.buffer.getbuffer().nbytes:
-                    continue
-                raise
-            if 'PayloadPart' not in chunk:
-                print('Unknown event type:' + chunk)
+                self._lines = iter(self.decoder.flush())
+                self.decoder = None
+                continue
+            if data:
+                self._lines = iter(self.decoder.feed(data))
+
+
+class AsyncLineIterator:
+    """Asyncio version of `LineIterator` over an async iterable of bytes or `PayloadPart` events."""
+
+    def __init__(self, stream: AsyncIterable, max_line_size: int = DEFAULT_MAX_LINE_SIZE, partial: bool = False):
+        self.byte_iterator = stream.__aiter__()
+        self.decoder = LineDecoder(max_line_size=max_line_size, partial=partial)
+        self._lines = iter(())
+
+    def __aiter__(self) -> "AsyncLineIterator":
+        return self
+
+    async def __anext__(self) -> bytes:
+        while True:
+            line = next(self._lines, None)
+            if line is not None:
+                return line
+            if self.decoder is None:
+                raise StopAsyncIteration
+            try:
+                data = _event_bytes(await self.byte_iterator.__anext__())
+            except StopAsyncIteration:
+                self._lines = iter(self.decoder.flush())
+                self.decoder = None
                 continue
-            self.buffer.seek(0, io.SEEK_END)
-            self.buffer.write(chunk['PayloadPart']['Bytes'])
+            if data:
+                self._lines = iter(self.decoder.feed(data))
+
+
+class FrameDecoder:
+    """
+    Turn lines into frames of a SSE (`data: {...}`) or JSONL stream.
+
+    The `data` fields of a SSE event are joined and emitted at the blank line closing the event,
+    comments and other SSE fields are skipped, any other non empty line is a JSONL frame.
+    The `[DONE]` sentinel of OpenAI streams is dropped.
+    """
+
+    def __init__(self):
+        self._data = []
+
+    def _emit(self) -> Optional[bytes]:
+        if not self._data:
+            return None
+        frame = b"\n".join(self._data)
+        self._data = []
+        return None if frame == SSE_DONE else frame
+
+    def feed(self, line: bytes) -> Optional[bytes]:
+        line = line.rstrip(b"\r\n")
+        if not line:
+            return self._emit()
+        if line.startswith(SSE_DATA_FIELD):
+            data = line[len(SSE_DATA_FIELD):]
+            self._data.append(data[1:] if data.startswith(b" ") else data)
+            return None
+        if line.startswith((b":", b"event:", b"id:", b"retry:")):
+            return None
+        line = line.strip()
+        return None if line == SSE_DONE else line
+
+    def flush(self) -> Optional[bytes]:
+        return self._emit()
+
+
+def iter_frames(lines: Iterable[bytes]) -> Iterator[bytes]:
+    decoder = FrameDecoder()
+    for line in lines:
+        frame = decoder.feed(line)
+        if frame is not None:
+            yield frame
+    frame = decoder.flush()
+    if frame is not None:
+        yield frame
+
+
+async def aiter_frames(lines: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    decoder = FrameDecoder()
+    async for line in lines:
+        frame = decoder.feed(line)
+        if frame is not None:
+            yield frame
+    frame = decoder.flush()
+    if frame is not None:
+        yield frame
+
+
+def decode_generated_text_line(line: bytes) -> str:
+    """Text of a (partial) line of the incremental `{"generated_text": "..."}` output of LMI containers."""
+    line = line.removeprefix(b'{"generated_text": "').removesuffix(b'"}')
+    return line.decode("utf-8").replace("\\n", "\n")
@@ -0,0 +1,136 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+from emd.constants import EMD_CACHE_DIR
+
+from .aws_service_utils import get_current_region
+from .logger_utils import get_logger
+
+logger = get_logger(__name__)
+
+STACK_RESOLUTION_CACHE_PATH = os.path.join(EMD_CACHE_DIR, "model_stacks.json")
+# seconds a resolved model stack is trusted, 0 disables the cache
+STACK_RESOLUTION_CACHE_TTL = float(os.environ.get("EMD_STACK_RESOLUTION_CACHE_TTL", 3600))
+
+_lock = threading.Lock()
+_memory_cache = {}
+
+
+def _cache_key(model_stack_name: str, profile_name: Optional[str] = None, region_name: Optional[str] = None) -> str:
+    profile = profile_name or os.environ.get("AWS_PROFILE") or "default"
+    return f"{profile}:{region_name or get_current_region()}:{model_stack_name}"
+
+
+def _load_cache() -> dict:
+    try:
+        with open(STACK_RESOLUTION_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache: dict):
+    # atomic replace, the file is shared by concurrent sdk and cli processes
+    try:
+        os.makedirs(EMD_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=EMD_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, STACK_RESOLUTION_CACHE_PATH)
+    except OSError as e:
+        logger.warning(f"Failed to write the model stack cache: {e}")
+
+
+def _describe_model_stack(
+        model_stack_name: str,
+        profile_name: Optional[str] = None,
+        region_name: Optional[str] = None
+    ) -> Optional[dict]:
+    session = boto3.Session(profile_name=profile_name)
+    cf = session.client("cloudformation", region_name=region_name or get_current_region())
+    try:
+        stack_info = cf.describe_stacks(StackName=model_stack_name)["Stacks"][0]
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ValidationError" and "does not exist" in str(e):
+            return None
+        raise
+    return {
+        "StackName": stack_info["StackName"],
+        "StackStatus": stack_info["StackStatus"],
+        "Outputs": stack_info.get("Outputs") or [],
+        "Parameters": stack_info.get("Parameters") or [],
+    }
+
+
+def resolve_model_stack_info(
+        model_stack_name: str,
+        refresh: bool = False,
+        profile_name: Optional[str] = None,
+        region_name: Optional[str] = None
+    ) -> dict:
+    """
+    Outputs and parameters of a deployed model stack (endpoint name or load balancer dns,
+    service type...), in the `describe_stacks` format.
+
+    The stack is described with the credentials of `profile_name` in `region_name`
+    (the default profile and the current region when not given).
+    Resolved stacks are cached in memory and in `~/.emd-cache` for
+    `STACK_RESOLUTION_CACHE_TTL` seconds, keyed by profile, region and stack name, the
+    callers invalidate the entry of a stack whose endpoint is not found anymore.
+
+    Raises:
+        ValueError: If the stack does not exist.
+    """
+    key = _cache_key(model_stack_name, profile_name, region_name)
+    now = time.time()
+    if not refresh and STACK_RESOLUTION_CACHE_TTL > 0:
+        with _lock:
+            entry = _memory_cache.get(key)
+            if entry is None:
+                entry = _load_cache().get(key)
+            if entry is not None and entry["expires_at"] > now:
+                _memory_cache[key] = entry
+                return entry["stack_info"]
+
+    stack_info = _describe_model_stack(model_stack_name, profile_name, region_name)
+    if stack_info is None:
+        invalidate_model_stack_info(model_stack_name, profile_name, region_name)
+        raise ValueError(f"Model stack {model_stack_name} does not exist")
+    # a stack without outputs is still being deployed, or failed
+    if STACK_RESOLUTION_CACHE_TTL > 0 and stack_info["Outputs"]:
+        entry = {"stack_info": stack_info, "expires_at": now + STACK_RESOLUTION_CACHE_TTL}
+        with _lock:
+            _memory_cache[key] = entry
+            cache = _load_cache()
+            cache = {k: v for k, v in cache.items() if v["expires_at"] > now}
+            cache[key] = entry
+            _save_cache(cache)
+    return stack_info
+
+
+def invalidate_model_stack_info(
+        model_stack_name: str,
+        profile_name: Optional[str] = None,
+        region_name: Optional[str] = None
+    ):
+    key = _cache_key(model_stack_name, profile_name, region_name)
+    with _lock:
+        _memory_cache.pop(key, None)
+        cache = _load_cache()
+        if cache.pop(key, None) is not None:
+            logger.info(f"Invalidated the cached resolution of model stack {model_stack_name}")
+            _save_cache(cache)
+
+
+def get_stack_output(stack_info: dict, output_key: str) -> Optional[str]:
+    for output in stack_info.get("Outputs") or []:
+        if output["OutputKey"] == output_key:
+            return output["OutputValue"]
+    return None
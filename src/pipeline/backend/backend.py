@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Iterable, List, AsyncGenerator
+from typing import Iterable, List, AsyncGenerator, Optional, Tuple
 from emd.models import Model,Engine
 from typing import Iterable, List
 import os
@@ -11,7 +11,12 @@ import traceback
 import json
 import socket
 import threading
-from fastapi.concurrency import run_in_threadpool
+import asyncio
+import functools
+import inspect
+from fastapi import HTTPException
+from fastapi.responses import Response
+from starlette.concurrency import iterate_in_threadpool
 
 
 # import httpx
@@ -21,15 +26,24 @@ from emd.utils.accelerator_utils import get_gpu_num,get_neuron_core_num,get_cpu_
 
 
 from utils.common import download_dir_from_s3_by_s5cmd
+from utils.inference_executor import InferenceExecutor
+from utils.metrics import RequestMetrics, parse_usage
 # import torch
 from emd.constants import EMD_MODELS_S3_KEY_TEMPLATE
 from emd.utils.logger_utils import get_logger
+from emd.utils.line_iterator import AsyncLineIterator,FrameDecoder,LineDecoder,aiter_frames
 
 logger = get_logger(__name__)
 
+# used when the `max_concurrency` of the engine is not set
+DEFAULT_ENGINE_MAX_CONCURRENCY = 128
+# seconds to wait for the response (or the next stream chunk) of the engine server
+DEFAULT_ENGINE_READ_TIMEOUT = 600
+
 class BackendBase(ABC):
     def __init__(self,model:Model):
         self.execute_model: Model = model
+        self._inference_executor = None
 
     @abstractmethod
     def start(self):
@@ -39,8 +53,128 @@ class BackendBase(ABC):
     def invoke(self, request):
         ...
 
+    @property
+    def inference_executor(self) -> InferenceExecutor:
+        """Bounded executor running the blocking model calls of in-process backends."""
+        if self._inference_executor is None:
+            current_engine = self.execute_model.executable_config.current_engine
+            max_workers = getattr(current_engine, "inference_max_workers", None)
+            if not max_workers:
+                # one worker per device
+                try:
+                    max_workers = get_gpu_num()
+                except Exception as e:
+                    logger.warning(f"Failed to get gpu num, use one inference worker: {e}")
+                    max_workers = 1
+                max_workers = max(max_workers, 1)
+            max_queue_size = getattr(current_engine, "inference_max_queue_size", 64)
+            logger.info(f"Creating inference executor, max_workers: {max_workers}, max_queue_size: {max_queue_size}")
+            self._inference_executor = InferenceExecutor(
+                max_workers=max_workers,
+                max_queue_size=max_queue_size
+            )
+        return self._inference_executor
+
+    async def run_in_inference_executor(self, func, *args, **kwargs):
+        """Run a blocking call in the inference executor.
+
+        Raises `InferenceQueueFullError` right away if the inference queue is full.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.inference_executor,
+            functools.partial(func, *args, **kwargs)
+        )
+
     async def ainvoke(self, request):
-        return await run_in_threadpool(self.invoke, request)
+        return await self.run_in_inference_executor(self.invoke, request)
+
+    async def ainvoke_with_metrics(self, request, metrics: RequestMetrics):
+        """`ainvoke` recording the engine latency, time to first token, inter-token latency, tokens and stream events."""
+        metrics.observe_admission()
+        response = await self.ainvoke(request)
+        if not request.get("stream", False):
+            metrics.observe_engine_done()
+            metrics.observe_tokens(*self.get_usage(response))
+            return response
+        return self._ainstrument_stream(response, metrics)
+
+    async def _ainstrument_stream(self, response, metrics: RequestMetrics):
+        if not hasattr(response, "__aiter__"):
+            response = iterate_in_threadpool(response)
+        events = 0
+        input_tokens = completion_tokens = None
+        # the raw reads of the proxied engines are re-framed into events, an event (or its
+        # usage) may be split across reads, the reads themselves are forwarded untouched
+        line_decoder = frame_decoder = None
+
+        def observe_event(event, count):
+            nonlocal events, input_tokens, completion_tokens
+            metrics.observe_chunk()
+            events += count
+            # the last event carries the usage with `stream_options.include_usage`
+            prompt_tokens, event_completion_tokens = self.get_usage(event)
+            if prompt_tokens is not None:
+                input_tokens, completion_tokens = prompt_tokens, event_completion_tokens
+
+        try:
+            async for chunk in response:
+                if isinstance(chunk, (bytes, bytearray)):
+                    if frame_decoder is None:
+                        line_decoder, frame_decoder = LineDecoder(), FrameDecoder()
+                    for line in line_decoder.feed(chunk):
+                        frame = frame_decoder.feed(line)
+                        if frame is not None:
+                            observe_event(frame, 1)
+                else:
+                    observe_event(chunk, self.count_stream_events(chunk))
+                yield chunk
+        finally:
+            if frame_decoder is not None:
+                frames = [frame_decoder.feed(line) for line in line_decoder.flush()] + [frame_decoder.flush()]
+                for frame in frames:
+                    if frame is not None:
+                        observe_event(frame, 1)
+            metrics.observe_engine_done()
+            # without usage the number of tokens is unknown, events are not tokens
+            metrics.observe_tokens(input_tokens, completion_tokens)
+            metrics.observe_stream_events(events)
+
+    def get_usage(self, response) -> Tuple[Optional[int], Optional[int]]:
+        """Prompt and completion tokens of a response or stream chunk, from its openai `usage`."""
+        if isinstance(response, dict):
+            usage = response.get("usage") or {}
+            return usage.get("prompt_tokens"), usage.get("completion_tokens")
+        if hasattr(response, "usage"):
+            # responses of the openai client
+            usage = response.usage
+            return getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None)
+        if isinstance(response, str):
+            response = response.encode("utf-8")
+        elif isinstance(response, Response):
+            # raw json of the proxied engines
+            response = response.body
+        if isinstance(response, (bytes, bytearray)):
+            return parse_usage(response)
+        return None, None
+
+    def count_stream_events(self, chunk) -> int:
+        """Events of a stream chunk (`data:` lines or sagemaker frames)."""
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if not isinstance(chunk, (bytes, bytearray)):
+            return 1
+        events = chunk.count(b"data:") or chunk.count(b"\n") or 1
+        return max(events - chunk.count(b"[DONE]"), 0)
+
+    @property
+    def engine_max_concurrency(self) -> int:
+        """Max number of requests the backend processes concurrently."""
+        max_concurrency = getattr(self.execute_model.executable_config.current_engine, "max_concurrency", None)
+        if max_concurrency:
+            return max_concurrency
+        # the inference executor runs and queues the blocking jobs of the in-process backends
+        return self.inference_executor.max_workers + self.inference_executor.max_queue_size
 
 
 class OpenAICompitableProxyBackendBase(BackendBase):
@@ -79,7 +213,10 @@ class OpenAICompitableProxyBackendBase(BackendBase):
         self.engine_type = self.execute_model.executable_config.current_engine.engine_type
         # self.gpu_num = torch.cuda.device_count()
         self.model_type = self.execute_model.model_type
+        self.raw_stream_proxy = getattr(self.execute_model.executable_config.current_engine, "raw_stream_proxy", False)
+        self.raw_response_proxy = getattr(self.execute_model.executable_config.current_engine, "raw_response_proxy", False)
         self.proc = None
+        self._http_client = None
 
 
     @property
@@ -217,7 +354,6 @@ class OpenAICompitableProxyBackendBase(BackendBase):
         if self.service_type == ServiceType.SAGEMAKER:
             return response +  "\n"
         else:
-            logger.info(f"data: {response}")
             return f"data: {response}\n\n"
 
     def _get_streaming_response(self, response) -> Iterable[List[str]]:
@@ -232,7 +368,6 @@ class OpenAICompitableProxyBackendBase(BackendBase):
     async def _aget_streaming_response(self, response) -> AsyncGenerator[str, None]:
         try:
             async for chunk in response:
-                logger.info(f"chunk: {chunk}")
                 yield self._format_streaming_response(chunk.model_dump_json())
         except Exception as e:
             logger.error(traceback.format_exc())
@@ -240,3 +375,124 @@ class OpenAICompitableProxyBackendBase(BackendBase):
 
     async def _aget_response(self, response) -> List[str]:
         return response
+
+    @property
+    def engine_max_concurrency(self) -> int:
+        """Max number of sequences the engine server runs concurrently, the `max_concurrency` of the engine."""
+        max_concurrency = getattr(self.execute_model.executable_config.current_engine, "max_concurrency", None)
+        if max_concurrency:
+            return max_concurrency
+        logger.warning(
+            f"max_concurrency of the {self.engine_type} engine is not set, "
+            f"use {DEFAULT_ENGINE_MAX_CONCURRENCY}, set it to the batch capacity of the engine (e.g. --max_num_seqs)"
+        )
+        return DEFAULT_ENGINE_MAX_CONCURRENCY
+
+    @property
+    def http_client(self):
+        """Pooled keep-alive http client of the engine server."""
+        if self._http_client is None:
+            import httpx
+            # twice the engine batch, the next sequences wait in the engine scheduler,
+            # further requests wait for a pooled connection
+            pool_size = 2 * self.engine_max_concurrency
+            read_timeout = getattr(
+                self.execute_model.executable_config.current_engine, "read_timeout", DEFAULT_ENGINE_READ_TIMEOUT
+            )
+            logger.info(f"Creating engine http client, pool size: {pool_size}, read timeout: {read_timeout}")
+            self._http_client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=httpx.Timeout(read_timeout, connect=10),
+                headers={"Authorization": f"Bearer {self.api_key}"} if self.api_key else None
+            )
+        return self._http_client
+
+    def _prepare_raw_request(self, request:dict):
+        # the openai client options of the request become http headers and body fields
+        request = dict(request)
+        headers = request.pop("extra_headers", None) or {}
+        request.update(request.pop("extra_body", None) or {})
+        return request, headers
+
+    async def _aiter_raw_streaming_response(self, response) -> AsyncGenerator[bytes, None]:
+        try:
+            if self.service_type == ServiceType.SAGEMAKER:
+                # sagemaker streams newline delimited json
+                async for frame in aiter_frames(AsyncLineIterator(response.aiter_bytes())):
+                    yield frame + b"\n"
+            else:
+                async for data in response.aiter_bytes():
+                    yield data
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            yield self._format_streaming_response(json.dumps({"error": str(e)})).encode("utf-8")
+        finally:
+            await response.aclose()
+
+    async def _aproxy_streaming_response(self, path:str, request:dict) -> AsyncGenerator[bytes, None]:
+        """Forward the streaming response of the engine server without parsing its chunks."""
+        body, headers = self._prepare_raw_request(request)
+        http_request = self.http_client.build_request("POST", path, json=body, headers=headers)
+        response = await self.http_client.send(http_request, stream=True)
+        if response.status_code != 200:
+            await response.aread()
+            await response.aclose()
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        return self._aiter_raw_streaming_response(response)
+
+    def _request_path(self, request:dict) -> str:
+        if self.model_type == ModelType.EMBEDDING:
+            return "/embeddings"
+        if self.model_type == ModelType.RERANK:
+            return "/rerank"
+        return "/chat/completions"
+
+    async def _aproxy_response(self, path:str, request:dict) -> Response:
+        """Forward the response of the engine server without parsing it."""
+        body, headers = self._prepare_raw_request(request)
+        response = await self.http_client.post(path, json=body, headers=headers)
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        return Response(
+            content=response.content,
+            media_type=response.headers.get("content-type", "application/json")
+        )
+
+    async def _aopenai_create(self, fn, request:dict):
+        body, headers = self._prepare_raw_request(request)
+        sig = inspect.signature(fn)
+        extra_body = {k:body.pop(k) for k in list(body.keys()) if k not in sig.parameters}
+        return await fn(**body, extra_body=extra_body, extra_headers=headers)
+
+    async def _aopenai_streaming_response(self, request:dict):
+        response = await self._aopenai_create(self.async_client.chat.completions.create, request)
+        return await self._atransform_streaming_response(response)
+
+    async def _aopenai_response(self, path:str, request:dict):
+        if self.model_type == ModelType.RERANK:
+            # the openai client has no rerank api
+            body, headers = self._prepare_raw_request(request)
+            response = await self.http_client.post(path, json=body, headers=headers)
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=response.text)
+            response = response.json()
+        elif self.model_type == ModelType.EMBEDDING:
+            response = await self._aopenai_create(self.async_client.embeddings.create, request)
+        else:
+            response = await self._aopenai_create(self.async_client.chat.completions.create, request)
+        return await self._atransform_response(response)
+
+    async def ainvoke(self, request):
+        # one async request path for all the engines, the engines opt in to forward the
+        # bytes of the engine server without the transforms of the backend
+        request = self._transform_request(request)
+        logger.info(f"Chat request:{request}")
+        path = self._request_path(request)
+        if request.get("stream", False):
+            if self.raw_stream_proxy:
+                return await self._aproxy_streaming_response(path, request)
+            return await self._aopenai_streaming_response(request)
+        if self.raw_response_proxy:
+            return await self._aproxy_response(path, request)
+        return await self._aopenai_response(path, request)
@@ -15,10 +15,19 @@ from threading import Thread
 import json
 from transformers import AutoModel
 from PIL import Image
+import numpy as np
+from fastapi.responses import Response
+from utils.micro_batcher import MicroBatcher
 
 
 logger = get_logger(__name__)
 
+# little-endian dtypes of the base64/binary embedding encodings
+EMBEDDING_DTYPES = {
+    "float32": "<f4",
+    "float16": "<f2"
+}
+
 class TransformerEmbeddingBackend(BackendBase):
     def __init__(self,*args,**kwargs):
         super().__init__(
@@ -36,6 +45,11 @@ class TransformerEmbeddingBackend(BackendBase):
         self.model = None
         self.pretrained_model_init_kwargs = self.execute_model.executable_config.current_engine.pretrained_model_init_kwargs or {}
         self.is_bge_vl = "bge-vl" in self.model_id.lower()
+        current_engine = self.execute_model.executable_config.current_engine
+        self.max_batch_size = getattr(current_engine, "max_batch_size", 0)
+        self.max_batch_wait_ms = getattr(current_engine, "max_batch_wait_ms", 5)
+        self.batch_length_buckets = getattr(current_engine, "batch_length_buckets", None)
+        self.batcher = None
 
 
     def start(self):
@@ -81,8 +95,55 @@ class TransformerEmbeddingBackend(BackendBase):
         #     **self.pretrained_tokenizer_init_kwargs
         # )
 
+        # BGE-VL inputs are multimodal and are not merged across requests
+        if self.max_batch_size and not self.is_bge_vl:
+            self.batcher = MicroBatcher(
+                self._encode_batch,
+                max_batch_size=self.max_batch_size,
+                max_wait_ms=self.max_batch_wait_ms,
+                length_buckets=self.batch_length_buckets,
+                executor=self.inference_executor,
+                max_pending_requests=self.inference_executor.max_queue_size
+            )
+            logger.info(
+                f"micro batching enabled, max_batch_size: {self.max_batch_size}, "
+                f"max_batch_wait_ms: {self.max_batch_wait_ms}, length_buckets: {self.batch_length_buckets}"
+            )
 
-    def format_openai_response(self,responses:list[list[float]]):
+
+    def _to_numpy(self, embeddings, embedding_dtype:str="float32"):
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unsupported embedding_dtype: {embedding_dtype}, supported: {list(EMBEDDING_DTYPES)}")
+        if hasattr(embeddings, "detach"):
+            embeddings = embeddings.detach().float().cpu().numpy()
+        # no copy when the buffer already has the requested layout
+        return np.ascontiguousarray(embeddings, dtype=EMBEDDING_DTYPES[embedding_dtype])
+
+    def format_binary_response(self, embeddings, embedding_dtype:str="float32"):
+        """Return all embeddings as one raw little-endian matrix, the shape and dtype are carried by the content type."""
+        if isinstance(embeddings, (list, tuple)):
+            embeddings = np.stack([self._to_numpy(e, embedding_dtype).reshape(-1) for e in embeddings])
+        matrix = self._to_numpy(embeddings, embedding_dtype)
+        return Response(
+            content=matrix.tobytes(),
+            media_type=f"application/octet-stream; dtype={embedding_dtype}; shape={matrix.shape[0]},{matrix.shape[1]}"
+        )
+
+    def format_openai_response(self,embeddings,encoding_format:str="float",embedding_dtype:str="float32"):
+        if encoding_format == "binary":
+            return self.format_binary_response(embeddings, embedding_dtype)
+        if encoding_format == "base64":
+            responses = [
+                base64.b64encode(self._to_numpy(embedding, embedding_dtype).reshape(-1).tobytes()).decode("ascii")
+                for embedding in embeddings
+            ]
+        elif encoding_format in (None, "float"):
+            responses = [
+                embedding.tolist() if hasattr(embedding, "tolist") else embedding
+                for embedding in embeddings
+            ]
+        else:
+            raise ValueError(f"Unsupported encoding_format: {encoding_format}, supported: float, base64, binary")
         return {
             "object": "list",
             "data": [
@@ -212,27 +273,56 @@ class TransformerEmbeddingBackend(BackendBase):
 
         return all_embeddings
 
+    def _encode_batch(self, inputs:list[str], encode_kwargs:tuple):
+        return self.model.encode(inputs, **dict(encode_kwargs))
+
+    def _get_encode_kwargs(self, request:dict):
+        return (
+            ("task", request.get('task', 'text-matching')),
+            ("truncate_dim", request.get('truncate_dim', None))
+        )
+
     def invoke(self, request:dict):
         inputs = request['input']
         if not inputs:
             return []
+        if isinstance(inputs, str):
+            inputs = [inputs]
 
         logger.info(f'request: {request}')
         t0 = time.time()
 
         if self.is_bge_vl:
             # Use BGE-VL multimodal processing
-            embeddings_list = self._generate_bge_vl_embeddings(inputs)
+            embeddings = self._generate_bge_vl_embeddings(inputs)
         else:
             # Use standard text embedding processing
-            task = request.get('task', 'text-matching')
-            truncate_dim = request.get('truncate_dim', None)
-            embeddings = self.model.encode(inputs, task=task, truncate_dim=truncate_dim)
-            embeddings_list = embeddings.tolist()
+            embeddings = self._encode_batch(inputs, self._get_encode_kwargs(request))
 
-        logger.info(f'embeddings generated, count: {len(embeddings_list)}, elapsed time: {time.time()-t0}')
-        return self.format_openai_response(embeddings_list)
+        logger.info(f'embeddings generated, count: {len(embeddings)}, elapsed time: {time.time()-t0}')
+        return self.format_openai_response(
+            embeddings,
+            encoding_format=request.get('encoding_format', 'float'),
+            embedding_dtype=request.get('embedding_dtype', 'float32')
+        )
 
     async def ainvoke(self, request: dict):
         """Async version of invoke method"""
-        return self.invoke(request)
+        if self.batcher is None:
+            return await self.run_in_inference_executor(self.invoke, request)
+
+        inputs = request['input']
+        if not inputs:
+            return []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        t0 = time.time()
+        # concurrent requests sharing the same encode kwargs are merged into one forward pass
+        embeddings = await self.batcher.submit(inputs, self._get_encode_kwargs(request))
+        logger.info(f'embeddings generated, count: {len(embeddings)}, elapsed time: {time.time()-t0}')
+        return self.format_openai_response(
+            embeddings,
+            encoding_format=request.get('encoding_format', 'float'),
+            embedding_dtype=request.get('embedding_dtype', 'float32')
+        )
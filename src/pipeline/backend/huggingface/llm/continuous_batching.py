@@ -0,0 +1,280 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional
+
+import torch
+
+from emd.utils.logger_utils import get_logger
+from utils.inference_executor import InferenceQueueFullError
+
+logger = get_logger(__name__)
+
+
+class GenerationRequest:
+    # generate kwargs handled by the continuous batching loop, other kwargs fall back to `model.generate`
+    SUPPORTED_GENERATE_KWARGS = {"max_new_tokens", "temperature", "top_p", "top_k", "do_sample", "eos_token_id"}
+
+    def __init__(self, input_ids: List[int], generate_kwargs: dict, streamer=None):
+        self.input_ids = input_ids
+        self.max_new_tokens = int(generate_kwargs.get("max_new_tokens", 512))
+        self.temperature = float(generate_kwargs.get("temperature") or 0.0)
+        self.top_p = generate_kwargs.get("top_p")
+        self.top_k = generate_kwargs.get("top_k")
+        self.do_sample = bool(generate_kwargs.get("do_sample", False))
+        eos_token_id = generate_kwargs.get("eos_token_id")
+        if eos_token_id is not None and not isinstance(eos_token_id, (list, tuple, set)):
+            eos_token_id = [eos_token_id]
+        self.eos_token_id = set(eos_token_id) if eos_token_id is not None else None
+        self.streamer = streamer
+        self.future = Future()
+        self.output_ids = []
+        self.finish_reason = None
+        self.cancelled = False
+        self.enqueue_time = time.time()
+
+    def cancel(self):
+        """Called by the consumer (e.g. a closed stream) to leave the running batch."""
+        self.cancelled = True
+        self.future.cancel()
+
+
+class ContinuousBatchingGenerator:
+    """
+    A persistent generation worker doing iteration-level (continuous) batching.
+
+    All running sequences share one left-padded KV cache and advance by one token per
+    forward pass. Waiting requests are prefilled and merged into the running batch at
+    token boundaries, finished sequences are removed from it right away. Each request
+    receives its tokens through its own streamer (`put`/`end`, e.g. `TextIteratorStreamer`)
+    and the generated token ids through its future.
+    """
+
+    def __init__(self, model, tokenizer, max_num_seqs: int = 8, max_queue_size: Optional[int] = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_num_seqs = max_num_seqs
+        self.max_queue_size = max_queue_size
+        self.device = model.device
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.default_eos_token_id = self._get_default_eos_token_id()
+        # mirror the sampling defaults `model.generate` would use
+        self.default_generate_kwargs = {
+            k: getattr(model.generation_config, k, None)
+            for k in ("do_sample", "temperature", "top_p", "top_k")
+            if getattr(model.generation_config, k, None) is not None
+        }
+        self._waiting = queue.Queue()
+        self._cache_cls = None
+        # batch state
+        self._active: List[GenerationRequest] = []
+        self._cache = None
+        self._attention_mask = None
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="continuous-batching")
+        self._thread.start()
+
+    def _get_default_eos_token_id(self):
+        eos_token_id = getattr(self.model.generation_config, "eos_token_id", None)
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        if eos_token_id is None:
+            return set()
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        return set(eos_token_id)
+
+    def submit(self, input_ids: List[int], generate_kwargs: dict, streamer=None) -> GenerationRequest:
+        if self.max_queue_size and self._waiting.qsize() >= self.max_queue_size:
+            raise InferenceQueueFullError(self.max_queue_size)
+        request = GenerationRequest(
+            input_ids,
+            {**self.default_generate_kwargs, **generate_kwargs},
+            streamer=streamer
+        )
+        if request.eos_token_id is None:
+            request.eos_token_id = self.default_eos_token_id
+        self._waiting.put(request)
+        return request
+
+    # ---------------- kv cache helpers ----------------
+    def _to_legacy_cache(self, cache):
+        if self._cache_cls is None:
+            self._cache_cls = type(cache)
+        if hasattr(cache, "to_legacy_cache"):
+            return cache.to_legacy_cache()
+        return cache
+
+    def _from_legacy_cache(self, cache):
+        if hasattr(self._cache_cls, "from_legacy_cache"):
+            return self._cache_cls.from_legacy_cache(cache)
+        return cache
+
+    @staticmethod
+    def _left_pad(tensor, length, dim, value=0):
+        pad_len = length - tensor.shape[dim]
+        if pad_len <= 0:
+            return tensor
+        pad_shape = list(tensor.shape)
+        pad_shape[dim] = pad_len
+        pad = torch.full(pad_shape, value, dtype=tensor.dtype, device=tensor.device)
+        return torch.cat([pad, tensor], dim=dim)
+
+    def _merge(self, cache, attention_mask):
+        """Merge the cache of newly prefilled sequences into the running batch."""
+        if self._cache is None:
+            self._cache, self._attention_mask = cache, attention_mask
+            return
+        length = max(self._attention_mask.shape[1], attention_mask.shape[1])
+        self._cache = tuple(
+            tuple(
+                torch.cat([self._left_pad(old, length, 2), self._left_pad(new, length, 2)], dim=0)
+                for old, new in zip(old_layer, new_layer)
+            )
+            for old_layer, new_layer in zip(self._cache, cache)
+        )
+        self._attention_mask = torch.cat(
+            [self._left_pad(self._attention_mask, length, 1), self._left_pad(attention_mask, length, 1)],
+            dim=0
+        )
+
+    def _select(self, keep: List[int]):
+        """Keep the given rows of the running batch and drop the columns padded for all of them."""
+        if not keep:
+            self._cache, self._attention_mask = None, None
+            return
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        start = int(attention_mask.any(dim=0).nonzero()[0])
+        self._attention_mask = attention_mask[:, start:]
+        self._cache = tuple(
+            tuple(t.index_select(0, index.to(t.device))[:, :, start:] for t in layer)
+            for layer in self._cache
+        )
+
+    # ---------------- generation ----------------
+    def _sample(self, logits, requests: List[GenerationRequest]) -> List[int]:
+        logits = logits.float()
+        next_tokens = []
+        for row, request in zip(logits, requests):
+            if not request.do_sample or request.temperature <= 1e-5:
+                next_tokens.append(int(row.argmax()))
+                continue
+            row = row / request.temperature
+            if request.top_k:
+                top_k = min(int(request.top_k), row.shape[-1])
+                threshold = torch.topk(row, top_k).values[-1]
+                row = row.masked_fill(row < threshold, float("-inf"))
+            if request.top_p is not None and request.top_p < 1.0:
+                sorted_logits, sorted_index = torch.sort(row, descending=True)
+                cum_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+                remove = cum_probs > request.top_p
+                # always keep the most probable token
+                remove[1:] = remove[:-1].clone()
+                remove[0] = False
+                row = row.masked_fill(remove.scatter(0, sorted_index, remove), float("-inf"))
+            next_tokens.append(int(torch.multinomial(row.softmax(dim=-1), 1)))
+        return next_tokens
+
+    def _forward(self, input_ids, attention_mask, position_ids, cache=None):
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._from_legacy_cache(cache) if cache is not None else None,
+            use_cache=True,
+        )
+        return outputs.logits[:, -1, :], self._to_legacy_cache(outputs.past_key_values)
+
+    def _prefill(self, requests: List[GenerationRequest]):
+        length = max(len(request.input_ids) for request in requests)
+        input_ids = torch.tensor(
+            [[self.pad_token_id] * (length - len(r.input_ids)) + r.input_ids for r in requests],
+            device=self.device
+        )
+        attention_mask = torch.tensor(
+            [[0] * (length - len(r.input_ids)) + [1] * len(r.input_ids) for r in requests],
+            device=self.device
+        )
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        logits, cache = self._forward(input_ids, attention_mask, position_ids)
+        self._merge(cache, attention_mask)
+        self._active.extend(requests)
+        self._append_tokens(requests, self._sample(logits, requests))
+
+    def _decode(self):
+        input_ids = torch.tensor(
+            [[request.output_ids[-1]] for request in self._active],
+            device=self.device
+        )
+        self._attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((len(self._active), 1))],
+            dim=1
+        )
+        position_ids = self._attention_mask.sum(-1, keepdim=True) - 1
+        logits, self._cache = self._forward(input_ids, self._attention_mask, position_ids, cache=self._cache)
+        self._append_tokens(self._active, self._sample(logits, self._active))
+
+    def _append_tokens(self, requests: List[GenerationRequest], tokens: List[int]):
+        for request, token in zip(requests, tokens):
+            if token in request.eos_token_id:
+                request.finish_reason = "stop"
+                continue
+            request.output_ids.append(token)
+            if request.streamer is not None:
+                request.streamer.put(torch.tensor([token]))
+            if len(request.output_ids) >= request.max_new_tokens:
+                request.finish_reason = "length"
+
+    def _finish(self, request: GenerationRequest, exception: Exception = None):
+        if request.streamer is not None:
+            request.streamer.end()
+        if request.future.done():
+            return
+        if exception is not None:
+            request.future.set_exception(exception)
+        else:
+            request.future.set_result(request.output_ids)
+
+    def _remove_finished(self):
+        keep = []
+        for index, request in enumerate(self._active):
+            if request.finish_reason is not None or request.cancelled:
+                self._finish(request)
+            else:
+                keep.append(index)
+        if len(keep) != len(self._active):
+            self._active = [self._active[index] for index in keep]
+            self._select(keep)
+
+    def _admit(self) -> List[GenerationRequest]:
+        admitted = []
+        while len(self._active) + len(admitted) < self.max_num_seqs:
+            try:
+                # block only when there is nothing to decode
+                request = self._waiting.get(block=not (self._active or admitted))
+            except queue.Empty:
+                break
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            admitted.append(request)
+        return admitted
+
+    @torch.inference_mode()
+    def _loop(self):
+        while True:
+            admitted = self._admit()
+            try:
+                if admitted:
+                    # new requests join the running batch at a token boundary
+                    self._prefill(admitted)
+                    self._remove_finished()
+                if self._active:
+                    self._decode()
+                    self._remove_finished()
+            except Exception as e:
+                logger.exception(f"continuous batching step failed: {e}")
+                for request in self._active + [r for r in admitted if r not in self._active]:
+                    self._finish(request, exception=e)
+                self._active = []
+                self._cache, self._attention_mask = None, None
@@ -13,6 +13,9 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers import TextIteratorStreamer
 from threading import Thread
 import json
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+from backend.huggingface.llm.continuous_batching import ContinuousBatchingGenerator, GenerationRequest
 
 
 logger = get_logger(__name__)
@@ -35,7 +38,17 @@ class TransformerLLMBackend(BackendBase):
         self.tokenizer = None
         self.pretrained_model_init_kwargs = self.execute_model.executable_config.current_engine.pretrained_model_init_kwargs or {}
         self.pretrained_tokenizer_init_kwargs = self.execute_model.executable_config.current_engine.pretrained_tokenizer_init_kwargs or {}
+        self.continuous_batching = getattr(self.execute_model.executable_config.current_engine, "continuous_batching", False)
+        self.max_num_seqs = getattr(self.execute_model.executable_config.current_engine, "max_num_seqs", 8)
+        self.generator = None
 
+    @property
+    def engine_max_concurrency(self) -> int:
+        max_concurrency = getattr(self.execute_model.executable_config.current_engine, "max_concurrency", None)
+        if self.continuous_batching and not max_concurrency:
+            # the generation loop runs up to `max_num_seqs` sequences, the others wait in its queue
+            return self.max_num_seqs
+        return super().engine_max_concurrency
 
     def start(self):
         model_dir = os.environ.get("MODEL_DIR") or EMD_MODELS_LOCAL_DIR_TEMPLATE.format(model_id=self.model_id)
@@ -63,9 +76,17 @@ class TransformerLLMBackend(BackendBase):
             model_abs_path,
             **self.pretrained_tokenizer_init_kwargs
         )
+        if self.continuous_batching:
+            self.generator = ContinuousBatchingGenerator(
+                self.model,
+                self.tokenizer,
+                max_num_seqs=self.max_num_seqs,
+                max_queue_size=self.inference_executor.max_queue_size
+            )
+            logger.info(f"continuous batching enabled, max_num_seqs: {self.max_num_seqs}")
 
 
-    def format_response_as_openai(self,response:str):
+    def format_response_as_openai(self,response:str,finish_reason="stop"):
         return {
             # "id": "chatcmpl-123",
             "object": "chat.completion",
@@ -79,7 +100,7 @@ class TransformerLLMBackend(BackendBase):
                 "content": response,
                 },
                 "logprobs": None,
-                "finish_reason": "stop"
+                "finish_reason": finish_reason
             }],
             # "service_tier": "default",
             # "usage": {
@@ -94,8 +115,8 @@ class TransformerLLMBackend(BackendBase):
             # }
         }
 
-    def format_stream_response_as_openai(self, chunk_response:str,is_last=False):
-        finish_reason = "stop" if is_last else None
+    def format_stream_response_as_openai(self, chunk_response:str,is_last=False,finish_reason="stop"):
+        finish_reason = finish_reason if is_last else None
         return {
             # "id":"chatcmpl-123",
             "object":"chat.completion.chunk",
@@ -114,7 +135,7 @@ class TransformerLLMBackend(BackendBase):
 
 
 
-    def invoke(self, request:dict):
+    def _prepare_inputs(self, request:dict):
         generate_kwargs = {
             "max_new_tokens":512,
             "temperature":0.01
@@ -133,6 +154,61 @@ class TransformerLLMBackend(BackendBase):
             add_generation_prompt=True,
             **tokenize_kwargs
         )
+        return text, generate_kwargs
+
+    def _use_continuous_batching(self, generate_kwargs:dict):
+        # generate kwargs like num_beams are only supported by `model.generate`
+        return self.generator is not None and \
+            set(generate_kwargs).issubset(GenerationRequest.SUPPORTED_GENERATE_KWARGS)
+
+    def _submit_generation(self, request:dict, text:str, generate_kwargs:dict):
+        input_ids = self.tokenizer(text)["input_ids"]
+        logger.info(f'request: {request}')
+        logger.info(f"input tokens: {len(input_ids)}, generate_kwargs: {generate_kwargs}")
+        streamer = None
+        if request.get('stream',False):
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=False, skip_special_tokens=True)
+        return self.generator.submit(input_ids, generate_kwargs, streamer=streamer)
+
+    def _format_generation_response(self, generation:GenerationRequest, output_ids:list[int]):
+        response = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+        response = self.format_response_as_openai(response, finish_reason=generation.finish_reason or "stop")
+        logger.info(f'response: {response}')
+        return response
+
+    def _streamer_return_helper(self, streamer, generation:GenerationRequest=None):
+        history_response = ""
+        try:
+            for new_text in streamer:
+                history_response += new_text
+                new_text = self.format_stream_response_as_openai(new_text)
+                if self.service_type == ServiceType.SAGEMAKER:
+                    yield json.dumps(new_text) + "\n"
+                else:
+                    yield new_text
+        finally:
+            # leave the running batch if the client goes away
+            if generation is not None:
+                generation.cancel()
+
+        finish_reason = "stop"
+        if generation is not None:
+            finish_reason = generation.finish_reason or "stop"
+        new_text = self.format_stream_response_as_openai("",is_last=True,finish_reason=finish_reason)
+        if self.service_type == ServiceType.SAGEMAKER:
+            yield json.dumps(new_text) + "\n"
+        else:
+            yield new_text
+        logger.info(f'response: {self.format_response_as_openai(history_response,finish_reason=finish_reason)}')
+
+    def invoke(self, request:dict):
+        text, generate_kwargs = self._prepare_inputs(request)
+        if self._use_continuous_batching(generate_kwargs):
+            generation = self._submit_generation(request, text, generate_kwargs)
+            if request.get('stream',False):
+                return self._streamer_return_helper(generation.streamer, generation)
+            return self._format_generation_response(generation, generation.future.result())
+
         model_inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
         logger.info(f'request: {request}')
         logger.info(f"model_inputs: {model_inputs}, generate_kwargs: {generate_kwargs}")
@@ -160,21 +236,23 @@ class TransformerLLMBackend(BackendBase):
         }
         thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
         thread.start()
-        def streamer_return_helper():
-            history_response = ""
-            for new_text in streamer:
-                history_response += new_text
-                new_text = self.format_stream_response_as_openai(new_text)
-                if self.service_type == ServiceType.SAGEMAKER:
-                    yield json.dumps(new_text) + "\n"
-                else:
-                    yield new_text
+        return self._streamer_return_helper(streamer)
 
-            new_text = self.format_stream_response_as_openai("",is_last=True)
-            if self.service_type == ServiceType.SAGEMAKER:
-                yield json.dumps(new_text) + "\n"
-            else:
-                yield new_text
-            logger.info(f'response: {self.format_response_as_openai(history_response)}')
+    async def ainvoke(self, request:dict):
+        if self.generator is None:
+            return await super().ainvoke(request)
+        text, generate_kwargs = await run_in_threadpool(self._prepare_inputs, request)
+        if not self._use_continuous_batching(generate_kwargs):
+            return await super().ainvoke(request)
 
-        return streamer_return_helper()
+        generation = await run_in_threadpool(self._submit_generation, request, text, generate_kwargs)
+        if request.get('stream',False):
+            return self._streamer_return_helper(generation.streamer, generation)
+        # wait for the shared generation loop without holding an inference worker
+        try:
+            output_ids = await asyncio.wrap_future(generation.future)
+        except asyncio.CancelledError:
+            # the future is already running, leave the batch instead of generating for nobody
+            generation.cancel()
+            raise
+        return self._format_generation_response(generation, output_ids)
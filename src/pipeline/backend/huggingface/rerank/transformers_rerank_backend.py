@@ -11,6 +11,8 @@ from emd.constants import EMD_MODELS_LOCAL_DIR_TEMPLATE
 from emd.utils.logger_utils import get_logger
 from threading import Thread
 import json
+import numpy as np
+from fastapi import HTTPException
 from transformers import AutoModelForSequenceClassification
 
 
@@ -32,6 +34,7 @@ class TransformerRerankBackend(BackendBase):
         self.proc = None
         self.model = None
         self.pretrained_model_init_kwargs = self.execute_model.executable_config.current_engine.pretrained_model_init_kwargs or {}
+        self.rerank_batch_size = getattr(self.execute_model.executable_config.current_engine, "rerank_batch_size", 32)
 
 
     def start(self):
@@ -69,35 +72,76 @@ class TransformerRerankBackend(BackendBase):
         # )
 
 
-    def format_vllm_response(self,documents:list[str],scores:list[float]):
+    def format_vllm_response(self,documents:list[str],scores:list[float],indices:list[int]=None,return_documents=True):
+        if indices is None:
+            indices = range(len(documents))
+        results = []
+        for index in indices:
+            result = {
+                "index": index,
+                "relevance_score": scores[index]
+            }
+            if return_documents:
+                result["document"] = {
+                    "text": documents[index]
+                }
+            results.append(result)
         return {
             "id": None,
             "model": self.model_id,
             "usage": {
                 "total_tokens": None
             },
-            "results": [
-                {
-                "index": index,
-                "document": {
-                    "text": doc
-                },
-                "relevance_score": score
-                }
-                for index,(doc,score) in enumerate(zip(documents,scores))
-            ]
+            "results": results
         }
 
+    def compute_scores(self, query:str, documents:list[str]) -> list[float]:
+        """Score all documents in length sorted mini batches to bound memory and padding."""
+        order = sorted(range(len(documents)), key=lambda i: len(documents[i]))
+        scores = [None] * len(documents)
+        for start in range(0, len(order), self.rerank_batch_size):
+            chunk = order[start:start + self.rerank_batch_size]
+            chunk_scores = self.model.compute_score([[query, documents[i]] for i in chunk])
+            if hasattr(chunk_scores, "tolist"):
+                chunk_scores = chunk_scores.tolist()
+            if not isinstance(chunk_scores, list):
+                chunk_scores = [chunk_scores]
+            for i, score in zip(chunk, chunk_scores):
+                scores[i] = float(score)
+        return scores
+
+    @staticmethod
+    def top_n_indices(scores:list[float], top_n:int) -> list[int]:
+        """Indices of the `top_n` (at least 1) highest scores in descending order, using a partial sort."""
+        if top_n < 1:
+            raise ValueError(f"top_n must be at least 1, got {top_n}")
+        scores = np.asarray(scores)
+        top_n = min(top_n, len(scores))
+        if top_n < len(scores):
+            candidates = np.argpartition(-scores, top_n - 1)[:top_n]
+        else:
+            candidates = np.arange(len(scores))
+        return candidates[np.argsort(-scores[candidates], kind="stable")].tolist()
+
     def invoke(self, request:dict):
         query:list = request['query']
         documents:list[str] = request['documents']
         assert isinstance(query, str) and isinstance(documents, list) \
             and query and documents,(query,documents)
+        top_n = request.get('top_n')
+        if top_n is not None:
+            try:
+                top_n = int(top_n)
+            except (TypeError, ValueError):
+                top_n = 0
+            if top_n < 1:
+                raise HTTPException(status_code=400, detail=f"top_n must be a positive integer, got {request['top_n']}")
+        return_documents = request.get('return_documents', True)
 
-        sentence_pairs = [[query, doc] for doc in documents]
         t0 = time.time()
-        scores = self.model.compute_score(sentence_pairs)
-        if not isinstance(scores,list):
-            scores = [scores]
-        logger.info(f'rerank res: {scores},\nelapsed time: {time.time()-t0}')
-        return self.format_vllm_response(documents, scores)
+        scores = self.compute_scores(query, documents)
+        logger.info(f'rerank documents: {len(documents)},\nelapsed time: {time.time()-t0}')
+        indices = None
+        if top_n is not None:
+            indices = self.top_n_indices(scores, top_n)
+        return self.format_vllm_response(documents, scores, indices=indices, return_documents=return_documents)
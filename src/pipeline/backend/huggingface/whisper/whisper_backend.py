@@ -13,8 +13,14 @@ import boto3
 import botocore
 import json
 import os
+import threading
+import subprocess
+import dataclasses
+from collections import OrderedDict
+import numpy as np
+import torch
 from emd.models.utils.logger_utils import get_logger
-from concurrent.futures import ProcessPoolExecutor,as_completed
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor,as_completed
 
 logger = get_logger(__name__)
 
@@ -56,61 +62,391 @@ def find_overlaps_with_threshold(list_a, list_b, min_overlap=0.1):
     return matches
 
 
-def inference(source, model_type, **decode_options):
-    logger.info(f"source:{source}")
-    logger.info(f"decode_options:{decode_options}")
+class WhisperModelCache:
+    """
+    Keep loaded whisper models resident across requests, keyed by `model_type`.
 
-    # decode_options = {
-    #               "language":language,
-    #               "temperature":0.1,
-    #               # "sample_len":30,
-    #               "best_of":5,
-    #               "beam_size":5,
-    #               "patience":3.0,
-    #               "word_timestamps":True,
-    #               "no_speech_threshold":0.6,
-    #               "logprob_threshold":None,
-    #               "compression_ratio_threshold":2.4,
-    #               "condition_on_previous_text":False,
-    #              }
+    The least recently used model is evicted when `max_cached_models` is reached or when
+    the free GPU memory ratio drops below `min_free_gpu_memory_ratio` before loading a new one.
+    """
 
-    model = whisper.load_model(
-        model_type, download_root="/opt/ml/code/models/", in_memory=True, device="cuda"
-    )
-    result = model.transcribe(source, **decode_options)
+    def __init__(self, max_cached_models=2, min_free_gpu_memory_ratio=0.2):
+        self.max_cached_models = max_cached_models
+        self.min_free_gpu_memory_ratio = min_free_gpu_memory_ratio
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
 
-    # language detection
-    audio = whisper.load_audio(source)
+    @staticmethod
+    def _free_gpu_memory_ratio():
+        if not torch.cuda.is_available():
+            return 1.0
+        free, total = torch.cuda.mem_get_info()
+        return free / total
+
+    def _evict(self):
+        model_type, _ = self._models.popitem(last=False)
+        torch.cuda.empty_cache()
+        logger.info(f"evicted whisper model: {model_type}, free gpu memory ratio: {self._free_gpu_memory_ratio():.2f}")
+
+    def get(self, model_type):
+        with self._lock:
+            if model_type in self._models:
+                self._models.move_to_end(model_type)
+                return self._models[model_type]
+            while self._models and (
+                len(self._models) >= self.max_cached_models
+                or self._free_gpu_memory_ratio() < self.min_free_gpu_memory_ratio
+            ):
+                self._evict()
+            logger.info(f"loading whisper model: {model_type}")
+            model = whisper.load_model(
+                model_type, download_root="/opt/ml/code/models/", in_memory=True, device="cuda"
+            )
+            self._models[model_type] = model
+            return model
+
+
+model_cache = WhisperModelCache()
+
+_vad_models = {}
+_vad_lock = threading.Lock()
+
+
+def get_vad_model(lang):
+    """Load the VAD model once and keep it resident, FunASR for Chinese and silero otherwise."""
+    vad_type = "funasr" if lang == "zh" else "silero"
+    with _vad_lock:
+        if vad_type not in _vad_models:
+            if vad_type == "funasr":
+                _vad_models[vad_type] = FunasrModel(
+                    model="/opt/ml/code/models/vad_model", model_revision="v2.0.4"
+                )
+            else:
+                _vad_models[vad_type] = load_silero_vad()
+        return _vad_models[vad_type]
+
+
+def detect_language(model, audio):
     mel = whisper.log_mel_spectrogram(
         audio, model.dims.n_mels, padding=whisper.audio.N_SAMPLES
     ).to(model.device)
     mel_segment = whisper.pad_or_trim(mel, whisper.audio.N_FRAMES)
     _, probs = model.detect_language(mel_segment)
-    lang = max(probs, key=probs.get)
+    return max(probs, key=probs.get)
+
 
+def detect_speech_timestamps(audio, lang):
+    """Speech timestamps in seconds of a 16kHz mono waveform."""
+    vad_model = get_vad_model(lang)
     if lang == "zh":
-        vad_model = FunasrModel(
-            model="/opt/ml/code/models/vad_model", model_revision="v2.0.4"
-        )
-        res = vad_model.generate(input=source)
+        res = vad_model.generate(input=audio, fs=whisper.audio.SAMPLE_RATE)
         speech_timestamps = []
         for row in res[0]["value"]:
             speech_timestamps.append({"start": row[0] / 1000, "end": row[1] / 1000})
     else:
-        vad_model = load_silero_vad()
-        wav = read_audio(source)
         speech_timestamps = get_speech_timestamps(
-            wav,
+            torch.from_numpy(audio),
             vad_model,
             return_seconds=True,
             threshold=0.2,  # Return speech timestamps in seconds (default is samples)
         )
+    return speech_timestamps
+
+
+def split_audio_chunks(speech_timestamps, total_duration, max_chunk_duration=30.0):
+    """
+    Group speech timestamps into chunks of at most `max_chunk_duration` seconds.
+
+    Chunks are cut at the silences between speech timestamps, a single speech segment
+    longer than `max_chunk_duration` is cut evenly.
+    """
+    chunks = []
+    for ts in speech_timestamps:
+        start, end = max(ts["start"], 0), min(ts["end"], total_duration)
+        if end <= start:
+            continue
+        if chunks and end - chunks[-1][0] <= max_chunk_duration:
+            chunks[-1][1] = end
+            continue
+        num = int(np.ceil((end - start) / max_chunk_duration))
+        step = (end - start) / num
+        for i in range(num):
+            chunks.append([start + i * step, start + (i + 1) * step])
+    return [(start, end) for start, end in chunks]
+
+
+def _get_decoding_options(decode_options):
+    option_names = {f.name for f in dataclasses.fields(whisper.DecodingOptions)}
+    options = {k: v for k, v in decode_options.items() if k in option_names}
+    temperature = options.get("temperature", 0.0)
+    if isinstance(temperature, (list, tuple)):
+        # no temperature fallback in batched decoding, use the first one
+        temperature = temperature[0]
+    options["temperature"] = temperature
+    # the same rules `whisper.transcribe` applies for every temperature
+    if temperature > 0:
+        options.pop("beam_size", None)
+        options.pop("patience", None)
+    else:
+        options.pop("best_of", None)
+    options["without_timestamps"] = False
+    return whisper.DecodingOptions(**options)
+
+
+TIME_PRECISION = 0.02
+
+
+def _split_timestamped_tokens(tokenizer, tokens, offset, duration):
+    """Cut the decoded tokens of one chunk into segments at the timestamp tokens."""
+    segments = []
+    start = 0.0
+    text_tokens = []
+    for token in tokens:
+        if token < tokenizer.timestamp_begin:
+            text_tokens.append(token)
+            continue
+        timestamp = (token - tokenizer.timestamp_begin) * TIME_PRECISION
+        if text_tokens:
+            segments.append((start, timestamp, text_tokens))
+            text_tokens = []
+        start = timestamp
+    if text_tokens:
+        segments.append((start, duration, text_tokens))
+    return [
+        {
+            "start": round(offset + start, 3),
+            "end": round(offset + min(end, duration), 3),
+            "text": tokenizer.decode(text_tokens),
+            "tokens": text_tokens,
+        }
+        for start, end, text_tokens in segments
+    ]
+
+
+@torch.inference_mode()
+def transcribe_chunks(model_type, chunks, decode_options):
+    """
+    Transcribe a batch of audio chunks (each at most 30 seconds) with a single `whisper.decode` call.
+
+    `chunks` is a list of `(offset, waveform)`, the returned segments are shifted by the chunk offset.
+    """
+    model = model_cache.get(model_type)
+    options = _get_decoding_options(decode_options)
+    mel = torch.stack([
+        whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels)
+        for _, audio in chunks
+    ]).to(model.device)
+    results = whisper.decode(model, mel, options)
+    no_speech_threshold = decode_options.get("no_speech_threshold", 0.6)
+    logprob_threshold = decode_options.get("logprob_threshold", -1.0)
+    segments = []
+    for (offset, audio), result in zip(chunks, results):
+        if (
+            no_speech_threshold is not None
+            and result.no_speech_prob > no_speech_threshold
+            and (logprob_threshold is None or result.avg_logprob < logprob_threshold)
+        ):
+            continue
+        tokenizer = whisper.tokenizer.get_tokenizer(
+            model.is_multilingual,
+            num_languages=model.num_languages,
+            language=result.language,
+            task=options.task,
+        )
+        for segment in _split_timestamped_tokens(
+            tokenizer, result.tokens, offset, len(audio) / whisper.audio.SAMPLE_RATE
+        ):
+            segment.update(
+                temperature=options.temperature,
+                avg_logprob=result.avg_logprob,
+                compression_ratio=result.compression_ratio,
+                no_speech_prob=result.no_speech_prob,
+            )
+            segments.append(segment)
+    return segments
+
+
+def _detect_language_worker(model_type, audio):
+    return detect_language(model_cache.get(model_type), audio)
+
+
+def _init_worker(gpu_ids):
+    # pin every worker process to its own gpu
+    gpu_id = gpu_ids.get()
+    torch.cuda.set_device(gpu_id)
+    logger.info(f"whisper worker started on gpu: {gpu_id}")
+
+
+def transcribe_long_audio(
+        audio,
+        model_type,
+        max_chunk_duration=30.0,
+        batch_size=16,
+        executor=None,
+        **decode_options
+    ):
+    """
+    Long audio mode: run vad first, cut the audio at silences into bounded chunks, transcribe
+    the chunks in batches and stitch the segments back with the timestamps of the whole audio.
+    Batches are spread over the worker processes of `executor` when given.
+    """
+    t0 = time.time()
+    sample_rate = whisper.audio.SAMPLE_RATE
+    total_duration = len(audio) / sample_rate
+    lang = decode_options.get("language")
+    if lang is None:
+        first_window = audio[:whisper.audio.N_SAMPLES]
+        if executor is not None:
+            lang = executor.submit(_detect_language_worker, model_type, first_window).result()
+        else:
+            lang = _detect_language_worker(model_type, first_window)
+        decode_options = {**decode_options, "language": lang}
+
+    speech_timestamps = detect_speech_timestamps(audio, lang)
+    chunks = [
+        (start, audio[int(start * sample_rate):int(end * sample_rate)])
+        for start, end in split_audio_chunks(speech_timestamps, total_duration, max_chunk_duration)
+    ]
+    batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
+    logger.info(
+        f"long audio mode, duration: {total_duration:.1f}s, language: {lang}, "
+        f"chunks: {len(chunks)}, batches: {len(batches)}"
+    )
+    if executor is not None:
+        futures = [executor.submit(transcribe_chunks, model_type, batch, decode_options) for batch in batches]
+        batch_segments = [future.result() for future in futures]
+    else:
+        batch_segments = [transcribe_chunks(model_type, batch, decode_options) for batch in batches]
+
+    segments = [segment for segments in batch_segments for segment in segments]
+    segments = find_overlaps_with_threshold(segments, speech_timestamps)
+    for index, item in enumerate(segments):
+        item["id"] = index
+    logger.info(f"long audio transcribed, elapsed time: {time.time()-t0:.2f}s")
+    return {
+        "text": "".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "language": lang,
+    }
+
+
+# iso media containers usually keep their index (moov atom) at the end of the file,
+# ffmpeg can not decode them from a pipe
+UNSTREAMABLE_AUDIO_EXTENSIONS = (".mp4", ".m4a", ".m4v", ".mov", ".3gp", ".3g2")
+
+
+def is_streamable_audio(key):
+    return not key.lower().endswith(UNSTREAMABLE_AUDIO_EXTENSIONS)
+
+
+def load_audio_from_s3(s3_client, bucket, key, size=None, part_size=8 * 1024 * 1024, max_concurrency=4):
+    """
+    Decode an s3 object to a 16kHz mono waveform without a local file.
+
+    The object is fetched in ranged parts (up to `max_concurrency` parts in flight) which are
+    written in order into the stdin of ffmpeg, so decoding starts with the first part.
+    Raises `RuntimeError` when ffmpeg can not decode the stream, e.g. for mp4 files with
+    the index at the end which need a seekable input.
+    """
+    if size is None:
+        size = s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le",
+        "-ar", str(whisper.audio.SAMPLE_RATE), "-"
+    ]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def get_part(start):
+        end = min(start + part_size, size) - 1
+        return s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")["Body"].read()
+
+    feed_error = []
+
+    def feed():
+        try:
+            with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+                # the pool keeps the order of the parts, at most `max_concurrency` parts are buffered
+                starts = iter(range(0, size, part_size))
+                futures = [pool.submit(get_part, start) for _, start in zip(range(max_concurrency), starts)]
+                while futures:
+                    data = futures.pop(0).result()
+                    next_start = next(starts, None)
+                    if next_start is not None:
+                        futures.append(pool.submit(get_part, next_start))
+                    process.stdin.write(data)
+        except BrokenPipeError:
+            # ffmpeg exited early, the error is reported from its return code
+            pass
+        except Exception as e:
+            feed_error.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    # stderr is drained by a thread as well, otherwise ffmpeg blocks when the pipe buffer is full
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+    out = process.stdout.read()
+    process.wait()
+    feeder.join()
+    stderr_reader.join()
+    if feed_error:
+        raise feed_error[0]
+    if process.returncode != 0:
+        raise RuntimeError(f"Failed to decode s3://{bucket}/{key} from stream: {b''.join(stderr_chunks).decode(errors='ignore')[-1000:]}")
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def inference(audio, model_type, long_audio_config=None, **decode_options):
+    logger.info(f"audio duration: {len(audio) / whisper.audio.SAMPLE_RATE:.2f}s")
+    logger.info(f"decode_options:{decode_options}")
+
+    # decode_options = {
+    #               "language":language,
+    #               "temperature":0.1,
+    #               # "sample_len":30,
+    #               "best_of":5,
+    #               "beam_size":5,
+    #               "patience":3.0,
+    #               "word_timestamps":True,
+    #               "no_speech_threshold":0.6,
+    #               "logprob_threshold":None,
+    #               "compression_ratio_threshold":2.4,
+    #               "condition_on_previous_text":False,
+    #              }
+
+    # the waveform is decoded once and shared by transcription, language detection and vad
+    long_audio_config = long_audio_config or {}
+    min_duration = long_audio_config.get("min_duration")
+    if min_duration is not None and len(audio) / whisper.audio.SAMPLE_RATE >= min_duration:
+        result = transcribe_long_audio(
+            audio,
+            model_type,
+            max_chunk_duration=long_audio_config.get("chunk_duration", 30.0),
+            batch_size=long_audio_config.get("batch_size", 16),
+            executor=long_audio_config.get("executor"),
+            **decode_options
+        )
+        return result
+
+    model = model_cache.get(model_type)
+    result = model.transcribe(audio, **decode_options)
+
+    # language detection
+    lang = detect_language(model, audio)
+
+    speech_timestamps = detect_speech_timestamps(audio, lang)
     segments = find_overlaps_with_threshold(result["segments"], speech_timestamps)
     for index, item in enumerate(segments):
         item["id"] = index
     result["segments"] = segments
-    logger.info("<<<<result:",result)
-    os.remove(source)
+    logger.info(f"<<<<result: {result}")
     return result
 
 class WhisperBackend(BackendBase):
@@ -120,12 +456,50 @@ class WhisperBackend(BackendBase):
               **kwargs
         )
         self.s3_client = None
+        self.long_audio_config = {}
+        self.worker_executor = None
+        self.stream_max_size = None
+        self.stream_part_size = 8 * 1024 * 1024
 
     def start(self):
         client_config = botocore.config.Config(
             max_pool_connections=50, connect_timeout=3600, read_timeout=3600
         )
         self.s3_client = boto3.client("s3", config=client_config)
+        current_engine = self.execute_model.executable_config.current_engine
+        model_cache.max_cached_models = getattr(current_engine, "max_cached_models", model_cache.max_cached_models)
+        model_cache.min_free_gpu_memory_ratio = getattr(
+            current_engine, "min_free_gpu_memory_ratio", model_cache.min_free_gpu_memory_ratio
+        )
+        # warm up the vad models, they are small and used by every request
+        for lang in ("zh", "en"):
+            try:
+                get_vad_model(lang)
+            except Exception as e:
+                logger.warning(f"Failed to preload vad model for {lang}: {e}")
+
+        self.stream_max_size = getattr(current_engine, "s3_stream_max_size", self.stream_max_size)
+        self.stream_part_size = getattr(current_engine, "s3_stream_part_size", self.stream_part_size)
+        self.long_audio_config = {
+            "min_duration": getattr(current_engine, "long_audio_min_duration", None),
+            "chunk_duration": getattr(current_engine, "long_audio_chunk_duration", 30.0),
+            "batch_size": getattr(current_engine, "long_audio_batch_size", 16),
+        }
+        num_workers = getattr(current_engine, "long_audio_num_workers", None)
+        if num_workers is None:
+            num_workers = torch.cuda.device_count()
+        if self.long_audio_config["min_duration"] is not None and num_workers > 1:
+            # one worker process per gpu for the chunk batches of long audios
+            gpu_ids = ctx.Queue()
+            for gpu_id in range(num_workers):
+                gpu_ids.put(gpu_id % max(torch.cuda.device_count(), 1))
+            self.worker_executor = ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=ctx,
+                initializer=_init_worker,
+                initargs=(gpu_ids,)
+            )
+            self.long_audio_config["executor"] = self.worker_executor
         return
 
     def invoke(self, request:dict):
@@ -142,14 +516,31 @@ class WhisperBackend(BackendBase):
         bucket = s3_url.replace("s3://", "").split("/")[0]
         file_prefix = s3_url.replace(f"s3://{bucket}/", "")
 
-        logger.info(f"<<<<download video file: {download_file_name}")
-        try:
-            s3_client.download_file(bucket, file_prefix, download_file_name)
-        except Exception as e:
-            logger.error("<<<<download error:", e)
-            return {'status': 'bad response'}
+        audio = None
+        if self.stream_max_size and is_streamable_audio(file_prefix):
+            try:
+                size = self.s3_client.head_object(Bucket=bucket, Key=file_prefix)["ContentLength"]
+                if size <= self.stream_max_size:
+                    logger.info(f"<<<<stream decoding: {s3_url}, size: {size}")
+                    audio = load_audio_from_s3(
+                        self.s3_client, bucket, file_prefix, size=size, part_size=self.stream_part_size
+                    )
+            except Exception as e:
+                logger.warning(f"stream decoding failed, fall back to download: {e}")
+
+        if audio is None:
+            logger.info(f"<<<<download video file: {download_file_name}")
+            try:
+                self.s3_client.download_file(bucket, file_prefix, download_file_name)
+            except Exception as e:
+                logger.error(f"<<<<download error: {e}")
+                return {'status': 'bad response'}
+            logger.info(f"<<<<download success: {download_file_name}")
+            try:
+                audio = whisper.load_audio(download_file_name)
+            finally:
+                os.remove(download_file_name)
 
-        print("download success")
         # my_process = ctx.Process(
         #     target=inference,
         #     args=(download_file_name, output_bucket, output_key, model_type),
@@ -157,10 +548,22 @@ class WhisperBackend(BackendBase):
         # )
         # my_process.start()
         logger.info(">>>>>>>>>processing!!!")
-        result = inference(download_file_name, model_type, **decode_options)
+        long_audio_config = self.long_audio_config
+        if data.get("long_audio") is not None:
+            # per request switch, `True` forces the long audio mode, `False` disables it
+            long_audio_config = {
+                **long_audio_config,
+                "min_duration": 0 if data["long_audio"] else None
+            }
+        result = inference(
+            audio,
+            model_type,
+            long_audio_config=long_audio_config,
+            **decode_options
+        )
         # time.sleep(10)
         # return {'status': 'processing'}
         return result
 
     def load_model(self, model_type:str):
-        return
+        return model_cache.get(model_type)
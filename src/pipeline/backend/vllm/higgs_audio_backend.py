@@ -59,28 +59,3 @@ class HiggsAudioBackend(OpenAICompitableProxyBackendBase):
             return self._transform_streaming_response(response)
         else:
             return self._transform_response(response)
-
-    async def ainvoke(self, request):
-        """
-        Async invoke the Higgs Audio model with OpenAI-compatible API.
-        """
-        # Transform input to Higgs Audio format
-        request = self._transform_request(request)
-
-        logger.info(f"Higgs Audio async request: {request}")
-
-        # Handle different model types - Higgs Audio is primarily for audio generation
-        if self.model_type == ModelType.AUDIO:
-            # Use chat completions endpoint for audio generation
-            response = await self.openai_create_helper(self.async_client.chat.completions.create, request)
-        else:
-            # Fallback to standard chat completions
-            response = await self.openai_create_helper(self.async_client.chat.completions.create, request)
-
-        logger.info(f"Higgs Audio async response: {response}, request: {request}")
-
-        if request.get("stream", False):
-            logger.info(f"Higgs Audio streaming response: {response}")
-            return await self._atransform_streaming_response(response)
-        else:
-            return await self._atransform_response(response)
@@ -58,35 +58,3 @@ class VLLMBackend(OpenAICompitableProxyBackendBase):
             return self._transform_streaming_response(response)
         else:
             return self._transform_response(response)
-
-    async def ainvoke(self, request):
-        # Transform input to vllm format
-        request = self._transform_request(request)
-        # Invoke vllm
-        logger.info(f"Chat request:{request}")
-        if self.model_type == ModelType.EMBEDDING:
-            # print('cal embedding....')
-            response = await self.openai_create_helper(self.async_client.embeddings.create,request)
-            # print('end cal embedding....')
-        elif self.model_type == ModelType.RERANK:
-            headers = {
-                "accept": "application/json",
-                "Accept-Type": "application/json",
-            }
-            response = httpx.post(
-                f'{self.base_url}/rerank',
-                json=request,
-                headers=headers
-            ).json()
-        else:
-            response = await self.openai_create_helper(
-                self.async_client.chat.completions.create,
-                request
-            )
-        logger.info(f"response:{response},{request}")
-
-        if request.get("stream", False):
-            logger.info(f"engine streaming response {response}")
-            return await self._atransform_streaming_response(response)
-        else:
-            return await self._atransform_response(response)
@@ -1,5 +1,7 @@
 import os
 import sys
+import gzip
+import json
 import uvicorn
 import argparse
 import logging
@@ -8,9 +10,14 @@ from emd.models.utils.constants import FrameworkType
 from emd.models.utils.serialize_utils import load_extra_params,dump_extra_params
 from fastapi import FastAPI, Request, status, Header, Depends
 from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool
 from emd.utils.logger_utils import get_logger
 from fastapi.concurrency import run_in_threadpool
 from emd.utils.framework_utils import get_model_specific_path
+from utils.inference_executor import InferenceQueueFullError
+from utils.admission_controller import AdmissionController, AdmissionRejectedError, DEFAULT_PRIORITY_CLASS
+from utils.metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE, MetricsMiddleware, update_admission_metrics
 
 model_id = os.environ.get("model_id")
 model_tag = os.environ.get("model_tag")
@@ -21,7 +28,9 @@ logger.info(f"model_tag: {model_tag}")
 # prevent logging ping
 class HealthCheckFilter(logging.Filter):
     def filter(self, record: logging.LogRecord) -> bool:
-        return record.getMessage().find("GET /ping") == -1 and record.getMessage().find("GET /health") == -1
+        message = record.getMessage()
+        return message.find("GET /ping") == -1 and message.find("GET /health") == -1 \
+            and message.find("GET /queue") == -1 and message.find("GET /metrics") == -1
 
 # Remove /credentials/health from application server logs
 logging.getLogger("uvicorn.access").addFilter(HealthCheckFilter())
@@ -48,18 +57,125 @@ def parse_args():
 
 app = FastAPI()
 engine = None
+admission_controller = None
+admission_priority_header = "X-Priority-Class"
+# labels of the request metrics, the engine is known once the server is configured
+metrics_labels = {"model_id": model_id or "", "engine": ""}
+app.add_middleware(
+    MetricsMiddleware,
+    labels=metrics_labels,
+    excluded_paths=["/ping", "/health", "/queue", "/metrics"]
+)
+
+def observe_error(request: Request, exc: Exception):
+    # handled errors become responses before reaching the metrics middleware
+    metrics = getattr(request.state, "metrics", None)
+    if metrics is not None:
+        metrics.observe_error(exc)
+
+@app.exception_handler(InferenceQueueFullError)
+async def inference_queue_full_handler(request: Request, exc: InferenceQueueFullError):
+    observe_error(request, exc)
+    # reject fast instead of queuing invisibly when the model is saturated
+    return JSONResponse(
+        content={"error": str(exc)},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(AdmissionRejectedError)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejectedError):
+    observe_error(request, exc)
+    return JSONResponse(
+        content={"error": str(exc)},
+        status_code=exc.status_code,
+        headers={"Retry-After": str(exc.retry_after), "X-Queue-Depth": str(exc.queue_depth)}
+    )
+
+def create_admission_controller(engine, framework):
+    if not getattr(framework, "admission_control", False):
+        return None
+    max_concurrency = getattr(framework, "admission_max_concurrency", None) or engine.engine_max_concurrency
+    max_queue_size = getattr(framework, "admission_max_queue_size", None)
+    if max_queue_size is None:
+        max_queue_size = 4 * max_concurrency
+    queue_timeout = getattr(framework, "admission_queue_timeout", 30)
+    priority_classes = getattr(framework, "admission_priority_classes", None)
+    logger.info(
+        f"admission control, max_concurrency: {max_concurrency}, "
+        f"max_queue_size: {max_queue_size}, queue_timeout: {queue_timeout}, "
+        f"priority_classes: {priority_classes}"
+    )
+    return AdmissionController(
+        max_concurrency=max_concurrency,
+        max_queue_size=max_queue_size,
+        queue_timeout=queue_timeout,
+        priority_classes=priority_classes,
+        default_priority_class=getattr(framework, "admission_default_priority_class", DEFAULT_PRIORITY_CLASS),
+        tenants=getattr(framework, "admission_tenants", None)
+    )
+
+def get_priority_class(request: Request):
+    priority_class = request.headers.get(admission_priority_header)
+    if priority_class:
+        return priority_class
+    # sagemaker runtime only forwards the custom attributes, e.g. "priority_class=batch"
+    custom_attributes = request.headers.get("X-Amzn-SageMaker-Custom-Attributes") or ""
+    for attribute in custom_attributes.split(","):
+        key, _, value = attribute.partition("=")
+        if key.strip() == "priority_class":
+            return value.strip()
+    return None
+
+def get_tenant(authorization: str):
+    if authorization is None:
+        return None
+    return authorization.removeprefix("Bearer ").strip()
 
 async def get_authorization(authorization: str = Header(None)):
     return authorization
 
-async def invoke(payload):
-    # generator = await run_in_threadpool(engine.invoke, payload)
-    generator = await engine.ainvoke(payload)
+async def release_after_stream(generator, ticket):
+    try:
+        if not hasattr(generator, "__aiter__"):
+            generator = iterate_in_threadpool(generator)
+        async for chunk in generator:
+            yield chunk
+    finally:
+        ticket.release()
+
+async def invoke(payload, priority_class=None, tenant=None, metrics=None):
+    if admission_controller is None:
+        ticket = None
+    else:
+        # the class chosen by the client is capped at the default class unless the tenant is allowed it
+        priority_class = admission_controller.requestable_priority_class(priority_class, tenant)
+        ticket = await admission_controller.acquire(priority_class=priority_class, tenant=tenant)
+        if metrics is not None:
+            metrics.observe_queue_wait(ticket.queue_wait)
+    try:
+        # generator = await run_in_threadpool(engine.invoke, payload)
+        if metrics is None:
+            generator = await engine.ainvoke(payload)
+        else:
+            generator = await engine.ainvoke_with_metrics(payload, metrics)
+    except BaseException:
+        if ticket is not None:
+            ticket.release()
+        raise
     stream = payload.get("stream",False)
     if stream:
-        return StreamingResponse(content=generator,
-                                media_type="text/event-stream")
+        if ticket is None:
+            return StreamingResponse(content=generator,
+                                    media_type="text/event-stream")
+        # the slot is held until the stream ends, the background task releases it
+        # if the client disconnects before the stream starts
+        return StreamingResponse(content=release_after_stream(generator, ticket),
+                                media_type="text/event-stream",
+                                background=BackgroundTask(ticket.release))
     else:
+        if ticket is not None:
+            ticket.release()
         return generator
 
 # As sagemaker endpoint requires...
@@ -71,6 +187,20 @@ def ping():
 def health():
     return "200 OK"
 
+# queue depth of the admission controller, for autoscaling
+@app.get("/queue")
+def queue():
+    if admission_controller is None:
+        return JSONResponse(content={"admission_control": False})
+    return JSONResponse(content={"admission_control": True, **admission_controller.stats()})
+
+# prometheus scrapes
+@app.get("/metrics")
+def prometheus_metrics():
+    if admission_controller is not None:
+        update_admission_metrics(admission_controller, metrics_labels)
+    return Response(content=REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
 # As sagemaker endpoint requires...
 @app.post("/invocations")
 @app.post("/v1/invocations")
@@ -81,10 +211,16 @@ def health():
 # @measure_time
 async def invocations(request: Request, authorization: str = Depends(get_authorization)):
     # logger.info('invocations ......')
-    payload = await request.json()
+    body = await request.body()
+    # large requests of the sdk clients may be gzip compressed
+    if request.headers.get("content-encoding") == "gzip":
+        body = gzip.decompress(body)
+    payload = json.loads(body)
+    priority_class = get_priority_class(request)
+    metrics = getattr(request.state, "metrics", None)
     # If the request does not have Authorization, invoke the payload
     if authorization is None:
-        return await invoke(payload)
+        return await invoke(payload, priority_class=priority_class, metrics=metrics)
     # If the request has extra_headers, add Authorization to it
     if "extra_headers" in payload and "Authorization" not in payload["extra_headers"]:
         payload["extra_headers"]["Authorization"] = authorization
@@ -92,11 +228,13 @@ async def invocations(request: Request, authorization: str = Depends(get_authori
     elif "extra_headers" not in payload:
         payload["extra_headers"] = { "Authorization": authorization }
 
-    return await invoke(payload)
+    return await invoke(payload, priority_class=priority_class, tenant=get_tenant(authorization), metrics=metrics)
 
 endpoints = {
     "ping": {"func": ping, "methods": ["GET"]},
     "health": {"func": health, "methods": ["GET"]},
+    "queue": {"func": queue, "methods": ["GET"]},
+    "metrics": {"func": prometheus_metrics, "methods": ["GET"]},
     # Note: The functions for the POST endpoints all use "invocations".
     "invocations": {"func": invocations, "methods": ["POST"]},
     "v1/invocations": {"func": invocations, "methods": ["POST"]},
@@ -148,6 +286,9 @@ if __name__ == "__main__":
     engine = execute_model.get_engine()
     framework = execute_model.executable_config.current_framework
     engine.start()
+    admission_controller = create_admission_controller(engine, framework)
+    admission_priority_header = getattr(framework, "admission_priority_header", admission_priority_header)
+    metrics_labels.update(model_id=model_id, engine=backend_type)
     uvicorn.run(
         app,
         host=host,
@@ -5,7 +5,7 @@ import io
 import botocore
 import re
 
-from utils.LineIterator import LineIterator
+from emd.utils.line_iterator import LineIterator,decode_generated_text_line
 
 class SageMakerClient:
     def __init__(self, region="us-east-1", endpoint_name="vllm-endpoint", stream=False):
@@ -24,8 +24,8 @@ class SageMakerClient:
                 ContentType="application/json",
             )
             event_stream = response['Body']
-            for line in LineIterator(event_stream):
-                print(line, end="")
+            for line in LineIterator(event_stream, partial=True):
+                print(decode_generated_text_line(line), end="")
                 sys.stdout.flush()
         else:
             response = self.client.invoke_endpoint(
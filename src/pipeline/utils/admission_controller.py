@@ -0,0 +1,282 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from emd.utils.logger_utils import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_PRIORITY_CLASS = "default"
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a request is not admitted, the server answers with `status_code` and `Retry-After`."""
+
+    def __init__(self, message: str, status_code: int, retry_after: int = 1, queue_depth: int = 0):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.queue_depth = queue_depth
+
+
+class AdmissionTicket:
+    """Slot of an admitted request, released once when the response is complete."""
+
+    def __init__(self, controller: "AdmissionController", priority_class: str, tenant: Optional[str], queue_wait: float):
+        self.controller = controller
+        self.priority_class = priority_class
+        self.tenant = tenant
+        self.queue_wait = queue_wait
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.controller._release(self.priority_class, time.monotonic() - self.admitted_at)
+
+
+class _QueuedRequest:
+    __slots__ = ("finish_tag", "priority_class", "future", "queued")
+
+    def __init__(self, finish_tag: float, priority_class: str, future: asyncio.Future):
+        self.finish_tag = finish_tag
+        self.priority_class = priority_class
+        self.future = future
+        self.queued = True
+
+
+class AdmissionController:
+    """
+    Admit at most `max_concurrency` requests into the engine, i.e. its batch capacity
+    (`--max-num-seqs` of vllm...), the next ones wait in a bounded queue instead of queuing
+    invisibly inside the engine.
+
+    The queue is served by weighted fair queuing over the flows of (priority class, tenant):
+    each flow gets a share of the admissions proportional to the weight of its priority class
+    times the weight of its tenant, so bulk jobs do not starve interactive traffic, and one
+    tenant does not starve the others. Requests of a single flow are admitted in arrival order.
+    `priority_classes` maps class names to `{"weight": ..., "queue_timeout": ...}`, `tenants`
+    maps tenants (api keys) to `{"weight": ..., "priority_class": ..., "allowed_priority_classes": [...]}`,
+    a tenant pinned to a priority class can not request another one. Classes requested by the
+    clients (headers) go through `requestable_priority_class`: a class weighted above the default
+    one is only granted to the tenants allowed it.
+
+    A request is rejected with 429 when `max_queue_size` requests are already waiting (a queued
+    request of a flow served later is evicted to make room for one served earlier), and with
+    503 when it waited `queue_timeout` seconds without being admitted, or right away when it is
+    not expected to be admitted before that deadline. The expected wait is estimated from an
+    EWMA of the time requests hold their slot. Both carry a `Retry-After` estimate.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue_size: int,
+        queue_timeout: Optional[float] = 30,
+        priority_classes: Optional[Dict[str, dict]] = None,
+        default_priority_class: str = DEFAULT_PRIORITY_CLASS,
+        tenants: Optional[Dict[str, dict]] = None,
+        service_time_decay: float = 0.1,
+    ):
+        assert max_concurrency > 0, max_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+        self.priority_classes = priority_classes or {default_priority_class: {}}
+        if default_priority_class not in self.priority_classes:
+            raise ValueError(f"Default priority class {default_priority_class} is not in {list(self.priority_classes)}")
+        self.default_priority_class = default_priority_class
+        self.tenants = tenants or {}
+        self.service_time_decay = service_time_decay
+        self.service_time: Optional[float] = None
+        self.rejected = Counter()
+        self._in_flight = Counter()
+        self._queued = Counter()
+        # min heap of (finish tag, arrival order, request)
+        self._queue = []
+        self._arrivals = itertools.count()
+        # self-clocked fair queuing, the virtual time is the finish tag of the last admission
+        self._virtual_time = 0.0
+        self._flow_finish_tags = {}
+
+    @property
+    def in_flight(self) -> int:
+        """Number of admitted requests."""
+        return sum(self._in_flight.values())
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting for admission."""
+        return sum(self._queued.values())
+
+    def resolve_priority_class(self, priority_class: Optional[str] = None, tenant: Optional[str] = None) -> str:
+        tenant_config = self.tenants.get(tenant) or {}
+        priority_class = tenant_config.get("priority_class") or priority_class
+        if priority_class not in self.priority_classes:
+            return self.default_priority_class
+        return priority_class
+
+    def requestable_priority_class(self, priority_class: Optional[str] = None, tenant: Optional[str] = None) -> Optional[str]:
+        """Cap a priority class requested by a client at the default class, unless the tenant is allowed it."""
+        if priority_class not in self.priority_classes:
+            return None
+        tenant_config = self.tenants.get(tenant) or {}
+        if priority_class in tenant_config.get("allowed_priority_classes", ()):
+            return priority_class
+        default_weight = self.priority_classes[self.default_priority_class].get("weight", 1)
+        if self.priority_classes[priority_class].get("weight", 1) > default_weight:
+            logger.debug(f"Priority class {priority_class} is not allowed for the tenant, use {self.default_priority_class}")
+            return None
+        return priority_class
+
+    def _weight(self, priority_class: str, tenant: Optional[str]) -> float:
+        tenant_config = self.tenants.get(tenant) or {}
+        return self.priority_classes[priority_class].get("weight", 1) * tenant_config.get("weight", 1)
+
+    def _queue_timeout(self, priority_class: str) -> Optional[float]:
+        return self.priority_classes[priority_class].get("queue_timeout", self.queue_timeout)
+
+    def _finish_tag(self, priority_class: str, tenant: Optional[str]) -> float:
+        flow_finish_tag = self._flow_finish_tags.get((priority_class, tenant), 0)
+        return max(self._virtual_time, flow_finish_tag) + 1 / self._weight(priority_class, tenant)
+
+    def _commit_finish_tag(self, priority_class: str, tenant: Optional[str], finish_tag: float):
+        if len(self._flow_finish_tags) > 10000:
+            # flows behind the virtual time are idle, their tag would be reset anyway
+            self._flow_finish_tags = {
+                flow: tag for flow, tag in self._flow_finish_tags.items() if tag > self._virtual_time
+            }
+        self._flow_finish_tags[(priority_class, tenant)] = finish_tag
+
+    def expected_wait(self, position: int) -> float:
+        """Expected seconds before the request at `position` in the queue is admitted."""
+        if self.service_time is None:
+            return 0
+        return (position // self.max_concurrency + 1) * self.service_time
+
+    def retry_after(self) -> int:
+        return max(math.ceil(self.expected_wait(self.queue_depth)), 1)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_concurrency": self.max_concurrency,
+            "max_queue_size": self.max_queue_size,
+            "service_time": self.service_time,
+            "rejected": sum(self.rejected.values()),
+            "priority_classes": {
+                priority_class: {
+                    "in_flight": self._in_flight[priority_class],
+                    "queue_depth": self._queued[priority_class],
+                    "rejected": self.rejected[priority_class],
+                }
+                for priority_class in self.priority_classes
+            },
+        }
+
+    def _reject(self, priority_class: str, message: str, status_code: int) -> AdmissionRejectedError:
+        self.rejected[priority_class] += 1
+        return AdmissionRejectedError(
+            message,
+            status_code=status_code,
+            retry_after=self.retry_after(),
+            queue_depth=self.queue_depth
+        )
+
+    def _queued_requests(self):
+        return [request for _, _, request in self._queue if request.queued and not request.future.done()]
+
+    def _dequeue(self, request: _QueuedRequest):
+        request.queued = False
+        self._queued[request.priority_class] -= 1
+
+    def _admit(self, priority_class: str, finish_tag: float):
+        self._in_flight[priority_class] += 1
+        self._virtual_time = max(self._virtual_time, finish_tag)
+
+    async def acquire(self, priority_class: Optional[str] = None, tenant: Optional[str] = None) -> AdmissionTicket:
+        """
+        Wait for a slot, `tenant` is usually the api key of the request.
+
+        Raises:
+            AdmissionRejectedError: If the queue is full, or the request is not admitted
+                before its deadline.
+        """
+        arrived_at = time.monotonic()
+        priority_class = self.resolve_priority_class(priority_class, tenant)
+        finish_tag = self._finish_tag(priority_class, tenant)
+        if self.in_flight < self.max_concurrency and not self.queue_depth:
+            self._commit_finish_tag(priority_class, tenant, finish_tag)
+            self._admit(priority_class, finish_tag)
+            return AdmissionTicket(self, priority_class, tenant, 0)
+
+        queued_requests = self._queued_requests()
+        if len(queued_requests) >= self.max_queue_size:
+            victim = max(queued_requests, key=lambda request: request.finish_tag, default=None)
+            if victim is None or victim.finish_tag <= finish_tag:
+                raise self._reject(
+                    priority_class,
+                    f"Too many requests waiting (max queue size: {self.max_queue_size}), please retry later.",
+                    status_code=429
+                )
+            # make room for a request served before the last queued one
+            self._dequeue(victim)
+            victim.future.set_exception(self._reject(
+                victim.priority_class,
+                "Request was evicted from the admission queue by requests of higher priority, please retry later.",
+                status_code=429
+            ))
+            queued_requests.remove(victim)
+
+        queue_timeout = self._queue_timeout(priority_class)
+        position = sum(1 for request in queued_requests if request.finish_tag <= finish_tag)
+        if queue_timeout is not None and self.expected_wait(position) > queue_timeout:
+            # shed now rather than after waiting for nothing
+            raise self._reject(
+                priority_class,
+                f"Request would not be admitted within {queue_timeout}s, please retry later.",
+                status_code=503
+            )
+
+        self._commit_finish_tag(priority_class, tenant, finish_tag)
+        request = _QueuedRequest(finish_tag, priority_class, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, (finish_tag, next(self._arrivals), request))
+        self._queued[priority_class] += 1
+        try:
+            await asyncio.wait_for(request.future, queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if request.future.done() and not request.future.cancelled():
+                if request.future.exception() is None:
+                    # the slot was handed over meanwhile, pass it on
+                    self._release(priority_class, None)
+            elif request.queued:
+                self._dequeue(request)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject(
+                    priority_class,
+                    f"Request was not admitted within {queue_timeout}s, please retry later.",
+                    status_code=503
+                ) from None
+            raise
+        return AdmissionTicket(self, priority_class, tenant, time.monotonic() - arrived_at)
+
+    def _release(self, priority_class: str, service_time: Optional[float]):
+        if service_time is not None:
+            self.service_time = service_time if self.service_time is None else \
+                self.service_time_decay * service_time + (1 - self.service_time_decay) * self.service_time
+        self._in_flight[priority_class] -= 1
+        # hand the slot over to the queued request with the smallest finish tag
+        while self._queue:
+            finish_tag, _, request = heapq.heappop(self._queue)
+            if request.queued and not request.future.done():
+                self._dequeue(request)
+                self._admit(request.priority_class, finish_tag)
+                request.future.set_result(None)
+                return
@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+from emd.utils.logger_utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class InferenceQueueFullError(Exception):
+    """Raised when the inference queue is full, the server should answer with 503."""
+
+    def __init__(self, queue_size: int, retry_after: int = 1):
+        super().__init__(f"Inference queue is full (max queue size: {queue_size}), please retry later.")
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+
+
+class InferenceExecutor(Executor):
+    """
+    A bounded thread pool dedicated to blocking model inference.
+
+    At most `max_workers` jobs run at the same time (usually one per device) and at most
+    `max_queue_size` jobs wait for a free worker. Further submissions are rejected
+    immediately with `InferenceQueueFullError` instead of piling up, so the event loop
+    keeps serving health checks and request parsing when the model is saturated.
+    It can be passed to `loop.run_in_executor`.
+    """
+
+    def __init__(self, max_workers: int = 1, max_queue_size: int = 64):
+        assert max_workers > 0, max_workers
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="inference"
+        )
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of running and queued jobs."""
+        return self._pending
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a free worker."""
+        return max(self._pending - self.max_workers, 0)
+
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue_size:
+                raise InferenceQueueFullError(self.max_queue_size)
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self._executor.shutdown(wait=wait, cancel_futures=cancel_futures)
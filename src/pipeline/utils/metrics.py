@@ -0,0 +1,320 @@
+import bisect
+import re
+import threading
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+from emd.utils.logger_utils import get_logger
+
+logger = get_logger(__name__)
+
+# content type of the prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_LABELS = ("model_id", "engine", "route")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28, 2.56)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))   # 256 bytes to 64 MiB
+TOKEN_BUCKETS = tuple(2 ** i for i in range(4, 18))      # 16 to 128k tokens
+
+_USAGE_PATTERN = re.compile(rb'"(prompt_tokens|completion_tokens)"\s*:\s*(\d+)')
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return "\n".join(lines)
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, labels: Dict[str, str], amount: float = 1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def inc(self, labels: Dict[str, str], amount: float = 1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, labels: Dict[str, str], amount: float = 1):
+        self.inc(labels, -amount)
+
+    def set(self, labels: Dict[str, str], value: float):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, labels: Dict[str, str], value: float):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._values.get(key)
+            if sample is None:
+                # per bucket counts, the last one is +Inf, then sum
+                sample = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            sample[0][index] += 1
+            sample[1] += value
+
+    def _render_sample(self, key, value):
+        counts, total = value
+        label_names = self.label_names + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(
+                f"{self.name}_bucket{_format_labels(label_names, key + (_format_value(bound),))} {cumulative}"
+            )
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Minimal prometheus registry, the serving images do not ship `prometheus_client`."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = REGISTRY.counter(
+    "emd_requests_total", "Requests served, by status code.", REQUEST_LABELS + ("status",))
+REQUEST_ERRORS = REGISTRY.counter(
+    "emd_request_errors_total", "Failed requests, by error class.", REQUEST_LABELS + ("error_class",))
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "emd_requests_in_flight", "Requests being served, including the ones waiting for admission.", REQUEST_LABELS)
+REQUEST_LATENCY = REGISTRY.histogram(
+    "emd_request_latency_seconds", "Time from the request to the end of the response in the server.", REQUEST_LABELS)
+REQUEST_SIZE = REGISTRY.histogram(
+    "emd_request_size_bytes", "Size of the request bodies.", REQUEST_LABELS, buckets=SIZE_BUCKETS)
+QUEUE_WAIT = REGISTRY.histogram(
+    "emd_queue_wait_seconds", "Time waited for admission into the engine.", REQUEST_LABELS)
+ENGINE_LATENCY = REGISTRY.histogram(
+    "emd_engine_latency_seconds", "Time from the admission to the end of the response of the engine.", REQUEST_LABELS)
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    "emd_time_to_first_token_seconds", "Time from the admission to the first stream chunk of the engine.", REQUEST_LABELS)
+INTER_TOKEN_LATENCY = REGISTRY.histogram(
+    "emd_inter_token_latency_seconds", "Time between stream chunks of the engine.", REQUEST_LABELS,
+    buckets=TOKEN_LATENCY_BUCKETS)
+INPUT_TOKENS = REGISTRY.histogram(
+    "emd_input_tokens", "Prompt tokens of the requests, as reported by the engine.", REQUEST_LABELS,
+    buckets=TOKEN_BUCKETS)
+OUTPUT_TOKENS = REGISTRY.histogram(
+    "emd_output_tokens", "Generated tokens of the requests, as reported by the engine.", REQUEST_LABELS,
+    buckets=TOKEN_BUCKETS)
+STREAM_EVENTS = REGISTRY.histogram(
+    "emd_stream_events", "Events (SSE/JSONL events, sagemaker frames) of the streamed responses, not tokens.",
+    REQUEST_LABELS, buckets=TOKEN_BUCKETS)
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "emd_admission_queue_depth", "Requests waiting for admission.", ("model_id", "engine", "priority_class"))
+ADMISSION_IN_FLIGHT = REGISTRY.gauge(
+    "emd_admission_in_flight", "Requests admitted into the engine.", ("model_id", "engine", "priority_class"))
+ADMISSION_CAPACITY = REGISTRY.gauge(
+    "emd_admission_max_concurrency", "Requests admitted into the engine at most.", ("model_id", "engine"))
+
+
+def parse_usage(body: bytes) -> Tuple[Optional[int], Optional[int]]:
+    """Prompt and completion tokens of the openai `usage` of a json body, without decoding it."""
+    start = body.rfind(b'"usage"')
+    if start == -1:
+        return None, None
+    usage = dict(_USAGE_PATTERN.findall(body, start))
+    prompt_tokens = usage.get(b"prompt_tokens")
+    completion_tokens = usage.get(b"completion_tokens")
+    return (
+        int(prompt_tokens) if prompt_tokens is not None else None,
+        int(completion_tokens) if completion_tokens is not None else None
+    )
+
+
+class RequestMetrics:
+    """Timings of one request, recorded with the labels of its model, engine and route."""
+
+    def __init__(self, labels: Dict[str, str]):
+        self.labels = labels
+        self.error_class: Optional[str] = None
+        self.admitted_at: Optional[float] = None
+        self._last_chunk_at: Optional[float] = None
+
+    def observe_queue_wait(self, queue_wait: float):
+        QUEUE_WAIT.observe(self.labels, queue_wait)
+
+    def observe_admission(self):
+        self.admitted_at = time.perf_counter()
+
+    def observe_engine_done(self):
+        if self.admitted_at is not None:
+            ENGINE_LATENCY.observe(self.labels, time.perf_counter() - self.admitted_at)
+
+    def observe_chunk(self):
+        now = time.perf_counter()
+        if self._last_chunk_at is None:
+            if self.admitted_at is not None:
+                TIME_TO_FIRST_TOKEN.observe(self.labels, now - self.admitted_at)
+        else:
+            INTER_TOKEN_LATENCY.observe(self.labels, now - self._last_chunk_at)
+        self._last_chunk_at = now
+
+    def observe_tokens(self, input_tokens: Optional[int], output_tokens: Optional[int]):
+        if input_tokens is not None:
+            INPUT_TOKENS.observe(self.labels, input_tokens)
+        if output_tokens is not None:
+            OUTPUT_TOKENS.observe(self.labels, output_tokens)
+
+    def observe_stream_events(self, events: int):
+        STREAM_EVENTS.observe(self.labels, events)
+
+    def observe_error(self, error: BaseException):
+        self.error_class = type(error).__name__
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the size, latency (to the last byte of streams), status and
+    error class of the requests, and the number of requests in flight. The `RequestMetrics`
+    of a request is available to the handlers as `request.state.metrics`.
+
+    `labels` is read at each request, so that the model and engine can be filled in once the
+    server is configured. Paths ending with one of `excluded_paths` (health checks, scrapes)
+    are not recorded.
+    """
+
+    def __init__(self, app, labels: Dict[str, str], excluded_paths: Sequence[str] = ()):
+        self.app = app
+        self.labels = labels
+        self.excluded_paths = tuple(excluded_paths)
+        self._routes = {}
+
+    def _route(self, scope) -> str:
+        # the path template of the matched route, bounding the label cardinality
+        path = scope["path"]
+        route = self._routes.get(path)
+        if route is None:
+            from starlette.routing import Match
+            route = "unmatched"
+            for candidate in scope["app"].router.routes:
+                match, _ = candidate.matches(scope)
+                if match == Match.FULL:
+                    route = getattr(candidate, "path", path)
+                    break
+            if route != "unmatched" or len(self._routes) < 1000:
+                self._routes[path] = route
+        return route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].endswith(self.excluded_paths):
+            await self.app(scope, receive, send)
+            return
+        labels = {**self.labels, "route": self._route(scope)}
+        metrics = RequestMetrics(labels)
+        scope.setdefault("state", {})["metrics"] = metrics
+        start = time.perf_counter()
+        request_size = 0
+        status = 500
+
+        async def receive_wrapper():
+            nonlocal request_size
+            message = await receive()
+            if message["type"] == "http.request":
+                request_size += len(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(labels)
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except BaseException as e:
+            metrics.observe_error(e)
+            raise
+        finally:
+            REQUESTS_IN_FLIGHT.dec(labels)
+            REQUEST_LATENCY.observe(labels, time.perf_counter() - start)
+            REQUEST_SIZE.observe(labels, request_size)
+            REQUESTS.inc({**labels, "status": str(status)})
+            if status >= 400 or metrics.error_class is not None:
+                REQUEST_ERRORS.inc({**labels, "error_class": metrics.error_class or f"http_{status}"})
+
+
+def update_admission_metrics(admission_controller, labels: Dict[str, str]):
+    stats = admission_controller.stats()
+    ADMISSION_CAPACITY.set(labels, stats["max_concurrency"])
+    for priority_class, class_stats in stats["priority_classes"].items():
+        class_labels = {**labels, "priority_class": priority_class}
+        ADMISSION_QUEUE_DEPTH.set(class_labels, class_stats["queue_depth"])
+        ADMISSION_IN_FLIGHT.set(class_labels, class_stats["in_flight"])
@@ -0,0 +1,203 @@
+import asyncio
+import bisect
+import time
+from typing import Any, Callable, Hashable, List, Optional
+
+from emd.utils.logger_utils import get_logger
+from utils.inference_executor import InferenceQueueFullError
+
+logger = get_logger(__name__)
+
+
+class _PendingRequest:
+    def __init__(self, items: list, group_key: Hashable, future: asyncio.Future):
+        self.items = items
+        self.group_key = group_key
+        self.future = future
+        self.results = [None] * len(items)
+        self.remaining = len(items)
+        self.enqueue_time = time.time()
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent requests into a single call of a blocking batch function.
+
+    Every caller submits a list of items together with a group key (items can only be
+    merged with items of the same group, e.g. the same `task`/`truncate_dim` for an
+    embedding model). A single worker task collects requests until either `max_batch_size`
+    items are pending or `max_wait_ms` has elapsed since the first one arrived, sorts the
+    collected items by length, cuts them into chunks that never cross a length bucket
+    boundary and runs `process_fn(items, group_key)` once per chunk in `executor`, with up to
+    `max_concurrent_chunks` chunks (by default the `max_workers` of the executor) in flight.
+    The rows of every chunk result are scattered back to the callers in submission order.
+    Once `max_pending_requests` requests are waiting, new submissions are rejected with
+    `InferenceQueueFullError`.
+    """
+
+    def __init__(
+        self,
+        process_fn: Callable[[list, Hashable], Any],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5,
+        length_buckets: Optional[List[int]] = None,
+        length_fn: Optional[Callable[[Any], int]] = None,
+        executor=None,
+        max_pending_requests: Optional[int] = None,
+        max_concurrent_chunks: Optional[int] = None,
+    ):
+        assert max_batch_size > 0, max_batch_size
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.length_buckets = sorted(length_buckets or [])
+        self.length_fn = length_fn or self._default_length_fn
+        self.executor = executor
+        self.max_pending_requests = max_pending_requests
+        self.max_concurrent_chunks = max_concurrent_chunks or getattr(executor, "max_workers", None) or 1
+        self._queue = None
+        self._chunk_slots = None
+        self._batch_tasks = set()
+        self._worker = None
+
+    @staticmethod
+    def _default_length_fn(item) -> int:
+        # character count is a cheap proxy of the token count
+        if isinstance(item, str):
+            return len(item)
+        return 0
+
+    def _bucket_of(self, item) -> int:
+        return bisect.bisect_left(self.length_buckets, self.length_fn(item))
+
+    def _ensure_worker(self):
+        # the queue and the worker must be bound to the running event loop
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._chunk_slots = asyncio.Semaphore(self.max_concurrent_chunks)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, items: list, group_key: Hashable = None) -> list:
+        if not items:
+            return []
+        self._ensure_worker()
+        if self.max_pending_requests and self._queue.qsize() >= self.max_pending_requests:
+            raise InferenceQueueFullError(self.max_pending_requests)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_PendingRequest(list(items), group_key, future))
+        return await future
+
+    async def _collect(self, pending: List[_PendingRequest]):
+        """Collect the next batch into `pending`, it holds the collected requests if the worker stops meanwhile."""
+        first = await self._queue.get()
+        pending.append(first)
+        item_num = len(first.items)
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while item_num < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            pending.append(request)
+            item_num += len(request.items)
+
+    def _make_chunks(self, pending: List[_PendingRequest]) -> list:
+        groups = {}
+        for request in pending:
+            for item_index, item in enumerate(request.items):
+                groups.setdefault(request.group_key, []).append(
+                    (self._bucket_of(item), self.length_fn(item), request, item_index)
+                )
+        chunks = []
+        for group_key, entries in groups.items():
+            entries.sort(key=lambda x: x[1])
+            chunk = []
+            for entry in entries:
+                if chunk and (len(chunk) >= self.max_batch_size or chunk[-1][0] != entry[0]):
+                    chunks.append((group_key, chunk))
+                    chunk = []
+                chunk.append(entry)
+            if chunk:
+                chunks.append((group_key, chunk))
+        return chunks
+
+    async def _process_chunk(self, group_key, chunk):
+        loop = asyncio.get_running_loop()
+        requests = {id(entry[2]): entry[2] for entry in chunk}
+        try:
+            outputs = await loop.run_in_executor(
+                self.executor,
+                self.process_fn,
+                [entry[2].items[entry[3]] for entry in chunk],
+                group_key
+            )
+        except Exception as e:
+            for request in requests.values():
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        finally:
+            # the slot was taken by `_run` when the chunk was dispatched
+            self._chunk_slots.release()
+
+        for (_, _, request, item_index), output in zip(chunk, outputs):
+            if request.future.done():
+                continue
+            request.results[item_index] = output
+            request.remaining -= 1
+            if request.remaining == 0:
+                request.future.set_result(request.results)
+
+    async def _process_batch(self, pending: List[_PendingRequest], chunks: list, chunk_tasks: list, t0: float):
+        await asyncio.gather(*chunk_tasks)
+        logger.info(
+            f"micro batch processed, requests: {len(pending)}, "
+            f"items: {sum(len(request.items) for request in pending)}, chunks: {len(chunks)}, "
+            f"max queue wait: {t0 - min(request.enqueue_time for request in pending):.4f}, "
+            f"elapsed time: {time.time()-t0:.4f}"
+        )
+
+    def _fail_requests(self, requests: List[_PendingRequest], error: BaseException):
+        queue = self._queue
+        while queue is not None and not queue.empty():
+            requests.append(queue.get_nowait())
+        for request in requests:
+            if request.future.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                request.future.cancel()
+            else:
+                request.future.set_exception(error)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        # requests collected but not dispatched yet
+        pending = []
+        try:
+            while True:
+                pending = []
+                await self._collect(pending)
+                pending = [request for request in pending if not request.future.done()]
+                if not pending:
+                    continue
+                t0 = time.time()
+                chunks = self._make_chunks(pending)
+                chunk_tasks = []
+                for group_key, chunk in chunks:
+                    # the chunks run concurrently on the workers of the executor, the next batch is
+                    # collected once a worker is free, meanwhile the new requests pile up into it
+                    await self._chunk_slots.acquire()
+                    chunk_tasks.append(loop.create_task(self._process_chunk(group_key, chunk)))
+                batch_task = loop.create_task(self._process_batch(pending, chunks, chunk_tasks, t0))
+                self._batch_tasks.add(batch_task)
+                batch_task.add_done_callback(self._batch_tasks.discard)
+                pending = []
+        except BaseException as e:
+            # nobody would resolve the waiting requests, the next submission starts a new worker
+            if not isinstance(e, asyncio.CancelledError):
+                logger.exception(f"micro batch worker failed: {e}")
+            self._fail_requests(pending, e)
+            raise
@@ -0,0 +1,252 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from emd.models.frameworks import fastapi_framework
+from framework.fast_api import fast_api
+from utils.admission_controller import AdmissionController, AdmissionRejectedError
+
+
+async def queued(controller, **kwargs):
+    """Start an `acquire` and let it reach the queue."""
+    task = asyncio.ensure_future(controller.acquire(**kwargs))
+    await asyncio.sleep(0)
+    return task
+
+
+def test_admits_up_to_max_concurrency():
+    async def run():
+        controller = AdmissionController(max_concurrency=2, max_queue_size=4)
+        first = await controller.acquire()
+        second = await controller.acquire()
+        waiting = await queued(controller)
+        assert controller.stats()["in_flight"] == 2
+        assert controller.queue_depth == 1
+        assert not waiting.done()
+        first.release()
+        # released twice, counted once
+        first.release()
+        third = await asyncio.wait_for(waiting, 1)
+        assert controller.in_flight == 2 and controller.queue_depth == 0
+        second.release()
+        third.release()
+        assert controller.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_rejects_with_429_when_the_queue_is_full():
+    async def run():
+        controller = AdmissionController(max_concurrency=1, max_queue_size=1)
+        ticket = await controller.acquire()
+        waiting = await queued(controller)
+        with pytest.raises(AdmissionRejectedError) as e:
+            await controller.acquire()
+        assert e.value.status_code == 429
+        assert e.value.retry_after >= 1
+        assert e.value.queue_depth == 1
+        assert controller.stats()["rejected"] == 1
+        ticket.release()
+        (await waiting).release()
+
+    asyncio.run(run())
+
+
+def test_rejects_with_503_after_the_queue_timeout():
+    async def run():
+        controller = AdmissionController(max_concurrency=1, max_queue_size=4, queue_timeout=0.05)
+        ticket = await controller.acquire()
+        with pytest.raises(AdmissionRejectedError) as e:
+            await controller.acquire()
+        assert e.value.status_code == 503
+        assert controller.queue_depth == 0
+        ticket.release()
+        assert controller.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_sheds_requests_not_expected_to_be_admitted_in_time():
+    async def run():
+        controller = AdmissionController(max_concurrency=1, max_queue_size=4, queue_timeout=1)
+        # requests hold their slot for 10s on average
+        controller.service_time = 10
+        ticket = await controller.acquire()
+        with pytest.raises(AdmissionRejectedError) as e:
+            await controller.acquire()
+        assert e.value.status_code == 503
+        assert e.value.retry_after == 10
+        ticket.release()
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiters_leave_the_queue():
+    async def run():
+        controller = AdmissionController(max_concurrency=1, max_queue_size=4)
+        ticket = await controller.acquire()
+        waiting = await queued(controller)
+        next_waiting = await queued(controller)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert controller.queue_depth == 1
+        ticket.release()
+        # the slot goes to the next waiter, not to the cancelled one
+        (await asyncio.wait_for(next_waiting, 1)).release()
+        assert controller.in_flight == 0 and controller.queue_depth == 0
+
+    asyncio.run(run())
+
+
+
+async def admission_order(controller, flows):
+    """Queue one request per (priority class, tenant) of `flows` behind a held slot, return the admission order."""
+    ticket = await controller.acquire()
+    order = []
+
+    async def request(index, priority_class, tenant):
+        (await controller.acquire(priority_class=priority_class, tenant=tenant)).release()
+        order.append(index)
+
+    tasks = []
+    for index, (priority_class, tenant) in enumerate(flows):
+        tasks.append(asyncio.ensure_future(request(index, priority_class, tenant)))
+        await asyncio.sleep(0)
+    ticket.release()
+    await asyncio.wait_for(asyncio.gather(*tasks), 1)
+    return order
+
+
+def test_weighted_fair_queuing_between_priority_classes():
+    async def run():
+        controller = AdmissionController(
+            max_concurrency=1,
+            max_queue_size=32,
+            priority_classes={"interactive": {"weight": 4}, "batch": {"weight": 1}},
+            default_priority_class="batch",
+        )
+        flows = [("batch", None)] * 4 + [("interactive", None)] * 4
+        order = await admission_order(controller, flows)
+        # interactive requests queued last overtake the batch backlog, 4 of them per batch request
+        assert order == [4, 5, 6, 0, 7, 1, 2, 3]
+
+    asyncio.run(run())
+
+
+def test_tenants_share_their_priority_class():
+    async def run():
+        controller = AdmissionController(max_concurrency=1, max_queue_size=32)
+        flows = [(None, "bulk")] * 4 + [(None, "other")] * 2
+        order = await admission_order(controller, flows)
+        # the flows of the two tenants alternate, requests of one flow keep their order
+        assert order == [0, 4, 1, 5, 2, 3]
+
+    asyncio.run(run())
+
+
+def test_tenant_pinned_priority_class():
+    controller = AdmissionController(
+        max_concurrency=1,
+        max_queue_size=1,
+        priority_classes={"interactive": {}, "batch": {}},
+        default_priority_class="batch",
+        tenants={"key": {"priority_class": "batch"}},
+    )
+    assert controller.resolve_priority_class("interactive", tenant="key") == "batch"
+    assert controller.resolve_priority_class("interactive", tenant="other") == "interactive"
+    assert controller.resolve_priority_class("unknown") == "batch"
+    with pytest.raises(ValueError):
+        AdmissionController(max_concurrency=1, max_queue_size=1, priority_classes={"a": {}}, default_priority_class="b")
+
+
+def test_requested_priority_classes_are_capped_at_the_default_class():
+    controller = AdmissionController(
+        max_concurrency=1,
+        max_queue_size=1,
+        priority_classes={"interactive": {"weight": 8}, "default": {"weight": 2}, "batch": {"weight": 1}},
+        tenants={"chat key": {"allowed_priority_classes": ["interactive"]}},
+    )
+    assert controller.requestable_priority_class("interactive", tenant="chat key") == "interactive"
+    assert controller.requestable_priority_class("interactive", tenant="other") is None
+    assert controller.requestable_priority_class("interactive") is None
+    # lower classes can be chosen by anyone
+    assert controller.requestable_priority_class("batch") == "batch"
+    assert controller.requestable_priority_class("default") == "default"
+    assert controller.requestable_priority_class("unknown") is None
+    assert controller.requestable_priority_class(None) is None
+
+
+class RecordingEngine:
+    async def ainvoke_with_metrics(self, payload, metrics):
+        return {"ok": True}
+
+
+def test_priority_header_is_capped_for_the_tenants_not_allowed_it(monkeypatch):
+    controller = AdmissionController(
+        max_concurrency=1,
+        max_queue_size=1,
+        priority_classes={"interactive": {"weight": 8}, "default": {"weight": 1}},
+        tenants={"chat key": {"allowed_priority_classes": ["interactive"]}},
+    )
+    acquired = []
+    acquire = controller.acquire
+
+    async def recording_acquire(priority_class=None, tenant=None):
+        acquired.append(priority_class)
+        return await acquire(priority_class=priority_class, tenant=tenant)
+
+    monkeypatch.setattr(controller, "acquire", recording_acquire)
+    monkeypatch.setattr(fast_api, "engine", RecordingEngine())
+    monkeypatch.setattr(fast_api, "admission_controller", controller)
+    client = TestClient(fast_api.app)
+    for authorization in ("Bearer chat key", "Bearer other key"):
+        response = client.post(
+            "/invocations", json={"input": "hello"},
+            headers={"X-Priority-Class": "interactive", "Authorization": authorization},
+        )
+        assert response.status_code == 200
+    response = client.post(
+        "/invocations", json={"input": "hello"},
+        headers={"X-Amzn-SageMaker-Custom-Attributes": "priority_class=interactive"},
+    )
+    assert response.status_code == 200
+    assert acquired == ["interactive", None, None]
+
+
+def test_full_queue_evicts_requests_served_later():
+    async def run():
+        controller = AdmissionController(
+            max_concurrency=1,
+            max_queue_size=1,
+            priority_classes={"interactive": {"weight": 10}, "batch": {"weight": 1}},
+            default_priority_class="batch",
+        )
+        ticket = await controller.acquire(priority_class="batch")
+        batch = await queued(controller, priority_class="batch")
+        interactive = await queued(controller, priority_class="interactive")
+        with pytest.raises(AdmissionRejectedError) as e:
+            await batch
+        assert e.value.status_code == 429
+        # a request served later than the queued one is still rejected
+        with pytest.raises(AdmissionRejectedError):
+            await controller.acquire(priority_class="batch")
+        ticket.release()
+        (await asyncio.wait_for(interactive, 1)).release()
+        stats = controller.stats()
+        assert stats["priority_classes"]["batch"]["rejected"] == 2
+        assert stats["in_flight"] == 0 and stats["queue_depth"] == 0
+
+    asyncio.run(run())
+
+
+def test_admission_control_is_opt_in():
+    engine = SimpleNamespace(engine_max_concurrency=8)
+    assert fast_api.create_admission_controller(engine, fastapi_framework) is None
+    controller = fast_api.create_admission_controller(
+        engine, fastapi_framework.model_copy(update={"admission_control": True})
+    )
+    assert controller.stats()["max_concurrency"] == 8
+    assert controller.stats()["max_queue_size"] == 32
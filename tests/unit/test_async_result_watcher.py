@@ -0,0 +1,254 @@
+import io
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import boto3
+from botocore.exceptions import ClientError
+
+from emd.sdk.clients.sagemaker_client import SageMakerClient
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def put(self, path, data):
+        self.objects[path] = json.dumps(data).encode()
+
+    def head_object(self, Bucket, Key):
+        if f"s3://{Bucket}/{Key}" not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[f"s3://{Bucket}/{Key}"])}
+
+
+class FakeSQS:
+    """In-memory queue, `delete_failures` first batch deletions fail."""
+
+    def __init__(self, delete_failures=0):
+        self.messages = []
+        self.cond = threading.Condition()
+        self.delete_failures = delete_failures
+        self.deleted = []
+
+    def create_queue(self, QueueName, Attributes):
+        return {"QueueUrl": f"https://sqs/{QueueName}"}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        return {"Attributes": {"QueueArn": "arn:aws:sqs:queue"}}
+
+    def set_queue_attributes(self, QueueUrl, Attributes):
+        pass
+
+    def send(self, body):
+        with self.cond:
+            self.messages.append({"Body": json.dumps(body), "ReceiptHandle": str(len(self.deleted) + len(self.messages))})
+            self.cond.notify_all()
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+        with self.cond:
+            self.cond.wait_for(lambda: self.messages, timeout=0.1)
+            messages, self.messages = self.messages[:MaxNumberOfMessages], self.messages[MaxNumberOfMessages:]
+        return {"Messages": messages}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        if self.delete_failures:
+            self.delete_failures -= 1
+            raise ClientError({"Error": {"Code": "InternalError"}}, "DeleteMessageBatch")
+        self.deleted.extend(Entries)
+
+    def delete_queue(self, QueueUrl):
+        pass
+
+
+class FakeSNS:
+    def __init__(self, sqs):
+        self.sqs = sqs
+        self.subscriptions = []
+
+    def subscribe(self, TopicArn, Protocol, Endpoint, Attributes, ReturnSubscriptionArn):
+        self.subscriptions.append(TopicArn)
+        return {"SubscriptionArn": f"{TopicArn}:subscription"}
+
+    def publish(self, TopicArn, message):
+        if TopicArn in self.subscriptions:
+            self.sqs.send(message)
+
+    def unsubscribe(self, SubscriptionArn):
+        pass
+
+
+class FakeSageMaker:
+    def describe_endpoint(self, EndpointName):
+        return {"EndpointConfigName": f"{EndpointName}-config"}
+
+    def describe_endpoint_config(self, EndpointConfigName):
+        # DescribeEndpointConfig shape, the topics are in the output config
+        return {
+            "AsyncInferenceConfig": {
+                "ClientConfig": {},
+                "OutputConfig": {
+                    "S3OutputPath": "s3://bucket/output",
+                    "NotificationConfig": {"SuccessTopic": "arn:success", "ErrorTopic": "arn:error"},
+                },
+            }
+        }
+
+
+def make_client(delete_failures=0, **kwargs):
+    s3 = FakeS3()
+    sqs = FakeSQS(delete_failures=delete_failures)
+    sns = FakeSNS(sqs)
+    clients = {"sqs": sqs, "sns": sns, "sagemaker": FakeSageMaker()}
+    boto_session = SimpleNamespace(client=lambda name, region_name=None: clients[name])
+    client = SageMakerClient(
+        endpoint_name="endpoint",
+        client=SimpleNamespace(meta=SimpleNamespace(region_name="us-east-1")),
+        boto_session=boto_session,
+        s3_client=s3,
+        **kwargs
+    )
+    return client, s3, sns, sqs
+
+
+def test_results_are_resolved_from_notifications():
+    # slow polling, only the notification can resolve the result in time
+    client, s3, sns, sqs = make_client(result_notification=True, poll_initial_delay=60, poll_max_delay=60)
+    watcher = client.result_watcher
+    try:
+        assert watcher.notification_enabled
+        assert sns.subscriptions == ["arn:success", "arn:error"]
+        future = watcher.watch("s3://bucket/output/1.out", inference_id="1", timeout=30)
+        s3.put("s3://bucket/output/1.out", {"text": "done"})
+        sns.publish("arn:success", {
+            "invocationStatus": "Completed",
+            "inferenceId": "1",
+            "responseParameters": {"outputLocation": "s3://bucket/output/1.out"},
+        })
+        assert future.result(timeout=5) == {"text": "done"}
+    finally:
+        watcher.close()
+
+
+def test_listener_survives_delete_failures():
+    client, s3, sns, sqs = make_client(
+        delete_failures=1, result_notification=True, poll_initial_delay=60, poll_max_delay=60
+    )
+    watcher = client.result_watcher
+    try:
+        for i in range(2):
+            future = watcher.watch(f"s3://bucket/output/{i}.out", inference_id=str(i), timeout=30)
+            s3.put(f"s3://bucket/output/{i}.out", {"i": i})
+            sns.publish("arn:success", {
+                "invocationStatus": "Completed",
+                "inferenceId": str(i),
+                "responseParameters": {"outputLocation": f"s3://bucket/output/{i}.out"},
+            })
+            assert future.result(timeout=5) == {"i": i}
+        deadline = time.time() + 5
+        while not sqs.deleted and time.time() < deadline:
+            time.sleep(0.01)
+        assert sqs.deleted
+    finally:
+        watcher.close()
+
+
+def test_results_are_polled_without_notifications():
+    client, s3, sns, sqs = make_client(poll_initial_delay=0.01, poll_max_delay=0.05)
+    watcher = client.result_watcher
+    try:
+        assert not watcher.notification_enabled
+        future = watcher.watch("s3://bucket/output/2.out", "s3://bucket/failure/2.out", timeout=30)
+        s3.put("s3://bucket/output/2.out", {"text": "polled"})
+        assert future.result(timeout=5) == {"text": "polled"}
+    finally:
+        watcher.close()
+
+
+class FakeRuntime:
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def invoke_endpoint_async(self, InputLocation, EndpointName, Accept):
+        self.release.wait(5)
+        self.calls += 1
+        return {"OutputLocation": f"s3://bucket/output/{self.calls}.out", "InferenceId": str(self.calls)}
+
+
+def make_bulk_client(monkeypatch):
+    client, s3, sns, sqs = make_client(poll_initial_delay=0.01, poll_max_delay=0.05, default_bucket="bucket")
+    runtime = FakeRuntime()
+    monkeypatch.setattr(SageMakerClient, "_get_bulk_clients", lambda self, max_concurrency: (s3, runtime))
+    monkeypatch.setattr(SageMakerClient, "_upload_data_to_s3", lambda self, data, s3_client=None: "s3://bucket/input")
+    return client, s3, runtime
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_cancelled_submission_stops_its_watch(monkeypatch):
+    client, s3, runtime = make_bulk_client(monkeypatch)
+    watcher = client.result_watcher
+    try:
+        futures = client.submit_many([{"i": 1}, {"i": 2}], max_concurrency=2, timeout=30)
+        assert wait_for(lambda: len(watcher._pending) == 2)
+        cancelled = futures[0]
+        output_path = next(path for path, pending in watcher._pending.items() if pending.inference_id == "1")
+        assert cancelled.cancel()
+        assert output_path not in watcher._pending
+        s3.put(output_path, {"i": 1})
+        remaining = next(path for path in watcher._pending)
+        s3.put(remaining, {"i": 2})
+        assert futures[1].result(timeout=5) == {"i": 2}
+        assert cancelled.cancelled()
+    finally:
+        watcher.close()
+
+
+def test_cancelled_pending_submission_is_not_sent(monkeypatch):
+    client, s3, runtime = make_bulk_client(monkeypatch)
+    watcher = client.result_watcher
+    try:
+        runtime.release.clear()
+        futures = client.submit_many([{"i": 1}, {"i": 2}], max_concurrency=1, timeout=30)
+        # the second payload waits for the only submission thread
+        assert futures[1].cancel()
+        runtime.release.set()
+        s3.put("s3://bucket/output/1.out", {"i": 1})
+        assert futures[0].result(timeout=5) == {"i": 1}
+        time.sleep(0.1)
+        assert runtime.calls == 1
+        assert not watcher._pending
+    finally:
+        watcher.close()
+
+
+def test_notification_topics_without_a_session(monkeypatch):
+    # the runtime client is provided externally, the topics are read with the default credentials
+    clients = {"sqs": FakeSQS(), "sagemaker": FakeSageMaker()}
+    clients["sns"] = FakeSNS(clients["sqs"])
+    sessions = []
+
+    def Session(profile_name=None, region_name=None):
+        sessions.append((profile_name, region_name))
+        return SimpleNamespace(client=lambda name, region_name=None: clients[name])
+
+    monkeypatch.setattr(boto3, "Session", Session)
+    client = SageMakerClient(
+        endpoint_name="endpoint",
+        client=SimpleNamespace(meta=SimpleNamespace(region_name="us-east-1")),
+        s3_client=FakeS3(),
+    )
+    assert client.boto_session is None
+    assert client._get_notification_topics() == ("arn:success", "arn:error")
+    assert sessions == [(None, "us-east-1")]
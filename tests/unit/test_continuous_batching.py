@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from backend.huggingface.llm.continuous_batching import ContinuousBatchingGenerator
+
+
+class Tokenizer:
+    pad_token_id = 0
+    eos_token_id = 1
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        eos_token_id=1,
+        pad_token_id=0,
+    )
+    return transformers.LlamaForCausalLM(config).eval()
+
+
+def generate(model, input_ids, max_new_tokens):
+    output_ids = model.generate(
+        torch.tensor([input_ids]),
+        attention_mask=torch.ones(1, len(input_ids), dtype=torch.long),
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+    )[0, len(input_ids):].tolist()
+    if 1 in output_ids:
+        output_ids = output_ids[:output_ids.index(1)]
+    return output_ids
+
+
+def test_batched_generations_match_generate(model):
+    generator = ContinuousBatchingGenerator(model, Tokenizer(), max_num_seqs=2)
+    prompts = [[5, 6, 7], [8, 9, 10, 11, 12, 13], [14, 15], [16, 17, 18, 19]]
+    # more requests than `max_num_seqs`, with different lengths, join the running batch
+    requests = [
+        generator.submit(input_ids, {"max_new_tokens": 4 + 2 * index})
+        for index, input_ids in enumerate(prompts)
+    ]
+    for index, (input_ids, request) in enumerate(zip(prompts, requests)):
+        assert request.future.result(timeout=60) == generate(model, input_ids, 4 + 2 * index)
+
+
+def test_cancelled_request_leaves_the_batch(model):
+    generator = ContinuousBatchingGenerator(model, Tokenizer(), max_num_seqs=1)
+    # never stops by itself (no eos)
+    request = generator.submit([5, 6, 7], {"max_new_tokens": 10 ** 6, "eos_token_id": -1})
+    deadline = time.time() + 60
+    while not request.output_ids and time.time() < deadline:
+        time.sleep(0.01)
+
+    async def wait_and_cancel():
+        from backend.huggingface.llm.transformer_llm_backend import TransformerLLMBackend
+
+        backend = TransformerLLMBackend.__new__(TransformerLLMBackend)
+        backend.generator = generator
+        backend._prepare_inputs = lambda request: ("", {"max_new_tokens": 10 ** 6, "eos_token_id": -1})
+        backend._submit_generation = lambda *args: request
+        task = asyncio.ensure_future(backend.ainvoke({"messages": []}))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(wait_and_cancel())
+    assert request.cancelled
+    # the only slot is free for the next request
+    next_request = generator.submit([5, 6], {"max_new_tokens": 2})
+    assert len(next_request.future.result(timeout=60)) <= 2
+    assert request.future.done()
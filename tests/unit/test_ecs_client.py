@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from emd.sdk.clients.client_base import EndpointHTTPError
+from emd.sdk.clients.ecs_client import ECSClient
+
+
+class Endpoint:
+    """Answers with the queued status codes, then with 200."""
+
+    def __init__(self, *status_codes):
+        self.status_codes = list(status_codes)
+        self.requests = 0
+
+    def __call__(self, request):
+        self.requests += 1
+        if self.status_codes:
+            status_code = self.status_codes.pop(0)
+            if isinstance(status_code, Exception):
+                raise status_code
+            return httpx.Response(status_code, text="busy")
+        payload = json.loads(request.content)
+        if payload.get("stream"):
+            return httpx.Response(200, content=b'data: {"n": 1}\n\ndata: not json\n\ndata: {"n": 2}\n\n')
+        return httpx.Response(200, json={"echo": payload["input"]})
+
+
+def make_client(endpoint, monkeypatch, max_retries=3):
+    client = ECSClient(base_url="http://lb", max_retries=max_retries, retry_backoff=0)
+    client._http_client = httpx.Client(transport=httpx.MockTransport(endpoint))
+    monkeypatch.setattr(
+        ECSClient, "_create_async_http_client",
+        lambda self: httpx.AsyncClient(transport=httpx.MockTransport(endpoint))
+    )
+    return client
+
+
+@pytest.mark.parametrize("status_code", [502, 503, 504])
+def test_gateway_errors_are_retried(monkeypatch, status_code):
+    endpoint = Endpoint(status_code, status_code)
+    client = make_client(endpoint, monkeypatch)
+    assert client.invoke({"input": "a"}) == {"echo": "a"}
+    assert endpoint.requests == 3
+
+
+def test_connection_errors_are_retried(monkeypatch):
+    endpoint = Endpoint(httpx.ConnectError("refused"))
+    client = make_client(endpoint, monkeypatch)
+    assert client.invoke({"input": "a"}) == {"echo": "a"}
+    assert endpoint.requests == 2
+
+
+def test_model_errors_are_not_retried(monkeypatch):
+    endpoint = Endpoint(500)
+    client = make_client(endpoint, monkeypatch)
+    with pytest.raises(EndpointHTTPError) as e:
+        client.invoke({"input": "a"})
+    assert e.value.status_code == 500
+    assert endpoint.requests == 1
+
+
+def test_retries_are_bounded(monkeypatch):
+    endpoint = Endpoint(503, 503, 503)
+    client = make_client(endpoint, monkeypatch, max_retries=2)
+    with pytest.raises(EndpointHTTPError) as e:
+        client.invoke({"input": "a"})
+    assert e.value.status_code == 503
+    assert endpoint.requests == 3
+
+
+def test_async_gateway_errors_are_retried(monkeypatch):
+    endpoint = Endpoint(502, 504)
+    client = make_client(endpoint, monkeypatch)
+
+    async def run():
+        try:
+            return await client.ainvoke({"input": "a"})
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == {"echo": "a"}
+    assert endpoint.requests == 3
+
+
+def test_undecodable_stream_frames_are_skipped(monkeypatch):
+    endpoint = Endpoint(503)
+    client = make_client(endpoint, monkeypatch)
+    assert list(client.invoke({"input": "a", "stream": True})) == [{"n": 1}, {"n": 2}]
+    assert endpoint.requests == 2
@@ -0,0 +1,73 @@
+import base64
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from backend.huggingface.embedding.transformers_embedding_backend import TransformerEmbeddingBackend
+from emd.sdk.clients.client_base import ClientBase
+
+
+@pytest.fixture
+def backend():
+    # only the response formatting is exercised, no model is loaded
+    backend = TransformerEmbeddingBackend.__new__(TransformerEmbeddingBackend)
+    backend.model_id = "m"
+    return backend
+
+
+@pytest.fixture
+def embeddings():
+    return np.arange(6, dtype=np.float32).reshape(2, 3) / 4
+
+
+def test_float_encoding_returns_lists(backend, embeddings):
+    response = backend.format_openai_response(embeddings)
+    assert [item["embedding"] for item in response["data"]] == embeddings.tolist()
+
+
+@pytest.mark.parametrize("embedding_dtype", ["float32", "float16"])
+def test_base64_encoding_round_trip(backend, embeddings, embedding_dtype):
+    response = backend.format_openai_response(embeddings, "base64", embedding_dtype)
+    # what the server sends
+    response = json.loads(json.dumps(response))
+    assert isinstance(response["data"][0]["embedding"], str)
+    payload = {"input": ["a", "b"], "encoding_format": "base64", "embedding_dtype": embedding_dtype}
+    decoded = ClientBase(model_id="m")._decode_response(
+        json.dumps(response).encode("utf-8"), "application/json", payload
+    )
+    np.testing.assert_array_equal(np.stack([item["embedding"] for item in decoded["data"]]), embeddings)
+
+
+def test_base64_embedding_is_little_endian(backend):
+    response = backend.format_openai_response([np.array([1.0], dtype=">f4")], "base64")
+    assert base64.b64decode(response["data"][0]["embedding"]) == np.array([1.0], dtype="<f4").tobytes()
+
+
+@pytest.mark.parametrize("embedding_dtype", ["float32", "float16"])
+def test_binary_encoding_round_trip(backend, embeddings, embedding_dtype):
+    response = backend.format_openai_response(embeddings, "binary", embedding_dtype)
+    content_type = response.headers["content-type"]
+    assert content_type.startswith("application/octet-stream")
+    assert f"dtype={embedding_dtype}" in content_type
+    assert "shape=2,3" in content_type
+    decoded = ClientBase(model_id="m")._decode_response(response.body, content_type, {"encoding_format": "binary"})
+    assert decoded["model"] == "m"
+    assert [item["index"] for item in decoded["data"]] == [0, 1]
+    np.testing.assert_array_equal(np.stack([item["embedding"] for item in decoded["data"]]), embeddings)
+
+
+def test_binary_encoding_of_a_list_of_embeddings(backend, embeddings):
+    # the multimodal models return one tensor per input
+    response = backend.format_openai_response(list(embeddings), "binary")
+    assert response.body == embeddings.astype("<f4").tobytes()
+
+
+def test_unsupported_encodings_are_rejected(backend, embeddings):
+    with pytest.raises(ValueError):
+        backend.format_openai_response(embeddings, "hex")
+    with pytest.raises(ValueError):
+        backend.format_openai_response(embeddings, "base64", "int8")
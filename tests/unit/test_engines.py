@@ -0,0 +1,20 @@
+from emd.models import engines
+
+
+def test_long_audio_mode_is_opt_in():
+    # the chunked mode changes the transcription output, existing jobs keep `model.transcribe`
+    assert engines.HuggingFaceWhisperEngine.model_fields["long_audio_min_duration"].default is None
+    assert engines.huggingface_whisper_engine.long_audio_min_duration is None
+
+
+def test_embedding_and_rerank_engines_have_no_llm_fields():
+    for engine_cls in (engines.HuggingFaceEmbeddingEngine, engines.HuggingFaceRerankEngine):
+        assert "continuous_batching" not in engine_cls.model_fields
+        assert "max_num_seqs" not in engine_cls.model_fields
+        assert "pretrained_model_init_kwargs" in engine_cls.model_fields
+
+
+def test_raw_stream_proxy_is_enabled_per_engine():
+    assert engines.OpenAICompitableEngine.model_fields["raw_stream_proxy"].default is False
+    assert engines.tgi_qwen2d5_72b_engine064.raw_stream_proxy is False
+    assert engines.VllmEngine.model_fields["raw_stream_proxy"].default is True
@@ -0,0 +1,41 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from framework.fast_api import fast_api
+from utils.inference_executor import InferenceExecutor, InferenceQueueFullError
+
+
+def test_submissions_beyond_the_queue_are_rejected():
+    gate = threading.Event()
+    executor = InferenceExecutor(max_workers=1, max_queue_size=1)
+    try:
+        running = executor.submit(gate.wait, 5)
+        queued = executor.submit(lambda: "queued")
+        with pytest.raises(InferenceQueueFullError):
+            executor.submit(lambda: "rejected")
+        assert executor.pending == 2
+        assert executor.queue_depth == 1
+        gate.set()
+        assert running.result(timeout=5)
+        assert queued.result(timeout=5) == "queued"
+    finally:
+        gate.set()
+        executor.shutdown()
+    # finished jobs free their slots
+    assert executor.pending == 0
+
+
+class SaturatedEngine:
+    async def ainvoke_with_metrics(self, payload, metrics):
+        raise InferenceQueueFullError(queue_size=4, retry_after=2)
+
+
+def test_full_queue_answers_503(monkeypatch):
+    monkeypatch.setattr(fast_api, "engine", SaturatedEngine())
+    monkeypatch.setattr(fast_api, "admission_controller", None)
+    response = TestClient(fast_api.app).post("/invocations", json={"input": "hello"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
+    assert "max queue size: 4" in response.json()["error"]
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from emd.sdk.clients.sagemaker_client import SageMakerClient
+from emd.sdk.clients.integrations.langchain_clients import (
+    SageMakerVllmChatModel,
+    SageMakerVllmEmbeddings,
+    SageMakerVllmRerank,
+)
+
+
+class FakeSageMakerClient(SageMakerClient):
+    """Answers embedding and rerank requests, `ainvoke` must not be used by the sync methods."""
+
+    def invoke(self, pyload):
+        self.__dict__.setdefault("requests", []).append(pyload)
+        if "documents" in pyload:
+            scores = [float(len(document)) for document in pyload["documents"]]
+            return {"results": [
+                {"index": index, "relevance_score": score} for index, score in enumerate(scores)
+            ]}
+        # reversed order, the client sorts the embeddings by index
+        return {"data": [
+            {"index": index, "embedding": [float(len(text)), 1.0]}
+            for index, text in reversed(list(enumerate(pyload["input"])))
+        ]}
+
+    async def ainvoke(self, pyload):
+        return self.invoke(pyload)
+
+
+def make_fake_client():
+    return FakeSageMakerClient.model_construct(endpoint_name="endpoint")
+
+
+def test_embed_documents_batches_without_event_loop():
+    client = make_fake_client()
+    embeddings = SageMakerVllmEmbeddings(sagemaker_client=client, batch_size=2, max_concurrency=2)
+    texts = ["a", "bb", "ccc", "dddd", "eeeee"]
+    assert embeddings.embed_documents(texts) == [[float(len(text)), 1.0] for text in texts]
+    assert sorted(len(request["input"]) for request in client.requests) == [1, 2, 2]
+    # the sync and async paths agree
+    assert asyncio.run(embeddings.aembed_documents(texts)) == embeddings.embed_documents(texts)
+
+
+def test_embed_documents_inside_running_loop():
+    embeddings = SageMakerVllmEmbeddings(sagemaker_client=make_fake_client())
+
+    async def call_sync():
+        # e.g. a notebook, `asyncio.run` would fail here
+        return embeddings.embed_documents(["a", "bb"])
+
+    assert asyncio.run(call_sync()) == [[1.0, 1.0], [2.0, 1.0]]
+
+
+def test_rerank_merges_chunks():
+    client = make_fake_client()
+    rerank = SageMakerVllmRerank(sagemaker_client=client, max_documents_per_request=2)
+    documents = ["aaa", "a", "aaaaa", "aa", "aaaa"]
+    results = rerank.rerank(documents, "query", top_n=3)
+    assert [result["index"] for result in results] == [2, 4, 0]
+    assert len(client.requests) == 3
+    assert asyncio.run(rerank.arerank(documents, "query", top_n=3)) == results
+
+
+class FakeChatClient(SageMakerClient):
+    """Answers chat requests on the event loop only."""
+
+    def invoke(self, pyload):
+        raise AssertionError("the async methods must not use the sync client")
+
+    async def ainvoke(self, pyload):
+        self.__dict__.setdefault("requests", []).append(pyload)
+        return {
+            "model": "qwen",
+            "choices": [{"message": {"role": "assistant", "content": "hello"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4},
+        }
+
+    async def astream(self, pyload):
+        self.__dict__.setdefault("requests", []).append(pyload)
+        for content in ["hel", "lo"]:
+            await asyncio.sleep(0)
+            yield {"choices": [{"delta": {"role": "assistant", "content": content}, "finish_reason": None}]}
+        yield {"choices": []}
+        yield {"choices": [{"delta": {"content": ""}, "finish_reason": "stop"}]}
+
+
+def make_chat_model():
+    client = FakeChatClient.model_construct(endpoint_name="endpoint")
+    return SageMakerVllmChatModel(sagemaker_client=client, model_kwargs={"temperature": 0}), client
+
+
+def test_agenerate_runs_on_the_event_loop():
+    model, client = make_chat_model()
+    message = asyncio.run(model.ainvoke("hi"))
+    assert message.content == "hello"
+    assert message.usage_metadata["total_tokens"] == 4
+    assert client.requests == [{"temperature": 0, "messages": [{"role": "user", "content": "hi"}], "stream": False}]
+
+
+def test_astream_yields_the_chunks():
+    model, client = make_chat_model()
+
+    async def run():
+        return [chunk async for chunk in model.astream("hi")]
+
+    chunks = asyncio.run(run())
+    assert "".join(chunk.content for chunk in chunks) == "hello"
+    assert chunks[-1].response_metadata["finish_reason"] == "stop"
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from emd.utils.line_iterator import (
+    AsyncLineIterator,
+    LineDecoder,
+    LineIterator,
+    aiter_frames,
+    decode_generated_text_line,
+    iter_frames,
+)
+
+
+def split_every(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+SSE_STREAM = (
+    b': keep-alive\n\n'
+    b'data: {"a": 1}\r\n\r\n'
+    b'event: message\ndata: {"b":\ndata: 2}\n\n'
+    b'data: [DONE]\n\n'
+)
+
+
+def test_line_decoder_joins_split_lines():
+    decoder = LineDecoder()
+    assert decoder.feed(b'{"outputs": ') == []
+    assert decoder.feed(b'[" problem"]}\n{"x"') == [b'{"outputs": [" problem"]}']
+    assert decoder.feed(b': 1}\r\n') == [b'{"x": 1}']
+    assert decoder.flush() == []
+
+
+def test_line_decoder_partial_mode():
+    decoder = LineDecoder(partial=True)
+    assert decoder.feed(b'{"generated_text": "a') == [b'{"generated_text": "a']
+    assert decoder.feed(b'b\n') == [b'b\n']
+
+
+def test_line_decoder_bounds_unterminated_lines():
+    decoder = LineDecoder(max_line_size=8)
+    with pytest.raises(ValueError):
+        decoder.feed(b"x" * 9)
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 1000])
+def test_sse_frames(size):
+    frames = list(iter_frames(LineIterator(split_every(SSE_STREAM, size))))
+    assert frames == [b'{"a": 1}', b'{"b":\n2}']
+
+
+@pytest.mark.parametrize("size", [1, 5, 1000])
+def test_jsonl_frames_of_payload_parts(size):
+    stream = b'{"a": 1}\n\n{"b": 2}\n{"c": 3}'
+    events = [{"PayloadPart": {"Bytes": part}} for part in split_every(stream, size)] + [{"Unknown": {}}]
+    assert list(iter_frames(LineIterator(events))) == [b'{"a": 1}', b'{"b": 2}', b'{"c": 3}']
+
+
+def test_async_frames_match_sync_frames():
+    async def chunks():
+        for chunk in split_every(SSE_STREAM, 4):
+            yield chunk
+
+    async def collect():
+        return [frame async for frame in aiter_frames(AsyncLineIterator(chunks()))]
+
+    assert asyncio.run(collect()) == list(iter_frames(LineIterator(split_every(SSE_STREAM, 4))))
+
+
+def test_decode_generated_text_line():
+    assert decode_generated_text_line(b'{"generated_text": "a\\nb"}') == "a\nb"
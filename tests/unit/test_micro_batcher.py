@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils.inference_executor import InferenceExecutor, InferenceQueueFullError
+from utils.micro_batcher import MicroBatcher
+
+
+class Recorder:
+    """Batch function recording its calls and the peak number of concurrent calls."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, items, group_key):
+        with self.lock:
+            self.calls.append((list(items), group_key))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return [f"{group_key}:{item}" for item in items]
+
+
+def test_concurrent_requests_are_coalesced():
+    recorder = Recorder()
+    batcher = MicroBatcher(recorder, max_batch_size=8, max_wait_ms=50)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.submit(["a", "bb"], "g"),
+            batcher.submit(["ccc"], "g"),
+            batcher.submit(["d"], "h"),
+        )
+
+    results = asyncio.run(run())
+    assert results == [["g:a", "g:bb"], ["g:ccc"], ["h:d"]]
+    # one call per group key
+    assert sorted(group_key for _, group_key in recorder.calls) == ["g", "h"]
+
+
+def test_chunks_do_not_cross_length_buckets():
+    recorder = Recorder()
+    batcher = MicroBatcher(recorder, max_batch_size=2, max_wait_ms=50, length_buckets=[3])
+
+    async def run():
+        return await asyncio.gather(
+            batcher.submit(["aaaaa", "a"]),
+            batcher.submit(["bb", "bbbbbb", "b"]),
+        )
+
+    assert asyncio.run(run()) == [["None:aaaaa", "None:a"], ["None:bb", "None:bbbbbb", "None:b"]]
+    for items, _ in recorder.calls:
+        assert len(items) <= 2
+        assert len({len(item) <= 3 for item in items}) == 1
+
+
+def test_chunks_run_on_every_worker():
+    recorder = Recorder(delay=0.1)
+    executor = InferenceExecutor(max_workers=2, max_queue_size=8)
+    batcher = MicroBatcher(recorder, max_batch_size=1, max_wait_ms=50, executor=executor)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit([str(i)]) for i in range(4)))
+
+    t0 = time.time()
+    assert asyncio.run(run()) == [[f"None:{i}"] for i in range(4)]
+    # the chunks of a batch run concurrently, bounded by the workers of the executor
+    assert recorder.max_running == 2
+    assert time.time() - t0 < 0.35
+    executor.shutdown()
+
+
+def test_errors_fail_the_requests_of_the_chunk():
+    def fail(items, group_key):
+        raise RuntimeError("boom")
+
+    batcher = MicroBatcher(fail, max_wait_ms=1)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await batcher.submit(["a"])
+
+    asyncio.run(run())
+
+
+def test_queue_full():
+    gate = threading.Event()
+
+    def wait_for_gate(items, group_key):
+        gate.wait(5)
+        return items
+
+    batcher = MicroBatcher(wait_for_gate, max_batch_size=1, max_wait_ms=1, max_pending_requests=1)
+
+    async def run():
+        futures = []
+        try:
+            for item in ("a", "b", "c"):
+                # "a" runs, "b" waits for the worker, "c" waits in the queue
+                futures.append(asyncio.ensure_future(batcher.submit([item])))
+                await asyncio.sleep(0.05)
+            with pytest.raises(InferenceQueueFullError):
+                await batcher.submit(["d"])
+        finally:
+            gate.set()
+        return await asyncio.gather(*futures)
+
+    assert asyncio.run(run()) == [["a"], ["b"], ["c"]]
+
+
+def test_worker_failure_fails_the_waiting_requests():
+    batcher = MicroBatcher(lambda items, group_key: items, max_wait_ms=1)
+
+    def broken(pending):
+        raise RuntimeError("worker bug")
+
+    async def run():
+        batcher._make_chunks = broken
+        with pytest.raises(RuntimeError, match="worker bug"):
+            await asyncio.wait_for(batcher.submit(["a"]), 1)
+        # the next submission gets a new worker
+        del batcher._make_chunks
+        assert await asyncio.wait_for(batcher.submit(["b"]), 1) == ["b"]
+
+    asyncio.run(run())
+
+
+def test_stopped_worker_cancels_the_queued_requests():
+    gate = threading.Event()
+
+    def wait_for_gate(items, group_key):
+        gate.wait(5)
+        return items
+
+    batcher = MicroBatcher(wait_for_gate, max_batch_size=1, max_wait_ms=1)
+
+    async def run():
+        try:
+            running = asyncio.ensure_future(batcher.submit(["a"]))
+            await asyncio.sleep(0.05)
+            queued = [asyncio.ensure_future(batcher.submit([item])) for item in ("b", "c")]
+            await asyncio.sleep(0.05)
+            batcher._worker.cancel()
+            for future in queued:
+                with pytest.raises(asyncio.CancelledError):
+                    await asyncio.wait_for(future, 1)
+        finally:
+            gate.set()
+        assert await running == ["a"]
+
+    asyncio.run(run())
@@ -0,0 +1,171 @@
+import asyncio
+
+import pytest
+from botocore.exceptions import ClientError
+
+from emd.sdk.clients.client_base import ClientBase, EndpointHTTPError
+from emd.sdk.clients.pooled_client import PooledClient, is_endpoint_failure
+
+
+class FakeClient(ClientBase):
+    """Endpoint answering with its name, or raising the next of its `errors`."""
+
+    name: str = ""
+    errors: list = []
+    calls: int = 0
+
+    def _cache_endpoint(self) -> str:
+        return self.name
+
+    def _next(self, pyload):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"endpoint": self.name, **pyload}
+
+    def _invoke(self, pyload):
+        response = self._next(pyload)
+        if pyload.get("stream", False):
+            return iter([response])
+        return response
+
+    async def _ainvoke(self, pyload):
+        # the requests of a gather overlap
+        await asyncio.sleep(0)
+        return self._next(pyload)
+
+    async def _astream(self, pyload):
+        yield self._next(pyload)
+        yield {"endpoint": self.name, "done": True}
+
+
+def throttling_error():
+    return ClientError({"Error": {"Code": "ThrottlingException"}}, "InvokeEndpoint")
+
+
+def test_endpoint_failures():
+    assert is_endpoint_failure(EndpointHTTPError(503, "unavailable"))
+    assert is_endpoint_failure(EndpointHTTPError(429, "slow down"))
+    assert not is_endpoint_failure(EndpointHTTPError(400, "bad request"))
+    assert is_endpoint_failure(throttling_error())
+    assert is_endpoint_failure(ClientError(
+        {"Error": {"Code": "ModelError"}, "OriginalStatusCode": 500}, "InvokeEndpoint"
+    ))
+    assert not is_endpoint_failure(ValueError("bad payload"))
+
+
+def test_fails_over_and_ejects_the_failed_endpoint():
+    failing = FakeClient(name="a", errors=[throttling_error()])
+    healthy = FakeClient(name="b")
+    pool = PooledClient(clients=[failing, healthy], eject_cooldown=60)
+    for _ in range(3):
+        assert pool.invoke({"input": ["x"]})["endpoint"] == "b"
+    # the ejected endpoint is not tried again during its cooldown
+    assert failing.calls <= 1
+    assert healthy.calls == 3
+
+
+def test_client_errors_do_not_fail_over():
+    first = FakeClient(name="a", errors=[EndpointHTTPError(400, "bad request")])
+    second = FakeClient(name="b", errors=[EndpointHTTPError(400, "bad request")])
+    pool = PooledClient(clients=[first, second])
+    with pytest.raises(EndpointHTTPError):
+        pool.invoke({"input": ["x"]})
+    assert first.calls + second.calls == 1
+
+
+def test_max_failovers():
+    clients = [FakeClient(name=str(i), errors=[EndpointHTTPError(503, "unavailable")]) for i in range(4)]
+    pool = PooledClient(clients=clients, max_failovers=1)
+    with pytest.raises(EndpointHTTPError):
+        pool.invoke({"input": ["x"]})
+    assert sum(client.calls for client in clients) == 2
+
+
+def test_least_outstanding_balances_concurrent_requests():
+    clients = [FakeClient(name="a"), FakeClient(name="b")]
+    pool = PooledClient(clients=clients)
+
+    async def run():
+        return await asyncio.gather(*(pool.ainvoke({"input": [str(i)]}) for i in range(10)))
+
+    asyncio.run(run())
+    assert clients[0].calls == clients[1].calls == 5
+    assert all(state.outstanding == 0 for state in pool._states)
+
+
+def test_stream_fails_over_before_its_first_chunk():
+    failing = FakeClient(name="a", errors=[EndpointHTTPError(503, "unavailable")])
+    healthy = FakeClient(name="b")
+    pool = PooledClient(clients=[failing, healthy])
+    # the failing endpoint is tried first
+    pool._states[1].outstanding = 1
+
+    async def run():
+        return [chunk async for chunk in pool.astream({"messages": [], "stream": True})]
+
+    chunks = asyncio.run(run())
+    assert [chunk["endpoint"] for chunk in chunks] == ["b", "b"]
+    assert pool._states[0].ejected_until > 0
+    assert pool._states[1].outstanding == 1
+
+
+def test_sync_stream_releases_its_endpoint():
+    pool = PooledClient(clients=[FakeClient(name="a")])
+    chunks = list(pool.invoke({"messages": [], "stream": True}))
+    assert chunks[0]["endpoint"] == "a"
+    assert pool._states[0].outstanding == 0
+    assert pool._states[0].ewma is not None
+
+
+class LazyStreamClient(FakeClient):
+    """Streams fail when their first chunk is read, like the sagemaker event streams."""
+
+    def _invoke(self, pyload):
+        def stream():
+            yield self._next(pyload)
+            yield {"endpoint": self.name, "done": True}
+        return stream()
+
+
+def test_sync_stream_fails_over_on_its_first_chunk():
+    failing = LazyStreamClient(name="a", errors=[EndpointHTTPError(503, "unavailable")])
+    healthy = LazyStreamClient(name="b")
+    pool = PooledClient(clients=[failing, healthy])
+    # the failing endpoint is tried first
+    pool._states[1].outstanding = 1
+    chunks = list(pool.invoke({"messages": [], "stream": True}))
+    assert [chunk["endpoint"] for chunk in chunks] == ["b", "b"]
+    assert pool._states[0].ejected_until > 0
+    assert pool._states[0].outstanding == 0
+    assert pool._states[1].outstanding == 1
+
+
+def test_sync_stream_does_not_fail_over_after_its_first_chunk():
+    class BrokenStreamClient(FakeClient):
+        def _invoke(self, pyload):
+            def stream():
+                yield self._next(pyload)
+                raise EndpointHTTPError(503, "unavailable")
+            return stream()
+
+    broken = BrokenStreamClient(name="a")
+    healthy = FakeClient(name="b")
+    pool = PooledClient(clients=[broken, healthy])
+    pool._states[1].outstanding = 1
+    chunks = pool.invoke({"messages": [], "stream": True})
+    assert next(chunks)["endpoint"] == "a"
+    with pytest.raises(EndpointHTTPError):
+        next(chunks)
+    assert healthy.calls == 0
+    assert pool._states[0].outstanding == 0
+
+
+def test_ewma_prefers_the_fastest_endpoint():
+    clients = [FakeClient(name="slow"), FakeClient(name="fast")]
+    pool = PooledClient(clients=clients, strategy="ewma")
+    pool._states[0].ewma = 1.0
+    pool._states[1].ewma = 0.1
+    assert pool.invoke({"input": ["x"]})["endpoint"] == "fast"
+    with pytest.raises(ValueError):
+        PooledClient(clients=clients, strategy="random")
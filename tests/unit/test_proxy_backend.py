@@ -0,0 +1,230 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException
+
+from backend import backend as backend_module
+from backend.backend import OpenAICompitableProxyBackendBase
+from emd.models.utils.constants import ModelType, ServiceType
+
+
+class StreamingResponse:
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+        self.closed = False
+
+    async def aiter_bytes(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+    async def aclose(self):
+        self.closed = True
+
+
+class ProxyBackend(OpenAICompitableProxyBackendBase):
+    def invoke(self, request):
+        raise NotImplementedError
+
+
+def make_backend(service_type):
+    backend = ProxyBackend.__new__(ProxyBackend)
+    backend.service_type = service_type
+    return backend
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+@pytest.mark.parametrize("service_type", [ServiceType.SAGEMAKER, ServiceType.ECS])
+def test_raw_stream_yields_bytes_on_error(service_type):
+    backend = make_backend(service_type)
+    response = StreamingResponse([b'{"a": 1}\n'], error=RuntimeError("engine went away"))
+    chunks = asyncio.run(collect(backend._aiter_raw_streaming_response(response)))
+    assert all(isinstance(chunk, bytes) for chunk in chunks)
+    assert b"engine went away" in chunks[-1]
+    assert response.closed
+
+
+def test_sagemaker_raw_stream_is_reframed():
+    backend = make_backend(ServiceType.SAGEMAKER)
+    # a json line split across two reads is forwarded as one frame
+    response = StreamingResponse([b'{"a": ', b'1}\n{"b": 2}\n'])
+    chunks = asyncio.run(collect(backend._aiter_raw_streaming_response(response)))
+    assert chunks == [b'{"a": 1}\n', b'{"b": 2}\n']
+
+
+class RecordingMetrics:
+    def __init__(self):
+        self.chunks = 0
+        self.tokens = None
+        self.events = None
+        self.done = False
+
+    def observe_chunk(self):
+        self.chunks += 1
+
+    def observe_engine_done(self):
+        self.done = True
+
+    def observe_tokens(self, input_tokens, output_tokens):
+        self.tokens = (input_tokens, output_tokens)
+
+    def observe_stream_events(self, events):
+        self.events = events
+
+
+async def aiter(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def instrument(backend, chunks):
+    metrics = RecordingMetrics()
+    forwarded = asyncio.run(collect(backend._ainstrument_stream(aiter(chunks), metrics)))
+    # the reads are forwarded untouched
+    assert forwarded == chunks
+    return metrics
+
+
+def test_split_reads_are_instrumented_per_event():
+    backend = make_backend(ServiceType.ECS)
+    stream = (
+        b'data: {"choices":[{"delta":{"content":"a"}}]}\n\n'
+        b'data: {"choices":[{"delta":{"content":"b"}}]}\n\n'
+        b'data: {"choices":[],"usage":{"prompt_tokens":7,"completion_tokens":2}}\n\n'
+        b'data: [DONE]\n\n'
+    )
+    # cut inside the `data:` marker and inside the usage object
+    cuts = [2, stream.index(b'"usage"') + 12]
+    chunks = [stream[:cuts[0]], stream[cuts[0]:cuts[1]], stream[cuts[1]:]]
+    metrics = instrument(backend, chunks)
+    assert metrics.chunks == 3
+    assert metrics.tokens == (7, 2)
+    assert metrics.events == 3
+    assert metrics.done
+
+
+def test_streams_without_usage_report_events_not_tokens():
+    backend = make_backend(ServiceType.SAGEMAKER)
+    metrics = instrument(backend, [b'{"a": 1}\n{"b"', b': 2}\n', b'{"c": 3}'])
+    assert metrics.chunks == 3
+    assert metrics.tokens == (None, None)
+    assert metrics.events == 3
+
+
+def test_in_process_stream_chunks_are_events():
+    backend = make_backend(ServiceType.ECS)
+    metrics = instrument(backend, ['data: {"choices":[]}\n\n', 'data: {"choices":[]}\n\n'])
+    assert metrics.chunks == 2
+    assert metrics.tokens == (None, None)
+    assert metrics.events == 2
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, model=None, messages=None, stream=None, input=None,
+                     extra_body=None, extra_headers=None):
+        self.calls.append({"model": model, "extra_body": extra_body, "extra_headers": extra_headers})
+        return SimpleNamespace(usage=SimpleNamespace(prompt_tokens=3, completion_tokens=2))
+
+
+class TransformingProxyBackend(ProxyBackend):
+    async def _atransform_response(self, response):
+        return {"transformed": response}
+
+
+def make_engine_backend(handler, model_type=ModelType.LLM, **engine_kwargs):
+    backend = TransformingProxyBackend.__new__(TransformingProxyBackend)
+    engine = {"max_concurrency": 4, "read_timeout": 30, "raw_stream_proxy": False, "raw_response_proxy": False}
+    engine.update(engine_kwargs)
+    backend.execute_model = SimpleNamespace(executable_config=SimpleNamespace(current_engine=SimpleNamespace(**engine)))
+    backend.service_type = ServiceType.SAGEMAKER
+    backend.model_type = model_type
+    backend.model_id = "model"
+    backend.engine_type = "vllm"
+    backend.api_key = None
+    backend.raw_stream_proxy = engine["raw_stream_proxy"]
+    backend.raw_response_proxy = engine["raw_response_proxy"]
+    backend._http_client = None
+    completions = FakeCompletions()
+    backend.async_client = SimpleNamespace(
+        chat=SimpleNamespace(completions=completions), embeddings=completions
+    )
+    # the pooled client is created by the backend, only its transport is replaced
+    http_client = backend.http_client
+    http_client._transport = httpx.MockTransport(handler)
+    return backend, completions
+
+
+def engine_server(requests):
+    def handler(request):
+        requests.append(request)
+        if request.url.path.endswith("/rerank"):
+            return httpx.Response(200, json={"results": [{"index": 0, "relevance_score": 0.5}]})
+        return httpx.Response(200, content=b'{"id":"1","usage":{"prompt_tokens":3,"completion_tokens":2}}',
+                              headers={"content-type": "application/json"})
+    return handler
+
+
+def test_responses_go_through_the_backend_transform_by_default():
+    requests = []
+    backend, completions = make_engine_backend(engine_server(requests))
+    response = asyncio.run(backend.ainvoke({"messages": [], "top_k": 5, "extra_headers": {"Authorization": "key"}}))
+    assert response["transformed"].usage.prompt_tokens == 3
+    assert completions.calls == [{"model": "model", "extra_body": {"top_k": 5}, "extra_headers": {"Authorization": "key"}}]
+    assert requests == []
+
+
+def test_rerank_responses_go_through_the_backend_transform():
+    requests = []
+    backend, _ = make_engine_backend(engine_server(requests), model_type=ModelType.RERANK)
+    response = asyncio.run(backend.ainvoke({"query": "q", "documents": ["a"]}))
+    assert response == {"transformed": {"results": [{"index": 0, "relevance_score": 0.5}]}}
+    assert requests[0].url.path == "/v1/rerank"
+
+
+def test_opted_in_engines_forward_the_raw_response():
+    requests = []
+    backend, completions = make_engine_backend(engine_server(requests), raw_response_proxy=True)
+    response = asyncio.run(backend.ainvoke({"messages": [], "extra_headers": {"Authorization": "key"}}))
+    assert response.body == b'{"id":"1","usage":{"prompt_tokens":3,"completion_tokens":2}}'
+    assert backend.get_usage(response) == (3, 2)
+    assert completions.calls == []
+    assert requests[0].url.path == "/v1/chat/completions"
+    assert requests[0].headers["Authorization"] == "key"
+    assert json.loads(requests[0].content)["model"] == "model"
+
+
+def test_engine_errors_keep_their_status_code():
+    backend, _ = make_engine_backend(lambda request: httpx.Response(400, text="bad request"), raw_response_proxy=True)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(backend.ainvoke({"messages": []}))
+    assert e.value.status_code == 400
+
+
+def test_engine_http_client_is_bounded():
+    backend, _ = make_engine_backend(engine_server([]), max_concurrency=4, read_timeout=30)
+    assert backend.http_client.timeout.read == 30
+    assert backend.http_client.timeout.connect == 10
+
+
+def test_engine_max_concurrency_falls_back_with_a_warning(monkeypatch):
+    backend, _ = make_engine_backend(engine_server([]))
+    assert backend.engine_max_concurrency == 4
+    warnings = []
+    monkeypatch.setattr(backend_module.logger, "warning", warnings.append)
+    backend.execute_model.executable_config.current_engine.max_concurrency = None
+    assert backend.engine_max_concurrency == backend_module.DEFAULT_ENGINE_MAX_CONCURRENCY
+    assert "max_concurrency" in warnings[0]
@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("transformers")
+
+from fastapi import HTTPException
+
+from backend.huggingface.rerank.transformers_rerank_backend import TransformerRerankBackend
+
+
+class Model:
+    def compute_score(self, pairs):
+        return [float(len(document)) for _, document in pairs]
+
+
+def make_backend():
+    backend = TransformerRerankBackend.__new__(TransformerRerankBackend)
+    backend.model = Model()
+    backend.model_id = "rerank"
+    backend.rerank_batch_size = 2
+    return backend
+
+
+def test_top_n_indices():
+    scores = [0.1, 0.9, 0.5, 0.7]
+    assert TransformerRerankBackend.top_n_indices(scores, 2) == [1, 3]
+    # more than the number of documents returns them all
+    assert TransformerRerankBackend.top_n_indices(scores, 10) == [1, 3, 2, 0]
+    for top_n in (0, -1):
+        with pytest.raises(ValueError):
+            TransformerRerankBackend.top_n_indices(scores, top_n)
+
+
+def test_invoke_top_n():
+    backend = make_backend()
+    documents = ["aa", "aaaa", "a", "aaa"]
+    response = backend.invoke({"query": "q", "documents": documents, "top_n": 2, "return_documents": False})
+    assert [result["index"] for result in response["results"]] == [1, 3]
+    response = backend.invoke({"query": "q", "documents": documents, "top_n": 100})
+    assert [result["document"]["text"] for result in response["results"]] == ["aaaa", "aaa", "aa", "a"]
+    # without top_n the scores are returned in the order of the documents
+    response = backend.invoke({"query": "q", "documents": documents})
+    assert [result["index"] for result in response["results"]] == [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize("top_n", [0, -2, "x"])
+def test_invoke_rejects_invalid_top_n(top_n):
+    with pytest.raises(HTTPException) as e:
+        make_backend().invoke({"query": "q", "documents": ["a", "b"], "top_n": top_n})
+    assert e.value.status_code == 400
@@ -0,0 +1,132 @@
+import pickle
+
+import numpy as np
+
+from emd.sdk.clients.client_base import ClientBase
+from emd.sdk.clients.response_cache import (
+    ResponseCache,
+    dumps_response,
+    is_deterministic_request,
+    loads_response,
+    request_cache_key,
+)
+
+
+def test_request_cache_key_is_canonical():
+    assert request_cache_key("endpoint", {"input": ["a"], "model": "m"}) == \
+        request_cache_key("endpoint", {"model": "m", "input": ["a"]})
+    assert request_cache_key("endpoint", {"input": ["a"]}) != request_cache_key("other", {"input": ["a"]})
+
+
+def test_numpy_payloads_are_keyed_by_their_buffer():
+    first = np.zeros(10000, dtype=np.float32)
+    second = first.copy()
+    second[5000] = 1
+    # the reprs of both arrays are the same
+    assert str(first) == str(second)
+    assert request_cache_key("endpoint", {"input": first}) != request_cache_key("endpoint", {"input": second})
+    assert request_cache_key("endpoint", {"input": first}) == request_cache_key("endpoint", {"input": first.copy()})
+    assert request_cache_key("endpoint", {"input": first}) != \
+        request_cache_key("endpoint", {"input": first.astype(np.float16)})
+    assert request_cache_key("endpoint", {"input": first}) != \
+        request_cache_key("endpoint", {"input": first.reshape(100, 100)})
+
+
+def test_unknown_payload_values_are_not_cached():
+    assert request_cache_key("endpoint", {"input": object()}) is None
+
+
+def test_deterministic_requests():
+    assert is_deterministic_request({"input": ["a"]}, "embedding")
+    assert is_deterministic_request({"query": "q", "documents": ["a"]}, "rerank")
+    # e.g. audio inputs, or a client without a known model
+    assert not is_deterministic_request({"input": ["a"]}, "audio")
+    assert not is_deterministic_request({"input": ["a"]})
+    assert is_deterministic_request({"messages": [], "temperature": 0})
+    assert not is_deterministic_request({"messages": []})
+    assert not is_deterministic_request({"messages": [], "temperature": 0, "stream": True})
+
+
+def test_ndarray_responses_round_trip():
+    response = {"data": [{"index": 0, "embedding": np.arange(4, dtype=np.float16)}], "score": np.float32(0.5)}
+    decoded = loads_response(dumps_response(response))
+    embedding = decoded["data"][0]["embedding"]
+    assert embedding.dtype == np.float16 and embedding.tolist() == [0, 1, 2, 3]
+    assert decoded["score"] == 0.5
+
+
+def test_disk_tier_is_shared(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    writer = ResponseCache(path=path)
+    writer.set("key", {"data": [{"embedding": np.ones((2, 3), dtype=np.float32)}]})
+    reader = ResponseCache(path=path)
+    value = reader.get("key")
+    assert value["data"][0]["embedding"].shape == (2, 3)
+    assert reader.get("missing", "default") == "default"
+    writer.close()
+    reader.close()
+
+
+def test_pickled_rows_are_never_loaded(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(path=path)
+
+    class Exploit:
+        def __reduce__(self):
+            return (exec, ("raise AssertionError('unpickled')",))
+
+    data = pickle.dumps(Exploit())
+    cache._db.execute(
+        "INSERT INTO responses (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, NULL, 0)",
+        ("key", data, len(data))
+    )
+    cache._disk_size += len(data)
+    assert cache.get("key") is None
+    assert cache._disk_size == 0
+    cache.close()
+
+
+def test_disk_size_accounting(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite"), max_entries=1)
+
+    def stored_size():
+        return cache._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    for _ in range(3):
+        # replacing a row does not count its size twice
+        cache.set("key", {"text": "x" * 100})
+    assert cache._disk_size == stored_size()
+    cache.set("other", {"text": "y" * 10})
+    assert cache._disk_size == stored_size()
+
+
+def test_disk_eviction(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite"), max_entries=1, max_disk_size=250)
+    for i in range(5):
+        cache.set(f"key-{i}", {"text": str(i) * 100})
+    assert cache._disk_size <= 250
+    # least recently used entries are evicted first
+    assert cache.get("key-4") == {"text": "4" * 100}
+    cache.set("key-5", {"text": "5" * 100})
+    assert cache.get("key-0") is None
+
+
+class CountingClient(ClientBase):
+    calls: int = 0
+
+    def _cache_endpoint(self) -> str:
+        return "endpoint"
+
+    def _invoke(self, pyload):
+        self.calls += 1
+        return {"calls": self.calls}
+
+
+def test_clients_cache_inputs_of_embedding_models_only():
+    embedding_client = CountingClient(model_id="bge-m3", response_cache=ResponseCache(path=None))
+    for _ in range(2):
+        assert embedding_client.invoke({"input": ["a"]}) == {"calls": 1}
+    # the model type of a client without `model_id` is unknown
+    endpoint_client = CountingClient(response_cache=ResponseCache(path=None))
+    endpoint_client.invoke({"input": ["a"]})
+    assert endpoint_client.invoke({"input": ["a"]}) == {"calls": 2}
@@ -0,0 +1,93 @@
+import asyncio
+from types import SimpleNamespace
+
+import boto3
+import pytest
+
+from emd.sdk.clients.sagemaker_client import SageMakerClient
+
+
+def make_client(**kwargs):
+    # the runtime client is provided externally, without a session
+    return SageMakerClient(
+        endpoint_name="endpoint",
+        client=SimpleNamespace(meta=SimpleNamespace(region_name="us-west-2")),
+        **kwargs
+    )
+
+
+class FakeSession:
+    sessions = []
+
+    def __init__(self, profile_name=None, region_name=None):
+        self.profile_name = profile_name
+        self.region_name = region_name
+        self.sessions.append(self)
+
+    def get_credentials(self):
+        return SimpleNamespace(profile_name=self.profile_name)
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    monkeypatch.setattr(FakeSession, "sessions", [])
+    monkeypatch.setattr(boto3, "Session", FakeSession)
+    return FakeSession.sessions
+
+
+def test_credentials_of_external_clients_are_resolved_through_a_session(sessions):
+    client = make_client(credentials_profile_name="dev")
+    assert client._get_credentials().profile_name == "dev"
+    assert client._get_credentials().profile_name == "dev"
+    # the session is kept
+    assert [(s.profile_name, s.region_name) for s in sessions] == [("dev", "us-west-2")]
+
+
+def test_credentials_of_the_client_session_are_used(sessions):
+    boto_session = FakeSession(profile_name="prod")
+    client = make_client(boto_session=boto_session)
+    assert client._get_credentials().profile_name == "prod"
+    assert sessions == [boto_session]
+
+
+class FakeAsyncHttpClient:
+    def __init__(self):
+        self.closed_in = None
+
+    async def aclose(self):
+        self.closed_in = asyncio.get_running_loop()
+
+
+def test_replaced_async_http_client_is_closed_in_its_loop(monkeypatch):
+    monkeypatch.setattr(SageMakerClient, "_create_async_http_client", lambda self: FakeAsyncHttpClient())
+    client = make_client()
+
+    async def get_http_client():
+        return client.async_http_client
+
+    first_loop = asyncio.new_event_loop()
+    second_loop = asyncio.new_event_loop()
+    try:
+        first = first_loop.run_until_complete(get_http_client())
+        assert first_loop.run_until_complete(get_http_client()) is first
+        second = second_loop.run_until_complete(get_http_client())
+        assert second is not first
+        # the close is scheduled in the first loop
+        first_loop.run_until_complete(asyncio.sleep(0))
+        assert first.closed_in is first_loop
+        assert second.closed_in is None
+    finally:
+        first_loop.close()
+        second_loop.close()
+
+
+def test_client_of_a_closed_loop_is_dropped(monkeypatch):
+    monkeypatch.setattr(SageMakerClient, "_create_async_http_client", lambda self: FakeAsyncHttpClient())
+    client = make_client()
+
+    async def get_http_client():
+        return client.async_http_client
+
+    first = asyncio.run(get_http_client())
+    assert asyncio.run(get_http_client()) is not first
+    assert first.closed_in is None
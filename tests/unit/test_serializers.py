@@ -0,0 +1,75 @@
+import gzip
+import json
+
+import httpx
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from emd.sdk.clients import serializers
+from emd.sdk.clients.ecs_client import ECSClient
+from emd.sdk.clients.serializers import JSONSerializer
+from framework.fast_api import fast_api
+
+
+@pytest.fixture(params=["orjson", "json"])
+def serializer(request, monkeypatch):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(serializers, "orjson", None)
+    return JSONSerializer()
+
+
+def test_bodies_are_compact(serializer):
+    body = serializer.dumps({"input": ["a", "b"], "model": "bge-m3"})
+    assert body == b'{"input":["a","b"],"model":"bge-m3"}'
+
+
+def test_unicode_is_not_escaped(serializer):
+    body = serializer.dumps({"input": "你好"})
+    assert body == '{"input":"你好"}'.encode("utf-8")
+    assert json.loads(body) == {"input": "你好"}
+
+
+def test_large_integers_fall_back_to_the_standard_encoder(serializer):
+    assert json.loads(serializer.dumps({"seed": 2 ** 70})) == {"seed": 2 ** 70}
+
+
+def test_numpy_arrays_are_serialized():
+    pytest.importorskip("orjson")
+    body = JSONSerializer().dumps({"input": np.array([1.0, 2.0], dtype=np.float32)})
+    assert json.loads(body) == {"input": [1.0, 2.0]}
+
+
+def test_compression_is_opt_in():
+    assert JSONSerializer().encode({"input": "a" * 10000})[1] is None
+    serializer = JSONSerializer(compress_min_size=1000)
+    body, content_encoding = serializer.encode({"input": "a" * 10000})
+    assert content_encoding == "gzip"
+    assert json.loads(gzip.decompress(body)) == {"input": "a" * 10000}
+    # small bodies are sent as they are
+    assert serializer.encode({"input": "a"}) == (b'{"input":"a"}', None)
+
+
+class EchoEngine:
+    async def ainvoke_with_metrics(self, payload, metrics):
+        return payload
+
+
+def test_compressed_bodies_reach_the_server(monkeypatch):
+    monkeypatch.setattr(fast_api, "engine", EchoEngine())
+    monkeypatch.setattr(fast_api, "admission_controller", None)
+    server = TestClient(fast_api.app)
+    requests = []
+
+    def forward(request):
+        requests.append(request)
+        response = server.post("/invocations", content=request.content, headers=dict(request.headers))
+        return httpx.Response(response.status_code, content=response.content, headers={"Content-Type": "application/json"})
+
+    client = ECSClient(base_url="http://lb", serializer=JSONSerializer(compress_min_size=1000))
+    client._http_client = httpx.Client(transport=httpx.MockTransport(forward))
+    assert client.invoke({"input": "a" * 10000}) == {"input": "a" * 10000}
+    assert requests[0].headers["Content-Encoding"] == "gzip"
+    assert len(requests[0].content) < 1000
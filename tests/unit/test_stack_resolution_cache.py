@@ -0,0 +1,101 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from emd.sdk.clients.sagemaker_client import SageMakerClient
+from emd.utils import stack_resolution_cache
+from emd.utils.stack_resolution_cache import invalidate_model_stack_info, resolve_model_stack_info
+
+
+@pytest.fixture
+def described(monkeypatch, tmp_path):
+    """The `describe_stacks` calls, as `(stack, profile, region)`."""
+    described = []
+    stacks = {
+        "stack": [{"OutputKey": "SageMakerEndpointName", "OutputValue": "endpoint"}],
+        "deploying": [],
+    }
+
+    def describe(model_stack_name, profile_name=None, region_name=None):
+        described.append((model_stack_name, profile_name, region_name))
+        if model_stack_name not in stacks:
+            return None
+        return {"StackName": model_stack_name, "Outputs": stacks[model_stack_name], "Parameters": []}
+
+    monkeypatch.setattr(stack_resolution_cache, "_describe_model_stack", describe)
+    monkeypatch.setattr(stack_resolution_cache, "STACK_RESOLUTION_CACHE_PATH", str(tmp_path / "model_stacks.json"))
+    monkeypatch.setattr(stack_resolution_cache, "EMD_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(stack_resolution_cache, "_memory_cache", {})
+    monkeypatch.setattr(stack_resolution_cache, "get_current_region", lambda: "us-east-1")
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    return described
+
+
+def test_resolved_stacks_are_cached(described):
+    assert resolve_model_stack_info("stack")["Outputs"][0]["OutputValue"] == "endpoint"
+    resolve_model_stack_info("stack")
+    assert described == [("stack", None, None)]
+    # other processes read the file
+    stack_resolution_cache._memory_cache.clear()
+    resolve_model_stack_info("stack")
+    assert len(described) == 1
+    resolve_model_stack_info("stack", refresh=True)
+    assert len(described) == 2
+
+
+def test_cache_is_keyed_by_profile_and_region(described, monkeypatch):
+    resolve_model_stack_info("stack")
+    resolve_model_stack_info("stack", profile_name="dev")
+    resolve_model_stack_info("stack", region_name="eu-west-1")
+    resolve_model_stack_info("stack", profile_name="dev")
+    monkeypatch.setenv("AWS_PROFILE", "prod")
+    resolve_model_stack_info("stack")
+    assert described == [
+        ("stack", None, None), ("stack", "dev", None), ("stack", None, "eu-west-1"), ("stack", None, None)
+    ]
+
+
+def test_invalidated_stacks_are_described_again(described):
+    resolve_model_stack_info("stack", profile_name="dev")
+    resolve_model_stack_info("stack")
+    invalidate_model_stack_info("stack", profile_name="dev")
+    resolve_model_stack_info("stack", profile_name="dev")
+    resolve_model_stack_info("stack")
+    assert described == [("stack", "dev", None), ("stack", None, None), ("stack", "dev", None)]
+
+
+def test_expired_entries_are_described_again(described, monkeypatch):
+    resolve_model_stack_info("stack")
+    later = time.time() + stack_resolution_cache.STACK_RESOLUTION_CACHE_TTL + 1
+    monkeypatch.setattr(stack_resolution_cache.time, "time", lambda: later)
+    resolve_model_stack_info("stack")
+    assert len(described) == 2
+
+
+def test_cache_can_be_disabled(described, monkeypatch):
+    monkeypatch.setattr(stack_resolution_cache, "STACK_RESOLUTION_CACHE_TTL", 0)
+    resolve_model_stack_info("stack")
+    resolve_model_stack_info("stack")
+    assert len(described) == 2
+
+
+def test_stacks_without_outputs_are_not_cached(described):
+    resolve_model_stack_info("deploying")
+    resolve_model_stack_info("deploying")
+    assert len(described) == 2
+    with pytest.raises(ValueError):
+        resolve_model_stack_info("missing")
+
+
+def test_clients_resolve_with_their_profile_and_region(described):
+    client = SageMakerClient(
+        model_stack_name="stack",
+        client=SimpleNamespace(meta=SimpleNamespace(region_name="eu-west-1")),
+        credentials_profile_name="dev",
+        region_name="eu-west-1",
+    )
+    assert client.endpoint_name == "endpoint"
+    assert described == [("stack", "dev", "eu-west-1")]
+    client._invalidate_endpoint_resolution()
+    assert stack_resolution_cache._memory_cache == {}
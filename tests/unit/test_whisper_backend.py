@@ -0,0 +1,150 @@
+import pytest
+
+pytest.importorskip("whisper")
+pytest.importorskip("funasr")
+pytest.importorskip("silero_vad")
+
+from backend.huggingface.whisper import whisper_backend
+from backend.huggingface.whisper.whisper_backend import WhisperModelCache
+
+
+@pytest.fixture
+def loaded(monkeypatch):
+    loaded = []
+
+    def load_model(model_type, **kwargs):
+        loaded.append(model_type)
+        return object()
+
+    monkeypatch.setattr(whisper_backend.whisper, "load_model", load_model)
+    monkeypatch.setattr(WhisperModelCache, "_free_gpu_memory_ratio", staticmethod(lambda: 1.0))
+    return loaded
+
+
+def test_models_stay_resident_across_requests(loaded):
+    cache = WhisperModelCache(max_cached_models=2)
+    model = cache.get("large-v3")
+    assert cache.get("large-v3") is model
+    assert loaded == ["large-v3"]
+
+
+def test_least_recently_used_model_is_evicted(loaded):
+    cache = WhisperModelCache(max_cached_models=2)
+    cache.get("small")
+    cache.get("medium")
+    cache.get("small")
+    cache.get("large-v3")
+    assert list(cache._models) == ["small", "large-v3"]
+    cache.get("medium")
+    assert loaded == ["small", "medium", "large-v3", "medium"]
+
+
+def test_low_gpu_memory_evicts_before_loading(loaded, monkeypatch):
+    cache = WhisperModelCache(max_cached_models=4, min_free_gpu_memory_ratio=0.2)
+    cache.get("small")
+    cache.get("medium")
+    free_ratios = iter([0.1, 0.5])
+    monkeypatch.setattr(WhisperModelCache, "_free_gpu_memory_ratio", staticmethod(lambda: next(free_ratios, 0.5)))
+    cache.get("large-v3")
+    assert list(cache._models) == ["medium", "large-v3"]
+
+
+def test_chunks_are_cut_at_silences():
+    speech_timestamps = [
+        {"start": 1.0, "end": 10.0},
+        {"start": 12.0, "end": 25.0},
+        {"start": 27.0, "end": 40.0},
+        {"start": 41.0, "end": 50.0},
+    ]
+    assert whisper_backend.split_audio_chunks(speech_timestamps, 60.0, 30.0) == [(1.0, 25.0), (27.0, 50.0)]
+
+
+def test_long_speech_segments_are_cut_evenly():
+    assert whisper_backend.split_audio_chunks([{"start": 0.0, "end": 75.0}], 80.0, 30.0) == [
+        (0.0, 25.0), (25.0, 50.0), (50.0, 75.0)
+    ]
+
+
+class Tokenizer:
+    timestamp_begin = 100
+
+    def decode(self, tokens):
+        return "".join(chr(ord("a") + token) for token in tokens)
+
+
+def test_segments_are_shifted_by_the_chunk_offset():
+    # <0.00> a b <1.00><1.00> c <2.00> d
+    tokens = [100, 0, 1, 150, 150, 2, 200, 3]
+    segments = whisper_backend._split_timestamped_tokens(Tokenizer(), tokens, 30.0, 5.0)
+    assert [(s["start"], s["end"], s["text"]) for s in segments] == [
+        (30.0, 31.0, "ab"), (31.0, 32.0, "c"), (32.0, 35.0, "d")
+    ]
+
+
+def test_short_audio_keeps_the_sequential_transcription(monkeypatch):
+    monkeypatch.setattr(whisper_backend, "transcribe_long_audio", lambda *args, **kwargs: pytest.fail("long audio mode"))
+    monkeypatch.setattr(whisper_backend, "detect_language", lambda model, audio: "en")
+    monkeypatch.setattr(whisper_backend, "detect_speech_timestamps", lambda audio, lang: [{"start": 0.0, "end": 1.0}])
+
+    class Model:
+        def transcribe(self, audio, **decode_options):
+            return {"text": "hi", "segments": [{"start": 0.0, "end": 1.0, "text": "hi"}]}
+
+    monkeypatch.setattr(whisper_backend.model_cache, "get", lambda model_type: Model())
+    audio = whisper_backend.np.zeros(16000 * 2, dtype="float32")
+    result = whisper_backend.inference(audio, "large-v3", long_audio_config={"min_duration": 60})
+    assert result["segments"] == [{"start": 0.0, "end": 1.0, "text": "hi", "id": 0}]
+
+
+def test_long_audio_uses_the_chunked_mode(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        whisper_backend, "transcribe_long_audio",
+        lambda audio, model_type, **kwargs: calls.append(kwargs) or {"text": ""}
+    )
+    audio = whisper_backend.np.zeros(16000 * 2, dtype="float32")
+    whisper_backend.inference(audio, "large-v3", long_audio_config={"min_duration": 1, "batch_size": 4}, language="en")
+    assert calls == [{"max_chunk_duration": 30.0, "batch_size": 4, "executor": None, "language": "en"}]
+
+
+class FakeS3:
+    def __init__(self):
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append("head_object")
+        return {"ContentLength": 1024}
+
+    def download_file(self, bucket, key, file_name):
+        self.calls.append("download_file")
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = whisper_backend.WhisperBackend.__new__(whisper_backend.WhisperBackend)
+    backend.s3_client = FakeS3()
+    backend.stream_max_size = 2 * 1024 ** 3
+    backend.stream_part_size = 1024
+    backend.long_audio_config = {}
+    monkeypatch.setattr(whisper_backend, "inference", lambda audio, model_type, **kwargs: {"audio": audio})
+    monkeypatch.setattr(whisper_backend.whisper, "load_audio", lambda file_name: "downloaded", raising=False)
+    monkeypatch.setattr(whisper_backend.os, "remove", lambda file_name: None)
+    monkeypatch.setattr(whisper_backend, "load_audio_from_s3", lambda *args, **kwargs: "streamed")
+    return backend
+
+
+def invoke(backend, key):
+    return backend.invoke({
+        "audio_input": f"s3://bucket/{key}", "model": "large-v3", "bucket": "out", "key": "out.json", "config": {}
+    })
+
+
+def test_audio_is_streamed_from_s3(backend):
+    assert invoke(backend, "audio/talk.wav") == {"audio": "streamed"}
+    assert backend.s3_client.calls == ["head_object"]
+
+
+@pytest.mark.parametrize("key", ["audio/talk.mp4", "audio/talk.M4A", "audio/talk.mov"])
+def test_mp4_containers_are_downloaded_once(backend, key):
+    assert invoke(backend, key) == {"audio": "downloaded"}
+    assert backend.s3_client.calls == ["download_file"]